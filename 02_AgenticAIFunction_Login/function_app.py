@@ -1,45 +1,69 @@
-import os, json, re
+import os, json, re, time, threading, logging
+_IMPORT_STARTED = time.perf_counter()   # import-time instrumentation (logged at the end of the module)
+from itertools import islice
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.ai.projects import AIProjectClient
 
-# Initialize client and agent
+# Client and agent, set by _init_client() on the first chat request
 client = None
 agent = None
 init_error = None
 
-try:
-    PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
-    SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
-    RESOURCE_GROUP = os.environ.get("AZURE_RESOURCE_GROUP")
-    PROJECT_NAME = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
-    AGENT_ID = os.environ.get("AGENT_ID")
-    
-    if not PROJECT_ENDPOINT:
-        init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
-    elif not SUBSCRIPTION_ID or not RESOURCE_GROUP or not PROJECT_NAME:
-        init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
-    elif not AGENT_ID:
-        init_error = "AGENT_ID environment variable not set"
-    else:
-        credential = DefaultAzureCredential()
-        client = AIProjectClient(
-            credential=credential,
-            endpoint=PROJECT_ENDPOINT,
-            subscription_id=SUBSCRIPTION_ID,
-            resource_group_name=RESOURCE_GROUP,
-            project_name=PROJECT_NAME
-        )
-        agent = client.agents.get_agent(AGENT_ID)
-        
-        if not agent:
-            init_error = f"Agent with ID {AGENT_ID} not found"
+PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
+SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
+RESOURCE_GROUP = os.environ.get("AZURE_RESOURCE_GROUP")
+PROJECT_NAME = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
+AGENT_ID = os.environ.get("AGENT_ID")
+
+_init_lock = threading.Lock()
+_init_done = False
+
+def _init_client():
+    """
+    Import the AI Projects SDK, build the client and fetch the agent once, on first use
+    (thread-safe), instead of at import time. Sets client / agent / init_error.
+    A failure while building it (credential, network) is retried by the next request;
+    configuration errors stick.
+    """
+    global client, agent, init_error, _init_done
+    if _init_done:
+        return
+    with _init_lock:
+        if _init_done:
+            return
+        started = time.perf_counter()
+        init_error, retry = None, False
+        try:
+            if not PROJECT_ENDPOINT:
+                init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
+            elif not SUBSCRIPTION_ID or not RESOURCE_GROUP or not PROJECT_NAME:
+                init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
+            elif not AGENT_ID:
+                init_error = "AGENT_ID environment variable not set"
+            else:
+                from azure.identity import DefaultAzureCredential
+                from azure.ai.projects import AIProjectClient
+                credential = DefaultAzureCredential()
+                client = AIProjectClient(
+                    credential=credential,
+                    endpoint=PROJECT_ENDPOINT,
+                    subscription_id=SUBSCRIPTION_ID,
+                    resource_group_name=RESOURCE_GROUP,
+                    project_name=PROJECT_NAME
+                )
+                agent = client.agents.get_agent(AGENT_ID)
+
+                if not agent:
+                    init_error = f"Agent with ID {AGENT_ID} not found"
+                    client = None
+                    agent = None
+        except Exception as e:
+            init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
             client = None
             agent = None
-except Exception as e:
-    init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
-    client = None
-    agent = None
+            retry = True
+        _init_done = not retry
+        logging.info("Foundry client init took %.0f ms%s", (time.perf_counter() - started) * 1000,
+                     f" ({init_error})" if init_error else "")
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
@@ -56,6 +80,19 @@ def _add_user_message(thread_id: str, text: str):
         content=text
     )
 
+def _list_latest_messages(thread_id: str, run_id: str | None = None):
+    """
+    Newest-first messages, scoped to run_id when known (one message is enough then), so the
+    cost doesn't grow with the thread. Falls back to a plain list() on SDKs without these kwargs.
+    """
+    limit = 1 if run_id else 10
+    scope = {"run_id": run_id} if run_id else {}
+    try:
+        # materialized here: SDKs that don't know these kwargs fail on the first page fetch
+        return list(islice(client.agents.messages.list(thread_id=thread_id, order="desc", limit=limit, **scope), limit))
+    except TypeError:
+        return client.agents.messages.list(thread_id=thread_id)
+
 def _run_and_wait(thread_id: str) -> str:
     run = client.agents.runs.create_and_process(
         thread_id=thread_id,
@@ -65,7 +102,7 @@ def _run_and_wait(thread_id: str) -> str:
     if run.status == "failed":
         return f"(run failed: {run.last_error})"
 
-    messages = client.agents.messages.list(thread_id=thread_id)
+    messages = _list_latest_messages(thread_id, getattr(run, "id", None))
     
     for msg in messages:
         if getattr(msg, "role", None) == "assistant" and getattr(msg, "text_messages", None):
@@ -77,6 +114,7 @@ def _run_and_wait(thread_id: str) -> str:
 @app.route(route="chat", methods=[func.HttpMethod.POST])
 def chat(req: func.HttpRequest) -> func.HttpResponse:
     # Check if there was an initialization error
+    _init_client()
     if init_error:
         return func.HttpResponse(
             json.dumps({"error": "Initialization failed", "detail": init_error}),
@@ -130,3 +168,5 @@ def chat(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
             mimetype="application/json"
         )
+
+logging.info("function_app imported in %.0f ms", (time.perf_counter() - _IMPORT_STARTED) * 1000)
@@ -1,44 +1,68 @@
-import os, json, re
+import os, json, re, time, threading, logging
+_IMPORT_STARTED = time.perf_counter()   # import-time instrumentation (logged at the end of the module)
+from itertools import islice
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.ai.projects import AIProjectClient
 
-# Initialize client and agent(s)
+# Foundry client and init error, set by _init_client() on the first chat request
 client = None
 init_error = None
 
-try:
-    # Endpoint-style configuration
-    PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
-    SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
-    RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
-    PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
-
-    # Role-based agents (+ fallback)
-    AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
-    AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # user agent
-    AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # admin agent
-
-    if not PROJECT_ENDPOINT:
-        init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
-    elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
-        init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
-    elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
-        init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
-    else:
-        credential = DefaultAzureCredential()
-        client = AIProjectClient(
-            credential=credential,
-            endpoint=PROJECT_ENDPOINT,
-            subscription_id=SUBSCRIPTION_ID,
-            resource_group_name=RESOURCE_GROUP,
-            project_name=PROJECT_NAME,
-        )
-        # We pass assistant_id per call; no upfront agent fetch here.
+# -------------------- Foundry client: built on the first chat request, not at import --------------------
+# Endpoint-style configuration
+PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
+SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
+RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
+PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
+
+# Role-based agents (+ fallback)
+AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
+AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # user agent
+AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # admin agent
+
+_init_lock = threading.Lock()
+_init_done = False
 
-except Exception as e:
-    init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
-    client = None
+def _init_client():
+    """
+    Import the AI Projects SDK and build the client once, on first use (thread-safe), so cold
+    starts of routes that never talk to Foundry don't pay for it. Sets client / init_error.
+    A failure while building it (credential, network) is retried by the next request;
+    configuration errors stick.
+    """
+    global client, init_error, _init_done
+    if _init_done:
+        return
+    with _init_lock:
+        if _init_done:
+            return
+        started = time.perf_counter()
+        init_error, retry = None, False
+        try:
+            if not PROJECT_ENDPOINT:
+                init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
+            elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
+                init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
+            elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
+                init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
+            else:
+                from azure.identity import DefaultAzureCredential
+                from azure.ai.projects import AIProjectClient
+                credential = DefaultAzureCredential()
+                client = AIProjectClient(
+                    credential=credential,
+                    endpoint=PROJECT_ENDPOINT,
+                    subscription_id=SUBSCRIPTION_ID,
+                    resource_group_name=RESOURCE_GROUP,
+                    project_name=PROJECT_NAME,
+                )
+                # We pass assistant_id per call; no upfront agent fetch here.
+        except Exception as e:
+            init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
+            client = None
+            retry = True
+        _init_done = not retry
+        logging.info("Foundry client init took %.0f ms%s", (time.perf_counter() - started) * 1000,
+                     f" ({init_error})" if init_error else "")
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
@@ -71,6 +95,19 @@ def _add_user_message(thread_id: str, text: str):
         content=text
     )
 
+def _list_latest_messages(thread_id: str, run_id: str | None = None):
+    """
+    Newest-first messages, scoped to run_id when known (one message is enough then), so the
+    cost doesn't grow with the thread. Falls back to a plain list() on SDKs without these kwargs.
+    """
+    limit = 1 if run_id else 10
+    scope = {"run_id": run_id} if run_id else {}
+    try:
+        # materialized here: SDKs that don't know these kwargs fail on the first page fetch
+        return list(islice(client.agents.messages.list(thread_id=thread_id, order="desc", limit=limit, **scope), limit))
+    except TypeError:
+        return client.agents.messages.list(thread_id=thread_id)
+
 def _run_and_wait(thread_id: str, assistant_id: str) -> str:
     # NEW: runs live under client.agents.runs
     run = client.agents.runs.create_and_process(
@@ -83,8 +120,8 @@ def _run_and_wait(thread_id: str, assistant_id: str) -> str:
         last_error = getattr(run, "last_error", None)
         return f"(run failed: {last_error})" if last_error else "(run failed)"
 
-    # List messages in the thread and return the latest assistant text
-    messages = client.agents.messages.list(thread_id=thread_id)
+    # Latest assistant text from this run
+    messages = _list_latest_messages(thread_id, getattr(run, "id", None))
     for msg in messages:
         if getattr(msg, "role", None) == "assistant" and getattr(msg, "text_messages", None):
             text_value = msg.text_messages[-1].text.value
@@ -95,6 +132,7 @@ def _run_and_wait(thread_id: str, assistant_id: str) -> str:
 @app.route(route="chat", methods=[func.HttpMethod.POST])
 def chat(req: func.HttpRequest) -> func.HttpResponse:
     # Check init
+    _init_client()
     if init_error:
         return func.HttpResponse(
             json.dumps({"error": "Initialization failed", "detail": init_error}),
@@ -156,3 +194,5 @@ def chat(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
             mimetype="application/json"
         )
+
+logging.info("function_app imported in %.0f ms", (time.perf_counter() - _IMPORT_STARTED) * 1000)
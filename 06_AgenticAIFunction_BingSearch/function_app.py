@@ -1,10 +1,10 @@
-import os, json, re
+import os, json, re, time, threading, logging
+_IMPORT_STARTED = time.perf_counter()   # import-time instrumentation (logged at the end of the module)
+from itertools import islice
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.ai.projects import AIProjectClient
 from urllib.parse import quote_plus  # needed for Bing News fallback
 
-# Initialize client and agent(s)
+# Foundry client and init error, set by _init_client() on the first chat request
 client = None
 init_error = None
 
@@ -82,39 +82,62 @@ def _extract_sources_from_text(md: str, user_query: str | None = None):
 
     return md_clean.strip(), sources
 
-# -------------------- New endpoint-style client init (minimal change) --------------------
-try:
-    # Endpoint-style configuration
-    PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
-    SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
-    RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
-    PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
-
-    # Role-based agents (+ fallback)
-    AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
-    AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # useragent
-    AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # adminagent
-
-    if not PROJECT_ENDPOINT:
-        init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
-    elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
-        init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
-    elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
-        init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
-    else:
-        credential = DefaultAzureCredential()
-        client = AIProjectClient(
-            credential=credential,
-            endpoint=PROJECT_ENDPOINT,
-            subscription_id=SUBSCRIPTION_ID,
-            resource_group_name=RESOURCE_GROUP,
-            project_name=PROJECT_NAME,
-        )
-        # We pass agent_id per call; no upfront agent fetch.
+# -------------------- Foundry client: built on the first chat request, not at import --------------------
+# Endpoint-style configuration
+PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
+SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
+RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
+PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
+
+# Role-based agents (+ fallback)
+AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
+AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # useragent
+AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # adminagent
+
+_init_lock = threading.Lock()
+_init_done = False
 
-except Exception as e:
-    init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
-    client = None
+def _init_client():
+    """
+    Import the AI Projects SDK and build the client once, on first use (thread-safe), so cold
+    starts of routes that never talk to Foundry don't pay for it. Sets client / init_error.
+    A failure while building it (credential, network) is retried by the next request;
+    configuration errors stick.
+    """
+    global client, init_error, _init_done
+    if _init_done:
+        return
+    with _init_lock:
+        if _init_done:
+            return
+        started = time.perf_counter()
+        init_error, retry = None, False
+        try:
+            if not PROJECT_ENDPOINT:
+                init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
+            elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
+                init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
+            elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
+                init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
+            else:
+                from azure.identity import DefaultAzureCredential
+                from azure.ai.projects import AIProjectClient
+                credential = DefaultAzureCredential()
+                client = AIProjectClient(
+                    credential=credential,
+                    endpoint=PROJECT_ENDPOINT,
+                    subscription_id=SUBSCRIPTION_ID,
+                    resource_group_name=RESOURCE_GROUP,
+                    project_name=PROJECT_NAME,
+                )
+                # We pass agent_id per call; no upfront agent fetch.
+        except Exception as e:
+            init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
+            client = None
+            retry = True
+        _init_done = not retry
+        logging.info("Foundry client init took %.0f ms%s", (time.perf_counter() - started) * 1000,
+                     f" ({init_error})" if init_error else "")
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
@@ -147,7 +170,20 @@ def _add_user_message(thread_id: str, text: str):
         content=text
     )
 
-def _collect_last_assistant(thread_id: str, user_query: str | None):
+def _list_latest_messages(thread_id: str, run_id: str | None = None):
+    """
+    Newest-first messages, scoped to run_id when known (one message is enough then), so the
+    cost doesn't grow with the thread. Falls back to a plain list() on SDKs without these kwargs.
+    """
+    limit = 1 if run_id else 10
+    scope = {"run_id": run_id} if run_id else {}
+    try:
+        # materialized here: SDKs that don't know these kwargs fail on the first page fetch
+        return list(islice(client.agents.messages.list(thread_id=thread_id, order="desc", limit=limit, **scope), limit))
+    except TypeError:
+        return client.agents.messages.list(thread_id=thread_id)
+
+def _collect_last_assistant(thread_id: str, user_query: str | None, run_id: str | None = None):
     """
     Return a dict: { 'answer_md': str|None, 'answer': str|None, 'sources': list }
     Prefers structured JSON {answer_md, sources[]} if the agent returns it.
@@ -155,7 +191,7 @@ def _collect_last_assistant(thread_id: str, user_query: str | None):
     Falls back to plain text with auto-mined sources & cleaned citations.
     """
     # new SDK: iterate directly, not messages.data
-    messages = client.agents.messages.list(thread_id=thread_id)
+    messages = _list_latest_messages(thread_id, run_id)
 
     last_text = None
     ann_sources = []  # can include file refs and web URLs found in annotations
@@ -256,16 +292,17 @@ def _collect_last_assistant(thread_id: str, user_query: str | None):
 
 def _run_and_wait(thread_id: str, agent_id: str, user_query: str | None):
     # new SDK: runs live under client.agents.runs
-    client.agents.runs.create_and_process(
+    run = client.agents.runs.create_and_process(
         thread_id=thread_id,
         agent_id=agent_id
     )
-    return _collect_last_assistant(thread_id, user_query=user_query)
+    return _collect_last_assistant(thread_id, user_query=user_query, run_id=getattr(run, "id", None))
 
 # --------------------------------- HTTP Trigger ---------------------------------
 @app.route(route="chat", methods=[func.HttpMethod.POST])
 def chat(req: func.HttpRequest) -> func.HttpResponse:
     # Check init
+    _init_client()
     if init_error:
         return func.HttpResponse(
             json.dumps({"error": "Initialization failed", "detail": init_error}),
@@ -333,3 +370,5 @@ def chat(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
             mimetype="application/json"
         )
+
+logging.info("function_app imported in %.0f ms", (time.perf_counter() - _IMPORT_STARTED) * 1000)
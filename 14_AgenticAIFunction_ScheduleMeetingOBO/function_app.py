@@ -1,14 +1,16 @@
-import os, json, re
+import os, json, re, time, threading, socket, logging
+_IMPORT_STARTED = time.perf_counter()   # import-time instrumentation (logged at the end of the module)
+from itertools import islice
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.ai.projects import AIProjectClient
 from urllib.parse import quote_plus  # needed for Bing News fallback
 
 # >>> NEW (OBO / Graph)
 import requests
-from msal import ConfidentialClientApplication
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 
-# Initialize client and agent(s)
+# Foundry client and init error, set by _init_client() on the first chat request
 client = None
 init_error = None
 
@@ -86,39 +88,62 @@ def _extract_sources_from_text(md: str, user_query: str | None = None):
 
     return md_clean.strip(), sources
 
-# -------------------- New endpoint-style client init (minimal change) --------------------
-try:
-    # Endpoint-style configuration
-    PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
-    SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
-    RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
-    PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
-
-    # Role-based agents (+ fallback)
-    AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
-    AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # useragent
-    AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # adminagent
-
-    if not PROJECT_ENDPOINT:
-        init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
-    elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
-        init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
-    elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
-        init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
-    else:
-        credential = DefaultAzureCredential()
-        client = AIProjectClient(
-            credential=credential,
-            endpoint=PROJECT_ENDPOINT,
-            subscription_id=SUBSCRIPTION_ID,
-            resource_group_name=RESOURCE_GROUP,
-            project_name=PROJECT_NAME,
-        )
-        # We pass agent_id per call; no upfront agent fetch.
+# -------------------- Foundry client: built on the first chat request, not at import --------------------
+# Endpoint-style configuration
+PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
+SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
+RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
+PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
+
+# Role-based agents (+ fallback)
+AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
+AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # useragent
+AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # adminagent
 
-except Exception as e:
-    init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
-    client = None
+_init_lock = threading.Lock()
+_init_done = False
+
+def _init_client():
+    """
+    Import the AI Projects SDK and build the client once, on first use (thread-safe), so cold
+    starts of routes that never talk to Foundry don't pay for it. Sets client / init_error.
+    A failure while building it (credential, network) is retried by the next request;
+    configuration errors stick.
+    """
+    global client, init_error, _init_done
+    if _init_done:
+        return
+    with _init_lock:
+        if _init_done:
+            return
+        started = time.perf_counter()
+        init_error, retry = None, False
+        try:
+            if not PROJECT_ENDPOINT:
+                init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
+            elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
+                init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
+            elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
+                init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
+            else:
+                from azure.identity import DefaultAzureCredential
+                from azure.ai.projects import AIProjectClient
+                credential = DefaultAzureCredential()
+                client = AIProjectClient(
+                    credential=credential,
+                    endpoint=PROJECT_ENDPOINT,
+                    subscription_id=SUBSCRIPTION_ID,
+                    resource_group_name=RESOURCE_GROUP,
+                    project_name=PROJECT_NAME,
+                )
+                # We pass agent_id per call; no upfront agent fetch.
+        except Exception as e:
+            init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
+            client = None
+            retry = True
+        _init_done = not retry
+        logging.info("Foundry client init took %.0f ms%s", (time.perf_counter() - started) * 1000,
+                     f" ({init_error})" if init_error else "")
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
@@ -150,13 +175,26 @@ def _add_user_message(thread_id: str, text: str):
         content=text
     )
 
-def _collect_last_assistant(thread_id: str, user_query: str | None):
+def _list_latest_messages(thread_id: str, run_id: str | None = None):
+    """
+    Newest-first messages, scoped to run_id when known (one message is enough then), so the
+    cost doesn't grow with the thread. Falls back to a plain list() on SDKs without these kwargs.
+    """
+    limit = 1 if run_id else 10
+    scope = {"run_id": run_id} if run_id else {}
+    try:
+        # materialized here: SDKs that don't know these kwargs fail on the first page fetch
+        return list(islice(client.agents.messages.list(thread_id=thread_id, order="desc", limit=limit, **scope), limit))
+    except TypeError:
+        return client.agents.messages.list(thread_id=thread_id)
+
+def _collect_last_assistant(thread_id: str, user_query: str | None, run_id: str | None = None):
     """
     Return a dict: { 'answer_md': str|None, 'answer': str|None, 'sources': list }
     Prefers structured JSON {answer_md, sources[]} if the agent returns it.
     Also collects content.text.annotations (file citations / file paths / web URLs).
     """
-    messages = client.agents.messages.list(thread_id=thread_id)
+    messages = _list_latest_messages(thread_id, run_id)
 
     last_text = None
     ann_sources = []
@@ -248,16 +286,17 @@ def _collect_last_assistant(thread_id: str, user_query: str | None):
     return {"answer_md": clean_md, "answer": clean_md, "sources": all_sources}
 
 def _run_and_wait(thread_id: str, agent_id: str, user_query: str | None):
-    client.agents.runs.create_and_process(
+    run = client.agents.runs.create_and_process(
         thread_id=thread_id,
         agent_id=agent_id
     )
-    return _collect_last_assistant(thread_id, user_query=user_query)
+    return _collect_last_assistant(thread_id, user_query=user_query, run_id=getattr(run, "id", None))
 
 # --------------------------------- HTTP Trigger: Chat ---------------------------------
 @app.route(route="chat", methods=[func.HttpMethod.POST])
 def chat(req: func.HttpRequest) -> func.HttpResponse:
     # Check init
+    _init_client()
     if init_error:
         return func.HttpResponse(
             json.dumps({"error": "Initialization failed", "detail": init_error}),
@@ -334,15 +373,114 @@ BACKEND_SECRET   = os.environ.get("BACKEND_CLIENT_SECRET")  # client secret (or
 GRAPH_SCOPE      = ["https://graph.microsoft.com/.default"]
 GRAPH_ENDPOINT   = os.environ.get("GRAPH_ENDPOINT", "https://graph.microsoft.com/v1.0")
 
+_msal_lock = threading.Lock()
+_msal_cca = None
+
+def _msal_app():
+    """ConfidentialClientApplication built once on the first OBO call (its token cache then spans requests)."""
+    global _msal_cca
+    if _msal_cca is None:
+        with _msal_lock:
+            if _msal_cca is None:
+                from msal import ConfidentialClientApplication
+                _msal_cca = ConfidentialClientApplication(
+                    client_id=BACKEND_APP_ID,
+                    authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+                    client_credential=BACKEND_SECRET
+                )
+    return _msal_cca
+
+# -------------------- Pooled HTTP sessions: one keep-alive connection pool per upstream --------------------
+# Graph calls go through one requests.Session whose connections stay open between calls, so
+# requests skip the TCP+TLS handshake. TCP keep-alive probes stop idle pooled connections from
+# being dropped by the platform's SNAT / load balancer.
+HTTP_POOL_MAXSIZE     = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))        # open connections kept per host
+HTTP_RETRIES          = int(os.getenv("HTTP_RETRIES", "3"))              # transport-level retries; 0 = off
+HTTP_RETRY_BACKOFF    = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))    # seconds, doubled per retry
+HTTP_RETRY_AFTER_MAX  = float(os.getenv("HTTP_RETRY_AFTER_MAX", "10"))   # cap on a Retry-After wait
+HTTP_KEEPALIVE_SECS   = int(os.getenv("HTTP_KEEPALIVE_SECS", "60"))      # idle seconds before keep-alive probes; 0 = off
+
+# upstream -> (statuses retried, retry read errors). Connect errors are always retried (nothing was
+# sent). Graph sendMail / event creation aren't idempotent, so only a 429 is repeated there.
+_RETRY_RULES = {
+    "graph":  ((429,), False),                     # a throttled call wasn't run
+}
+
+class _Retry(Retry):
+    """
+    urllib3 Retry that repeats only the statuses in status_forcelist (urllib3 would also repeat any
+    413 / 503 carrying Retry-After) and caps Retry-After waits at HTTP_RETRY_AFTER_MAX.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        return status_code in (self.status_forcelist or ()) and super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        after = super().get_retry_after(response)
+        return None if after is None else min(after, HTTP_RETRY_AFTER_MAX)
+
+def _keepalive_options(idle: int) -> list:
+    opts = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", max(1, idle // 4)), ("TCP_KEEPCNT", 4)):
+        if hasattr(socket, name):   # not on every platform
+            opts.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return opts
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send TCP keep-alive probes; stats() counts connection reuse."""
+
+    def __init__(self, keepalive_secs: int = 0, **kwargs):
+        self._keepalive_secs = keepalive_secs   # before super().__init__, which builds the pool manager
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._keepalive_secs > 0:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + _keepalive_options(self._keepalive_secs)
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self) -> dict:
+        """Requests sent and connections opened by the live host pools."""
+        sent = opened = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return {"requests": sent, "connections": opened, "reused": max(0, sent - opened)}
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+
+def _http_session(name: str) -> requests.Session:
+    """Process-wide pooled requests.Session per upstream ("graph"), created on first use."""
+    s = _sessions.get(name)
+    if s is None:
+        with _sessions_lock:
+            s = _sessions.get(name)
+            if s is None:
+                s = requests.Session()
+                kwargs = {"keepalive_secs": HTTP_KEEPALIVE_SECS, "pool_maxsize": HTTP_POOL_MAXSIZE}
+                if name in _RETRY_RULES and HTTP_RETRIES > 0:
+                    statuses, read = _RETRY_RULES[name]
+                    kwargs["max_retries"] = _Retry(total=HTTP_RETRIES, read=HTTP_RETRIES if read else 0,
+                                                   backoff_factor=HTTP_RETRY_BACKOFF, status_forcelist=statuses,
+                                                   allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False)
+                adapter = _PooledAdapter(**kwargs)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _sessions[name] = s
+    return s
+
+def _http_stats(name: str) -> dict:
+    """Connection reuse of an upstream's session (zeros before its first call)."""
+    s = _sessions.get(name)
+    return s.get_adapter("https://").stats() if s is not None else {"requests": 0, "connections": 0, "reused": 0}
+
 def _obo_get_graph_token(user_assertion: str) -> str:
     if not (TENANT_ID and BACKEND_APP_ID and BACKEND_SECRET):
         raise RuntimeError("OBO not configured. Set TENANT_ID, BACKEND_CLIENT_ID, BACKEND_CLIENT_SECRET.")
-    cca = ConfidentialClientApplication(
-        client_id=BACKEND_APP_ID,
-        authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-        client_credential=BACKEND_SECRET
-    )
-    result = cca.acquire_token_on_behalf_of(user_assertion=user_assertion, scopes=GRAPH_SCOPE)
+    result = _msal_app().acquire_token_on_behalf_of(user_assertion=user_assertion, scopes=GRAPH_SCOPE)
     if "access_token" not in result:
         raise RuntimeError(f"OBO failed: {result.get('error')}: {result.get('error_description')}")
     return result["access_token"]
@@ -356,12 +494,13 @@ def _graph_send_mail_as_user(graph_token: str, subject: str, body_html: str, rec
         },
         "saveToSentItems": True
     }
-    r = requests.post(
+    r = _http_session("graph").post(
         f"{GRAPH_ENDPOINT}/me/sendMail",
         headers={"Authorization": f"Bearer {graph_token}", "Content-Type": "application/json"},
         json=payload,
         timeout=30
     )
+    logging.info("graph pool: %s", _http_stats("graph"))
     if r.status_code >= 300:
         raise RuntimeError(f"Graph sendMail failed {r.status_code}: {r.text}")
 
@@ -480,7 +619,7 @@ def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
     else:
         url = f"{GRAPH_ENDPOINT}/me/events"
 
-    r = requests.post(
+    r = _http_session("graph").post(
         url,
         headers={
             "Authorization": f"Bearer {graph_token}",
@@ -490,6 +629,7 @@ def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
         json=body,
         timeout=30
     )
+    logging.info("graph pool: %s", _http_stats("graph"))
     if r.status_code >= 300:
         raise RuntimeError(f"Graph create event failed {r.status_code}: {r.text}")
 
@@ -588,3 +728,5 @@ def schedule_as_user(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
             mimetype="application/json"
         )
+
+logging.info("function_app imported in %.0f ms", (time.perf_counter() - _IMPORT_STARTED) * 1000)
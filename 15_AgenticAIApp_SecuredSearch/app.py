@@ -5,6 +5,7 @@ import json
 import base64
 import requests
 import re  # for extracting JSON blocks
+import time
 
 # Load environment variables
 load_dotenv()
@@ -12,6 +13,7 @@ load_dotenv()
 # Import our modules
 from auth.msal_auth import auth
 from auth.rbac import rbac, UserRole
+import json_scan  # one-pass JSON object finder (same file in the function app)
 # from ai_agent.foundry_client import ai_agent
 
 
@@ -30,8 +32,6 @@ def peek_jwt(token: str):
 
 # Helpers to detect & prepare payloads --------------------------------
 
-JSON_FENCE_RE = re.compile(r"```(?:json)?\s*({.*?})\s*```", re.DOTALL | re.IGNORECASE)
-
 def _coerce_list_str_emails(v):
     """Accept list[str] or comma/semicolon-separated string → list[str]."""
     if v is None:
@@ -51,18 +51,8 @@ def try_extract_email_payload(text: str):
     if not text or not isinstance(text, str):
         return None
 
-    candidates = []
-    for m in JSON_FENCE_RE.finditer(text):
-        candidates.append(m.group(1))
-
-    if not candidates:
-        m = re.search(r"(\{[^{}]*?(\"subject\"|\'subject\')[^{}]*?(\"bodyHtml\"|\'bodyHtml\')[\s\S]*?\})", text)
-        if m:
-            candidates.append(m.group(1))
-
-    for raw in candidates:
+    for obj in json_scan.json_objects(text):   # ```json fences first
         try:
-            obj = json.loads(raw)
             subj = obj.get("subject")
             body = obj.get("bodyHtml")
             recp = obj.get("recipients")
@@ -90,19 +80,8 @@ def try_extract_meeting_payload(text: str):
         return None
 
     keys_required = {"subject", "timeZone", "start", "end"}
-    candidates = []
-    for m in JSON_FENCE_RE.finditer(text):
-        candidates.append(m.group(1))
-    if not candidates:
-        # Heuristic: must contain subject + start + end
-        m = re.search(r"(\{[^{}]*?(\"subject\"|\'subject\')[\s\S]*?(\"start\"|\'start\')[\s\S]*?(\"end\"|\'end\')[\s\S]*?\})", text)
-        if m:
-            candidates.append(m.group(1))
-
-    for raw in candidates:
+    for obj in json_scan.json_objects(text):   # ```json fences first
         try:
-            obj = json.loads(raw)
-
             # Allow timeZone to be absent in source and default later
             has_min_required = {"subject", "start", "end"}.issubset(set(obj.keys()))
             if not (has_min_required or keys_required.issubset(set(obj.keys()))):
@@ -157,6 +136,7 @@ REVENUE_Q_RE   = re.compile(r"\b(total\s+revenue|revenue|sales\s+revenue)\b", re
 REVENUE_OF_FOR_RE = re.compile(r"\b(?:total\s+revenue|revenue|sales\s+revenue)\s+(?:of|for)\s+\"?([A-Za-z0-9\-\s\+\./%]+?)\"?\s*(\?|$)", re.I)
 QUOTED_RE         = re.compile(r"\"([^\"]+)\"")
 _REGION_RE        = re.compile(r"\bregion\s*([0-9]+)\b|\b(region[0-9]+)\b", re.I)
+TOP_K_RE          = re.compile(r"\b(?:top|best)\s+(\d{1,3})\s+(products?|regions?)\b(?:.*?\bby\s+(units?(?:\s+sold)?|revenue|sales|rows|count))?", re.I)
 
 def is_popularity_intent(text: str | None) -> bool:
     return bool(text and POPULARITY_RE.search(text or ""))
@@ -164,6 +144,16 @@ def is_popularity_intent(text: str | None) -> bool:
 def is_revenue_intent(text: str | None) -> bool:
     return bool(text and REVENUE_Q_RE.search(text or ""))
 
+def build_top_k_query(text: str | None) -> dict | None:
+    """'top 5 products by units in region2' → a secured-search "query" payload (None if no match)."""
+    m = TOP_K_RE.search(text or "")
+    if not m:
+        return None
+    group = "Region" if m.group(2).lower().startswith("region") else "Product"
+    by = (m.group(3) or "units").lower()
+    metric = "TotalRevenue:sum" if by in ("revenue", "sales") else "count" if by in ("rows", "count") else "UnitSold:sum"
+    return {"operation": "query", "group_by": [group], "metrics": [metric], "top": int(m.group(1))}
+
 def extract_requested_region(text: str | None) -> str | None:
     if not text:
         return None
@@ -211,6 +201,79 @@ def post_secured_search(access_token: str, payload: dict) -> tuple[int, dict | s
         return 500, f"Request error: {e}"
 
 
+CHAT_TIMEOUT = float(os.getenv("CHAT_TIMEOUT", "60"))               # seconds to wait for POST /chat
+
+def with_deadline(headers: dict, seconds: float) -> dict:
+    """Tell the backend how long we wait, so it cancels the agent run instead of finishing it for nobody."""
+    return {**headers, "x-request-timeout": str(max(1, int(seconds) - 2))}
+
+
+CHAT_STREAM = os.getenv("CHAT_STREAM", "false").lower() == "true"   # use POST /chat/stream (NDJSON)
+
+def stream_chat(endpoint: str, headers: dict, payload: dict, on_text) -> tuple[int, dict | str]:
+    """
+    POST to the NDJSON /chat/stream endpoint, calling on_text(text_so_far) for every delta.
+    Returns (status_code, final frame) shaped like a /chat response.
+    """
+    with requests.post(endpoint, json=payload, headers=headers, stream=True, timeout=(10, 300)) as resp:
+        if resp.status_code != 200:
+            try:
+                return resp.status_code, resp.json()
+            except Exception:
+                return resp.status_code, resp.text
+        text, final = "", None
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            frame = json.loads(line)
+            kind = frame.get("type")
+            if kind == "delta":
+                text += frame.get("text", "")
+                on_text(text)
+            elif kind == "final":
+                final = frame
+            elif kind == "error":
+                return 500, frame
+        return 200, final or {"answer": text, "answer_md": text, "sources": []}
+
+
+CHAT_ASYNC = os.getenv("CHAT_ASYNC", "false").lower() == "true"     # POST /chat {"async": true}, then poll the run
+CHAT_ASYNC_MAX_WAIT = float(os.getenv("CHAT_ASYNC_MAX_WAIT", "600"))  # seconds
+
+def run_chat_async(base: str, headers: dict, payload: dict) -> tuple[int, dict | str]:
+    """
+    Start the run in async mode and poll /chat/runs/{run_id} until it settles, so long runs
+    are not cut off by a single request timeout. Returns (status_code, /chat-shaped payload).
+    """
+    base = base.rstrip("/")
+    resp = requests.post(f"{base}/chat", json={**payload, "async": True},
+                         headers=with_deadline(headers, CHAT_ASYNC_MAX_WAIT), timeout=60)
+    try:
+        data = resp.json()
+    except Exception:
+        return resp.status_code, resp.text
+    if resp.status_code != 202:
+        return resp.status_code, data          # older backend answered synchronously, or an error
+    status_url = f"{base}/{data['status_url']}"
+    deadline = time.monotonic() + CHAT_ASYNC_MAX_WAIT
+    wait = float(resp.headers.get("Retry-After", 2))
+    while time.monotonic() < deadline:
+        time.sleep(wait)
+        r = requests.get(status_url, headers=headers, timeout=30)
+        try:
+            data = r.json()
+        except Exception:
+            return r.status_code, r.text
+        if r.status_code != 200:
+            return r.status_code, data
+        if data.get("status") == "completed":
+            return 200, data
+        if data.get("error"):
+            return 500, data
+        wait = float(r.headers.get("Retry-After", wait))
+    return 504, {"error": "Timed out waiting for the agent run", "run_id": data.get("run_id"), "thread_id": data.get("thread_id")}
+
+
 def post_send_as_user(access_token: str, payload: dict) -> tuple[int, dict | str]:
     """
     Call the backend /send-as-user (OBO to Graph).
@@ -591,7 +654,15 @@ class AzureAIFoundryApp:
                         call_secured = False
                         sec_payload = None
 
-                        if is_popularity_intent(user_message):
+                        top_k = build_top_k_query(user_message)
+                        if top_k:
+                            call_secured = True
+                            sec_payload = top_k
+                            req_reg = extract_requested_region(user_message)
+                            if req_reg:
+                                sec_payload["requested_region"] = req_reg
+
+                        elif is_popularity_intent(user_message):
                             call_secured = True
                             sec_payload = {"operation": "popular_product"}
                             req_reg = extract_requested_region(user_message)
@@ -603,32 +674,16 @@ class AzureAIFoundryApp:
                             prod = extract_product_from_revenue_q(user_message)
                             req_reg = extract_requested_region(user_message)
 
-                            # If user asks "revenue of most popular product"
+                            # "revenue of most popular product" → one batch request (one aggregation server-side)
                             if (not prod) and POPULARITY_RE.search(user_message or ""):
-                                # step 1: ask secured-search for top product (respect region ask)
-                                step1_payload = {"operation": "popular_product"}
-                                if req_reg:
-                                    step1_payload["requested_region"] = req_reg
-                                s1, d1 = post_secured_search(tok, step1_payload)
-                                st.session_state["last_api_debug"] = {
-                                    "endpoint": f"{apim_base.rstrip('/')}/secured-search",
-                                    "request": step1_payload,
-                                    "status_code": s1,
-                                    "response": d1
-                                }
-                                if s1 == 200 and isinstance(d1, dict) and d1.get("data") and d1["data"].get("Product"):
-                                    prod = d1["data"]["Product"]
-                                else:
-                                    # likely denial or no data → show and stop
-                                    step1_msg = (d1.get("answer_md") or d1.get("answer")) if isinstance(d1, dict) else str(d1)
-                                    if step1_msg:
-                                        st.markdown(step1_msg)
-                                        st.session_state["chat_history"].append({"role": "assistant", "content": step1_msg})
-                                        st.rerun()
-
-                            sec_payload = {"operation": "product_revenue"}
-                            if prod:
-                                sec_payload["product"] = prod
+                                sec_payload = {"operations": [
+                                    {"id": "top", "operation": "popular_product"},
+                                    {"id": "revenue", "operation": "product_revenue", "product_from": "top"},
+                                ]}
+                            else:
+                                sec_payload = {"operation": "product_revenue"}
+                                if prod:
+                                    sec_payload["product"] = prod
                             if req_reg:
                                 sec_payload["requested_region"] = req_reg
 
@@ -671,18 +726,31 @@ class AzureAIFoundryApp:
                             "request": payload
                         }
 
-                        resp = requests.post(apim_endpoint, json=payload, headers=headers, timeout=60)
-
-                        try:
-                            resp_json = resp.json()
-                        except Exception:
-                            resp_json = resp.text
+                        status_code = None
+                        if CHAT_STREAM:
+                            # render deltas as they arrive; the final frame replaces them with the cleaned answer
+                            live = st.empty()
+                            status_code, resp_json = stream_chat(f"{apim_endpoint}/stream", headers, payload,
+                                                                 on_text=lambda t: live.markdown(t + " ▌"))
+                            live.empty()
+                            if status_code == 404:   # /chat/stream not published in APIM
+                                status_code = None
+                        if status_code is None and CHAT_ASYNC:
+                            status_code, resp_json = run_chat_async(apim_base, headers, payload)
+                        if status_code is None:
+                            resp = requests.post(apim_endpoint, json=payload, headers=with_deadline(headers, CHAT_TIMEOUT),
+                                                 timeout=CHAT_TIMEOUT)
+                            status_code = resp.status_code
+                            try:
+                                resp_json = resp.json()
+                            except Exception:
+                                resp_json = resp.text
                         st.session_state["last_api_debug"].update({
-                            "status_code": resp.status_code,
+                            "status_code": status_code,
                             "response": resp_json
                         })
 
-                        if resp.status_code == 200:
+                        if status_code == 200:
                             data = resp_json if isinstance(resp_json, dict) else {}
                             ai_md = data.get("answer_md")
                             ai_text = data.get("answer", "No response from AI")
@@ -741,8 +809,18 @@ class AzureAIFoundryApp:
                                 elif draft_email:
                                     st.session_state["pending_email"] = draft_email
 
+                        elif status_code == 504 and isinstance(resp_json, dict) and resp_json.get("answer_md"):
+                            # deadline hit: the backend cancelled the run and returned what it had written so far
+                            ai_response = f"{resp_json['answer_md']}\n\n_(answer cut short: the request timed out)_"
+                            st.markdown(ai_response)
+                            st.session_state["chat_history"].append({"role": "assistant", "content": ai_response})
+                        elif status_code == 429:   # the previous message on this thread is still being answered
+                            wait = resp_json.get("retry_after") if isinstance(resp_json, dict) else None
+                            ai_response = f"Still answering your previous message. Please resend in {wait or 'a few'} seconds."
+                            st.info(ai_response)
+                            st.session_state["chat_history"].append({"role": "assistant", "content": ai_response})
                         else:
-                            ai_response = f"Error {resp.status_code}: {resp.text}"
+                            ai_response = f"Error {status_code}: {resp_json}"
                             st.write(ai_response)
                             st.session_state["chat_history"].append({"role": "assistant", "content": ai_response})
                         
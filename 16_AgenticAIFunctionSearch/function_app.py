@@ -1,127 +1,179 @@
-import os, json, re
+import os, json, re, time, threading, socket, atexit, logging, asyncio, tempfile
+_IMPORT_STARTED = time.perf_counter()   # import-time instrumentation (logged at the end of the module)
+from collections import OrderedDict, deque
+from dataclasses import replace
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.ai.projects import AIProjectClient
 from urllib.parse import quote_plus  # needed for Bing News fallback
 
 # >>> NEW (OBO / Graph)
 import requests
-from msal import ConfidentialClientApplication
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 
-# Initialize client and agent(s)
+import sales_agg  # secured-search aggregations (one pass, RLS guard memoized per region)
+import json_scan  # one-pass JSON object finder (same file in the Streamlit app)
+import citations  # typed answer sources, one-pass citation marker / URL scan
+import payloads   # response models + JSON serializer (orjson when installed)
+
+# Foundry client (azure.ai.projects.aio) and init error, set by _init_client() on the first chat request
 client = None
 init_error = None
 
-# --- Citations / link helpers (unchanged from your working version) ---
-_URL_RE = re.compile(r'https?://[^\s\]\)]+', re.IGNORECASE)
-_CITATION_MARKER_RE = re.compile(r'【[^】]+】')
-_BING_MARKER_RE = re.compile(r'【\d+:\d+†source】')
-
-def _dedup_sources(items):
-    """De-duplicate sources by URL (or file_id fallback) while preserving order."""
-    seen = set()
-    out = []
-    for s in items:
-        url = (s or {}).get("url", "") or ""
-        key = url or f"file:{(s or {}).get('file_id','')}"
-        if key and key not in seen:
-            seen.add(key)
-            out.append(s)
-    return out
-
+# --- Citations / link helpers (typed Source records, see citations.py) ---
 def _extract_json_block(text: str):
     """
     Try to extract a JSON object from the assistant text.
-    Supports ```json ... ``` fences or a bare {...} object.
+    Supports ```json ... ``` fences (preferred) or a bare {...} object.
     Returns (obj | None).
     """
     if not text:
         return None
-    # fenced ```json ... ```
-    m = re.search(r"```json\s*(\{.*?\})\s*```", text, re.DOTALL | re.IGNORECASE)
-    if m:
-        try:
-            return json.loads(m.group(1))
-        except Exception:
-            pass
-    # first top-level JSON object (best effort)
-    m2 = re.search(r"(\{.*\})", text, re.DOTALL)
-    if m2:
-        candidate = m2.group(1)
-        try:
-            return json.loads(candidate)
-        except Exception:
-            pass
-    return None
+    objects = json_scan.json_objects(text)
+    return objects[0] if objects else None
+
+_NEWS_KEYWORDS = ("news", "latest", "today", "breaking", "update")
 
-def _extract_sources_from_text(md: str, user_query: str | None = None):
+def _is_time_sensitive(text: str | None) -> bool:
+    """News-style query (answers go stale quickly)."""
+    q = (text or "").lower()
+    return any(k in q for k in _NEWS_KEYWORDS)
+
+def _extract_sources_from_text(md: str, user_query: str | None = None, sources: citations.Sources | None = None):
     """
-    Clean bracketed citation markers and collect URLs as sources.
+    Clean bracketed citation markers and collect URLs as sources, in one pass over md.
     If there are no URLs and this looks like a news query, add a Bing News search link.
-    Returns (clean_markdown, sources_list).
+    URL sources are added to `sources` (a new collection if None) after what it already holds.
+    Returns (clean_markdown, sources).
     """
+    if sources is None:
+        sources = citations.Sources()
     if not md:
-        return md, []
-
-    # detect Bing-style markers before stripping
-    has_bing_markers = bool(_BING_MARKER_RE.search(md))
+        return md, sources
 
-    # strip markers in displayed text
-    md_clean = _CITATION_MARKER_RE.sub('', md)
-
-    # collect inline URLs
-    urls = list(dict.fromkeys(_URL_RE.findall(md_clean)))  # de-dup preserve order
-    sources = [{"title": "Source", "url": u, "publisher": "", "date": ""} for u in urls]
+    md_clean, urls, has_bing_markers = citations.strip_citations(md)
+    for u in urls:
+        sources.add(citations.Source("Source", u))
 
     # synthesize Bing link for newsy queries if nothing else found
-    if not sources and user_query:
-        q = user_query.lower()
-        if has_bing_markers or any(k in q for k in ["news", "latest", "today", "breaking", "update"]):
-            sources.append({
-                "title": "Bing News results",
-                "url": f"https://www.bing.com/news/search?q={quote_plus(user_query)}",
-                "publisher": "Bing",
-                "date": ""
-            })
+    if not urls and user_query and (has_bing_markers or _is_time_sensitive(user_query)):
+        sources.add(citations.bing_news_source(user_query))
 
     return md_clean.strip(), sources
 
-# -------------------- New endpoint-style client init (minimal change) --------------------
-try:
-    # Endpoint-style configuration
-    PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
-    SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
-    RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
-    PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
-
-    # Role-based agents (+ fallback)
-    AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
-    AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # useragent
-    AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # adminagent
-
-    if not PROJECT_ENDPOINT:
-        init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
-    elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
-        init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
-    elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
-        init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
-    else:
-        credential = DefaultAzureCredential()
-        client = AIProjectClient(
-            credential=credential,
-            endpoint=PROJECT_ENDPOINT,
-            subscription_id=SUBSCRIPTION_ID,
-            resource_group_name=RESOURCE_GROUP,
-            project_name=PROJECT_NAME,
-        )
-        # We pass agent_id per call; no upfront agent fetch.
-
-except Exception as e:
-    init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
-    client = None
+class _TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_background = set()
+
+def _spawn(coro) -> asyncio.Task:
+    """Run coro as a task on the worker's event loop, referenced until it finishes."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+# -------------------- Foundry client: built on the first chat request, not at import --------------------
+# Endpoint-style configuration
+PROJECT_ENDPOINT = os.environ.get("AI_FOUNDRY_PROJECT_ENDPOINT")
+SUBSCRIPTION_ID = os.environ.get("AZURE_SUBSCRIPTION_ID")
+RESOURCE_GROUP  = os.environ.get("AZURE_RESOURCE_GROUP")
+PROJECT_NAME    = os.environ.get("AI_FOUNDRY_PROJECT_NAME")
+
+# Role-based agents (+ fallback)
+AGENT_ID_DEFAULT = os.environ.get("AGENT_ID")        # optional fallback
+AGENT_ID_USER    = os.environ.get("AGENT_ID_USER")   # useragent
+AGENT_ID_ADMIN   = os.environ.get("AGENT_ID_ADMIN")  # adminagent
+
+_init_lock = threading.Lock()
+_init_done = False
+
+def _project_client_kwargs() -> dict:
+    return {"endpoint": PROJECT_ENDPOINT, "subscription_id": SUBSCRIPTION_ID,
+            "resource_group_name": RESOURCE_GROUP, "project_name": PROJECT_NAME}
+
+def _init_client():
+    """
+    Import the async AI Projects SDK and build the client once, on first use (thread-safe), so
+    cold starts of routes that never talk to Foundry don't pay for it. Sets client / init_error.
+    Called from the routes, on the event loop (the thread pool is filled by a task on it).
+    A failure while building it (credential, network) is retried by the next request;
+    configuration errors stick.
+    """
+    global client, init_error, _init_done
+    if _init_done:
+        return
+    with _init_lock:
+        if _init_done:
+            return
+        started = time.perf_counter()
+        init_error, retry = None, False
+        try:
+            if not PROJECT_ENDPOINT:
+                init_error = "AI_FOUNDRY_PROJECT_ENDPOINT environment variable not set"
+            elif not (SUBSCRIPTION_ID and RESOURCE_GROUP and PROJECT_NAME):
+                init_error = "AZURE_SUBSCRIPTION_ID, AZURE_RESOURCE_GROUP, and AI_FOUNDRY_PROJECT_NAME must be set"
+            elif not (AGENT_ID_USER or AGENT_ID_ADMIN or AGENT_ID_DEFAULT):
+                init_error = "No agent id configured. Set AGENT_ID_USER / AGENT_ID_ADMIN (or AGENT_ID as fallback)."
+            else:
+                from azure.identity.aio import DefaultAzureCredential
+                from azure.ai.projects.aio import AIProjectClient
+                client = AIProjectClient(credential=DefaultAzureCredential(), **_project_client_kwargs())
+                # We pass agent_id per call; no upfront agent fetch.
+        except Exception as e:
+            init_error = f"Failed to initialize Azure AI Foundry client: {str(e)}"
+            client = None
+            retry = True
+        if client is not None and CHAT_THREAD_POOL_SIZE > 0:
+            _thread_pool.fill()
+            atexit.register(_thread_pool.drain)
+        _init_done = not retry
+        logging.info("Foundry client init took %.0f ms%s", (time.perf_counter() - started) * 1000,
+                     f" ({init_error})" if init_error else "")
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
+# -------------------- Request concurrency --------------------
+# The chat, Graph and search routes are `async def`: they await the aio Foundry / identity clients and
+# aiohttp, so one worker interleaves its requests on the event loop instead of parking a thread on each
+# agent run, Graph call or search page (tools/load_chat.py --simulate compares the two). Blocking work
+# that is left (MSAL's OBO call, cited-page fetches) goes through asyncio.to_thread.
+
+def _json_response(payload, status_code: int = 200, headers: dict | None = None) -> func.HttpResponse:
+    """JSON response for a dict or response model (payloads.dumps: empty model fields left out)."""
+    return func.HttpResponse(payloads.dumps(payload), status_code=status_code, headers=headers, mimetype="application/json")
+
 def pick_agent_id(role_header: str | None) -> str:
     """
     Choose the agent id based on APIM-stamped role header.
@@ -137,194 +189,946 @@ def pick_agent_id(role_header: str | None) -> str:
     raise RuntimeError("No agent id available for this request")
 
 # -------------------- Threads/Messages/Runs using new sub-clients (minimal change) --------------------
-def _ensure_thread(thread_id: str | None) -> str:
-    if thread_id:
-        return thread_id
-    t = client.agents.threads.create()
+CHAT_THREAD_POOL_SIZE = int(os.getenv("CHAT_THREAD_POOL_SIZE", "0"))       # pre-created empty threads; 0 disables
+CHAT_THREAD_POOL_TTL  = float(os.getenv("CHAT_THREAD_POOL_TTL", "3600"))   # seconds an unused pooled thread is kept
+
+async def _create_thread() -> str:
+    t = await client.agents.threads.create()
     return getattr(t, "id", t.get("id") if isinstance(t, dict) else t)
 
-def _add_user_message(thread_id: str, text: str):
-    client.agents.messages.create(
+class _ThreadPool:
+    """
+    Empty agent threads created ahead of time, so a conversation's first message skips the
+    threads.create round trip. take() hands one out and kicks a background refill (a task on the
+    event loop); threads older than ttl are deleted instead of handed out, and whatever is left
+    is deleted at shutdown.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._items = deque()        # (created_at, thread_id), oldest first
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "expired": 0}
+
+    def take(self) -> str | None:
+        """A pooled thread id, or None (miss) when the pool is empty or disabled."""
+        if self.size <= 0:
+            return None
+        expired, thread_id = [], None
+        with self._lock:
+            cutoff = time.monotonic() - self.ttl
+            while self._items and self._items[0][0] < cutoff:
+                expired.append(self._items.popleft()[1])
+            if self._items:
+                thread_id = self._items.popleft()[1]
+            self.stats["hits" if thread_id else "misses"] += 1
+            self.stats["expired"] += len(expired)
+            stats = dict(self.stats, pooled=len(self._items))
+        logging.info("thread pool %s: %s", "hit" if thread_id else "miss", stats)
+        self.fill(expired)
+        return thread_id
+
+    def fill(self, discard: list | None = None):
+        """Top the pool up (and delete discarded threads) in a background task."""
+        with self._lock:
+            if self._refilling or (len(self._items) >= self.size and not discard):
+                return
+            self._refilling = True
+        _spawn(self._refill(discard or []))
+
+    async def _refill(self, discard: list):
+        try:
+            for thread_id in discard:
+                await _delete_thread(thread_id)
+            while len(self._items) < self.size:
+                thread_id = await _create_thread()
+                with self._lock:
+                    self._items.append((time.monotonic(), thread_id))
+                    self.stats["created"] += 1
+        except Exception as e:
+            logging.warning("thread pool refill failed: %s", e)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def drain(self):
+        """Delete every pooled thread (registered with atexit; the event loop is gone by then, so with the sync SDK)."""
+        with self._lock:
+            items, self._items = list(self._items), deque()
+        if not items:
+            return
+        try:
+            from azure.identity import DefaultAzureCredential
+            from azure.ai.projects import AIProjectClient
+            agents = AIProjectClient(credential=DefaultAzureCredential(), **_project_client_kwargs()).agents
+        except Exception as e:
+            logging.warning("could not delete %d pooled threads: %s", len(items), e)
+            return
+        for _, thread_id in items:
+            try:
+                agents.threads.delete(thread_id)
+            except Exception as e:
+                logging.warning("could not delete pooled thread %s: %s", thread_id, e)
+
+async def _delete_thread(thread_id: str):
+    try:
+        await client.agents.threads.delete(thread_id)
+    except Exception as e:
+        logging.warning("could not delete pooled thread %s: %s", thread_id, e)
+
+_thread_pool = _ThreadPool(CHAT_THREAD_POOL_SIZE, CHAT_THREAD_POOL_TTL)   # filled by _init_client()
+
+async def _ensure_thread(thread_id: str | None) -> str:
+    if thread_id:
+        return _compactions.resolve(thread_id)   # continue on its compacted copy once that is ready
+    return _thread_pool.take() or await _create_thread()
+
+async def _add_user_message(thread_id: str, text: str):
+    _compactions.touch(thread_id)
+    await client.agents.messages.create(
         thread_id=thread_id,
         role="user",
         content=text
     )
 
-def _collect_last_assistant(thread_id: str, user_query: str | None):
+async def _first(pager, n: int | None = None) -> list:
+    """The first n items (all if n is None) of an async pager such as messages.list()."""
+    out = []
+    async for item in pager:
+        out.append(item)
+        if n is not None and len(out) >= n:
+            break
+    return out
+
+async def _list_latest_messages(thread_id: str, run_id: str | None = None, seen: dict | None = None):
+    """
+    Newest-first messages, scoped to run_id when known (one message is enough then), so the
+    cost doesn't grow with the thread. Falls back to a plain list() on SDKs without these kwargs.
+
+    If a seen dict is passed and compaction counts messages, the newest CHAT_COMPACT_MESSAGES are
+    listed unscoped instead (still one page), seen["messages"] gets their number and the run's
+    messages are picked out of them.
+    """
+    window = min(CHAT_COMPACT_MESSAGES, 100) if seen is not None and CHAT_COMPACTION == "summarize" else 0
+    if window and run_id:
+        try:
+            page = await _first(client.agents.messages.list(thread_id=thread_id, order="desc", limit=window), window)
+        except TypeError:
+            page = []
+        seen["messages"] = len(page)
+        mine = [m for m in page if getattr(m, "run_id", None) == run_id]
+        if mine:
+            return mine
+    limit = 1 if run_id else 10
+    scope = {"run_id": run_id} if run_id else {}
+    try:
+        # SDKs that don't know these kwargs fail on the call or on the first page fetch
+        return await _first(client.agents.messages.list(thread_id=thread_id, order="desc", limit=limit, **scope), limit)
+    except TypeError:
+        return await _first(client.agents.messages.list(thread_id=thread_id))
+
+async def _collect_last_assistant(thread_id: str, user_query: str | None, run_id: str | None = None,
+                                  seen: dict | None = None):
+    """
+    Return a payloads.Answer with answer, answer_md and sources (see _answer_from), the
+    sources enriched with page metadata when SOURCE_ENRICH is on.
+    seen is passed on to _list_latest_messages.
+    """
+    answer = _answer_from(await _list_latest_messages(thread_id, run_id, seen), user_query)
+    if answer.sources:
+        await _enrich_sources(answer.sources)
+    return answer
+
+def _answer_from(messages, user_query: str | None):
     """
-    Return a dict: { 'answer_md': str|None, 'answer': str|None, 'sources': list }
+    payloads.Answer from the newest assistant message with text in messages.
     Prefers structured JSON {answer_md, sources[]} if the agent returns it.
     Also collects content.text.annotations (file citations / file paths / web URLs).
     """
-    messages = client.agents.messages.list(thread_id=thread_id)
-
     last_text = None
-    ann_sources = []
-
+    ann_sources = citations.Sources()
     for msg in messages:
         if getattr(msg, "role", None) == "assistant":
-            chunks = []
-            content_list = getattr(msg, "content", []) or []
-            for c in content_list:
-                if hasattr(c, "text"):
-                    tv = getattr(c.text, "value", None)
-                    chunks.append(tv if tv else str(c.text))
-
-                    anns = getattr(c.text, "annotations", None)
-                    if anns:
-                        for an in anns:
-                            if hasattr(an, "file_citation") and an.file_citation:
-                                fc = an.file_citation
-                                ann_sources.append({
-                                    "title": "Document citation",
-                                    "url": "",
-                                    "publisher": "",
-                                    "date": "",
-                                    "file_id": getattr(fc, "file_id", "unknown"),
-                                    "quote": getattr(fc, "quote", "")
-                                })
-                            elif hasattr(an, "file_path") and an.file_path:
-                                fp = an.file_path
-                                ann_sources.append({
-                                    "title": "File attachment",
-                                    "url": "",
-                                    "publisher": "",
-                                    "date": "",
-                                    "file_id": getattr(fp, "file_id", "unknown")
-                                })
-                            else:
-                                url = getattr(an, "url", None)
-                                if url:
-                                    ann_sources.append({
-                                        "title": "Source",
-                                        "url": url,
-                                        "publisher": "",
-                                        "date": ""
-                                    })
-                                else:
-                                    try:
-                                        s = str(an)
-                                    except Exception:
-                                        s = ""
-                                    m = re.search(r'https?://[^\s\'">,]+', s)
-                                    if m:
-                                        ann_sources.append({
-                                            "title": "Source",
-                                            "url": m.group(0),
-                                            "publisher": "",
-                                            "date": ""
-                                        })
-
-                elif isinstance(getattr(msg, "content", None), str):
-                    chunks.append(msg.content)
-
-            if chunks:
-                last_text = "\n\n".join(chunks)
+            last_text = citations.message_text(msg, ann_sources)
             if last_text:
                 break
 
     if not last_text:
-        return {"answer_md": None, "answer": "(no assistant message)", "sources": []}
+        return payloads.Answer(answer="(no assistant message)")
 
     obj = _extract_json_block(last_text)
     if isinstance(obj, dict) and ("answer_md" in obj or "answer" in obj):
-        sources = obj.get("sources", [])
-        if not isinstance(sources, list):
-            sources = []
+        given = obj.get("sources", [])
+        if not isinstance(given, list):
+            given = []
         answer_md = obj.get("answer_md") or obj.get("answer") or ""
-        if not sources:
-            answer_md, mined = _extract_sources_from_text(answer_md, user_query=user_query)
-            sources = _dedup_sources((ann_sources or []) + mined)
+        if not given:
+            answer_md, sources = _extract_sources_from_text(answer_md, user_query, ann_sources)
         else:
-            sources = _dedup_sources(sources + (ann_sources or []))
-        return {
-            "answer_md": answer_md,
-            "answer": obj.get("answer") or answer_md,
-            "sources": sources
-        }
-
-    clean_md, mined_sources = _extract_sources_from_text(last_text, user_query=user_query)
-    all_sources = _dedup_sources((ann_sources or []) + mined_sources)
-    return {"answer_md": clean_md, "answer": clean_md, "sources": all_sources}
-
-def _run_and_wait(thread_id: str, agent_id: str, user_query: str | None):
-    client.agents.runs.create_and_process(
-        thread_id=thread_id,
-        agent_id=agent_id
-    )
-    return _collect_last_assistant(thread_id, user_query=user_query)
+            sources = citations.Sources()
+            for s in given:
+                sources.add(citations.Source.from_value(s))
+            sources.extend(ann_sources)
+        return payloads.Answer(
+            answer=obj.get("answer") or answer_md,
+            answer_md=answer_md,
+            sources=list(sources)
+        )
+
+    clean_md, sources = _extract_sources_from_text(last_text, user_query, ann_sources)
+    return payloads.Answer(answer=clean_md, answer_md=clean_md, sources=list(sources))
+
+# --- Source enrichment (opt-in): title / publisher / date of cited URLs, cached in SQLite ---
+SOURCE_ENRICH               = os.getenv("SOURCE_ENRICH", "off").lower() in ("1", "true", "on", "yes")
+SOURCE_ENRICH_BUDGET_MS     = float(os.getenv("SOURCE_ENRICH_BUDGET_MS", "800"))     # longest an answer waits for metadata
+SOURCE_ENRICH_PER_HOST      = int(os.getenv("SOURCE_ENRICH_PER_HOST", "2"))          # concurrent fetches per host
+SOURCE_ENRICH_MAX_URLS      = int(os.getenv("SOURCE_ENRICH_MAX_URLS", "8"))          # fetched per answer (cached ones don't count); 0 = all
+SOURCE_ENRICH_WORKERS       = int(os.getenv("SOURCE_ENRICH_WORKERS", "16"))
+SOURCE_ENRICH_ALLOW_PRIVATE = os.getenv("SOURCE_ENRICH_ALLOW_PRIVATE", "off").lower() in ("1", "true", "on", "yes")
+SOURCE_CACHE_PATH           = os.getenv("SOURCE_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "source_meta.sqlite3")
+SOURCE_CACHE_TTL            = float(os.getenv("SOURCE_CACHE_TTL", "86400"))          # seconds a page's metadata is reused
+SOURCE_CACHE_FAIL_TTL       = float(os.getenv("SOURCE_CACHE_FAIL_TTL", "3600"))      # ...and a failed fetch is not retried
+
+_enricher_lock = threading.Lock()
+_enricher = None
+
+def _source_enricher():
+    """source_meta.Enricher singleton, built on first use (imports the module lazily)."""
+    global _enricher
+    if _enricher is None:
+        with _enricher_lock:
+            if _enricher is None:
+                import source_meta
+                try:
+                    cache = source_meta.MetaCache(SOURCE_CACHE_PATH)
+                except Exception as e:
+                    logging.warning("source cache %s unavailable, enriching without it: %s", SOURCE_CACHE_PATH, e)
+                    cache = None
+                _enricher = source_meta.Enricher(
+                    lambda: _http_session("sources"), cache,
+                    per_host=SOURCE_ENRICH_PER_HOST, workers=SOURCE_ENRICH_WORKERS,
+                    ttl=SOURCE_CACHE_TTL, fail_ttl=SOURCE_CACHE_FAIL_TTL,
+                    allow_private=SOURCE_ENRICH_ALLOW_PRIVATE,
+                )
+    return _enricher
+
+async def _enrich_sources(sources: list):
+    """
+    Fill placeholder titles / publishers / dates from the cited pages, in place, within
+    SOURCE_ENRICH_BUDGET_MS (Enricher blocks while it waits, so off the event loop).
+    """
+    if SOURCE_ENRICH and sources:
+        try:
+            await asyncio.to_thread(_source_enricher().enrich, sources, SOURCE_ENRICH_BUDGET_MS / 1000,
+                                    limit=SOURCE_ENRICH_MAX_URLS)
+        except Exception as e:
+            logging.warning("source enrichment failed: %s", e)
+
+# --- Thread compaction for long conversations ---
+CHAT_COMPACTION       = os.getenv("CHAT_COMPACTION", "off").lower()         # off | truncate | summarize
+CHAT_COMPACT_TOKENS   = int(os.getenv("CHAT_COMPACT_TOKENS", "12000"))    # summarize once a run's prompt reaches this (0 = ignore)
+CHAT_COMPACT_MESSAGES = int(os.getenv("CHAT_COMPACT_MESSAGES", "40"))     # ...or the thread holds this many messages (0 = ignore, max 100)
+CHAT_KEEP_LAST        = int(os.getenv("CHAT_KEEP_LAST", "6"))             # messages kept verbatim / seen by a truncated run
+_SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below for your own future reference: the user's goals, facts and "
+    "figures already given, decisions, open questions. Be concise; plain text, no preamble."
+)
+
+def _run_options() -> dict:
+    """Extra kwargs for every run: in truncate mode the service only feeds the last CHAT_KEEP_LAST messages."""
+    if CHAT_COMPACTION == "truncate":
+        from azure.ai.agents.models import TruncationObject
+        return {"truncation_strategy": TruncationObject(type="last_messages", last_messages=CHAT_KEEP_LAST)}
+    return {}
+
+def _needs_compaction(run, seen: dict) -> bool:
+    """Thresholds checked on what the finished run already returned: its usage and the messages listed with it."""
+    if CHAT_COMPACTION != "summarize":
+        return False
+    usage = getattr(run, "usage", None)
+    if CHAT_COMPACT_TOKENS and (getattr(usage, "prompt_tokens", None) or 0) >= CHAT_COMPACT_TOKENS:
+        return True
+    return bool(CHAT_COMPACT_MESSAGES) and seen.get("messages", 0) >= CHAT_COMPACT_MESSAGES
+
+async def _compact_thread(thread_id: str, agent_id: str) -> str:
+    """
+    Summarize all but the last CHAT_KEEP_LAST messages with the agent (on a scratch thread, tools
+    off) and return a new thread seeded with that summary plus the recent messages verbatim.
+    """
+    msgs = await _first(client.agents.messages.list(thread_id=thread_id, order="asc"))
+    older, recent = msgs[:-CHAT_KEEP_LAST or None], msgs[-CHAT_KEEP_LAST:] if CHAT_KEEP_LAST else []
+    transcript = "\n\n".join(f"{getattr(m, 'role', '')}: {(citations.message_text(m) or '')[:2000]}" for m in older)
+
+    scratch = await _create_thread()
+    try:
+        await _add_user_message(scratch, transcript)
+        run = await client.agents.runs.create_and_process(
+            thread_id=scratch,
+            agent_id=agent_id,
+            instructions=_SUMMARY_INSTRUCTIONS,
+            tool_choice="none"
+        )
+        summary = "".join(citations.message_text(m) or "" for m in await _list_latest_messages(scratch, getattr(run, "id", None))
+                          if getattr(m, "role", None) == "assistant")
+    finally:
+        await _delete_thread(scratch)
+    if not summary:
+        raise RuntimeError("empty summary")
+
+    new_thread = await _create_thread()
+    await client.agents.messages.create(thread_id=new_thread, role="assistant",
+                                        content=f"Summary of our earlier conversation:\n\n{summary}")
+    for m in recent:
+        text = citations.message_text(m)
+        if text:
+            await client.agents.messages.create(thread_id=new_thread, role=getattr(m, "role", "user"), content=text)
+    return new_thread
+
+_COMPACTING, _STALE = object(), object()
+
+class _Compactions:
+    """
+    Summarize-mode compaction, off the request path. A run that passes the thresholds schedules
+    a compacted copy of its thread in the background; the next message for the thread is posted
+    to the copy instead (resolve). A message posted to the original meanwhile (touch) makes the
+    copy stale: it is deleted and a later turn schedules again. State is per worker; an instance
+    that never saw the copy keeps using the original thread. Compactions are tasks on the event
+    loop, at most `workers` at a time.
+    """
+
+    def __init__(self, workers: int, moved_ttl: float):
+        self._lock = threading.Lock()
+        self._state = {}                           # thread_id -> _COMPACTING | _STALE | copy's thread_id
+        self._moved = _TTLCache(moved_ttl, 4096)   # thread_id -> copy, for messages still sent to the original
+        self._slots = asyncio.Semaphore(max(1, workers))
+
+    def schedule(self, thread_id: str, agent_id: str):
+        with self._lock:
+            if thread_id in self._state:
+                return
+            self._state[thread_id] = _COMPACTING
+        _spawn(self._compact(thread_id, agent_id))
+
+    def resolve(self, thread_id: str) -> str:
+        """thread_id to post the next message to: the compacted copy once it is ready."""
+        with self._lock:
+            moved = self._moved.get(thread_id)
+            if moved:
+                return moved
+            copy = self._state.get(thread_id)
+            if not isinstance(copy, str):
+                return thread_id
+            del self._state[thread_id]
+            self._moved.put(thread_id, copy)
+            return copy
+
+    def touch(self, thread_id: str):
+        """A message goes to thread_id itself: a copy taken before it would lose that message."""
+        with self._lock:
+            copy = self._state.get(thread_id)
+            if copy is None:
+                return
+            if copy is _COMPACTING:
+                self._state[thread_id] = _STALE
+                return
+            if copy is not _STALE:
+                del self._state[thread_id]
+        if isinstance(copy, str):
+            _spawn(_delete_thread(copy))
+
+    async def _compact(self, thread_id: str, agent_id: str):
+        copy = None
+        try:
+            async with self._slots:
+                copy = await _compact_thread(thread_id, agent_id)
+            logging.info("compacted thread %s into %s", thread_id, copy)
+        except Exception as e:
+            logging.warning("thread compaction failed for %s: %s", thread_id, e)
+        with self._lock:
+            if copy is not None and self._state.get(thread_id) is _COMPACTING:
+                self._state[thread_id] = copy
+                return
+            self._state.pop(thread_id, None)
+        if copy is not None:
+            await _delete_thread(copy)
+
+_COMPACT_WORKERS = 2          # background compactions per worker
+_COMPACT_MOVED_SECS = 3600    # how long messages still sent to a compacted thread follow it to the copy
+
+_compactions = _Compactions(_COMPACT_WORKERS, _COMPACT_MOVED_SECS)
+
+def _maybe_compact(thread_id: str, agent_id: str, run, seen: dict):
+    """Schedule a compacted copy of thread_id once the finished run passes the thresholds."""
+    if _needs_compaction(run, seen):
+        _compactions.schedule(thread_id, agent_id)
+
+# --- Deadlines: callers say how long they will wait; a run still going by then is cancelled ---
+CHAT_DEADLINE_HEADER  = "x-request-timeout"                                # seconds the caller will wait (or body "timeout")
+CHAT_RUN_TIMEOUT_SECS = float(os.getenv("CHAT_RUN_TIMEOUT_SECS", "0"))     # budget when the caller sends none (0 = no deadline)
+CHAT_RUN_POLL_SECS    = float(os.getenv("CHAT_RUN_POLL_SECS", "1"))        # status poll interval of runs with a deadline
+
+class _RunTimeout(Exception):
+    """The deadline passed before the run finished; the run (if started) was cancelled."""
+    def __init__(self, thread_id: str, run_id: str | None, detail: str | None = None):
+        super().__init__(detail or (f"Run {run_id} cancelled: deadline exceeded" if run_id else "Deadline exceeded before the run started"))
+        self.thread_id = thread_id
+        self.run_id = run_id
+
+def _request_deadline(headers, body) -> float | None:
+    """time.monotonic() deadline from the x-request-timeout header or the body's "timeout" (seconds)."""
+    raw = headers.get(CHAT_DEADLINE_HEADER) or (body or {}).get("timeout")
+    try:
+        secs = float(raw) if raw not in (None, "") else CHAT_RUN_TIMEOUT_SECS
+    except (TypeError, ValueError):
+        secs = CHAT_RUN_TIMEOUT_SECS
+    return time.monotonic() + secs if secs > 0 else None
+
+class _RunNeedsAction(Exception):
+    """The run asked for an action this app can't take (tool outputs it has no tools for); it was cancelled."""
+    def __init__(self, thread_id: str, run_id: str, detail: str):
+        super().__init__(f"Run {run_id} cancelled: {detail}")
+        self.thread_id = thread_id
+        self.run_id = run_id
+
+async def _cancel_run(thread_id: str, run_id: str, reason: str = "deadline exceeded"):
+    try:
+        await client.agents.runs.cancel(thread_id=thread_id, run_id=run_id)
+        logging.info("cancelled run %s on %s: %s", run_id, thread_id, reason)
+    except Exception as e:   # it may have finished meanwhile
+        logging.warning("could not cancel run %s: %s", run_id, e)
+
+def _unmet_action(run) -> str | None:
+    """
+    Why a requires_action run can't go on, as create_and_process decides: no tool calls, an
+    action other than submit_tool_outputs, or "function" calls (no local toolset is registered
+    here). None when the service runs the calls itself (e.g. azure_function) and polling goes on.
+    """
+    action = getattr(run, "required_action", None)
+    kind = getattr(action, "type", None)
+    if kind != "submit_tool_outputs":
+        return f"unsupported required action {kind!r}"
+    calls = getattr(getattr(action, "submit_tool_outputs", None), "tool_calls", None)
+    if not calls:
+        return "the run required action without tool calls"
+    local = [getattr(getattr(call, "function", None), "name", None) or "?" for call in calls
+             if getattr(call, "type", None) == "function"]
+    if local:
+        return f"the run needs outputs of local function tools ({', '.join(local)})"
+    return None
+
+async def _run_until(thread_id: str, agent_id: str, deadline: float):
+    """create_and_process with a deadline: poll the run and cancel it once the time is up."""
+    run = await client.agents.runs.create(thread_id=thread_id, agent_id=agent_id, **_run_options())
+    while _run_status(run) in ("queued", "in_progress", "requires_action"):
+        if _run_status(run) == "requires_action":
+            unmet = _unmet_action(run)
+            if unmet:
+                await _cancel_run(thread_id, run.id, unmet)
+                raise _RunNeedsAction(thread_id, run.id, unmet)
+        left = deadline - time.monotonic()
+        if left <= 0:
+            await _cancel_run(thread_id, run.id)
+            raise _RunTimeout(thread_id, run.id)
+        await asyncio.sleep(min(CHAT_RUN_POLL_SECS, left))
+        run = await client.agents.runs.get(thread_id=thread_id, run_id=run.id)
+    return run
+
+async def _run_and_wait(thread_id: str, agent_id: str, user_query: str | None, deadline: float | None = None):
+    if deadline is not None:
+        run = await _run_until(thread_id, agent_id, deadline)
+    else:
+        run = await client.agents.runs.create_and_process(
+            thread_id=thread_id,
+            agent_id=agent_id,
+            **_run_options()
+        )
+    seen = {}
+    result = await _collect_last_assistant(thread_id, user_query=user_query, run_id=getattr(run, "id", None), seen=seen)
+    _maybe_compact(thread_id, agent_id, run, seen)
+    return result
+
+# --- Answer cache for repeated first-turn prompts (opt-in) ---
+CHAT_ANSWER_CACHE_TTL  = float(os.getenv("CHAT_ANSWER_CACHE_TTL", "0"))      # seconds; 0 disables
+CHAT_ANSWER_CACHE_SIZE = int(os.getenv("CHAT_ANSWER_CACHE_SIZE", "512"))
+
+def _agent_ttls(raw: str | None) -> dict:
+    """CHAT_ANSWER_CACHE_TTLS as {agent_id: seconds}; a malformed value is logged and ignored."""
+    try:
+        ttls = json.loads(raw or "{}")
+        if not isinstance(ttls, dict):
+            raise ValueError("expected a JSON object of agent id -> seconds")
+    except ValueError as e:
+        logging.warning("CHAT_ANSWER_CACHE_TTLS ignored, using CHAT_ANSWER_CACHE_TTL for every agent: %s", e)
+        return {}
+    out = {}
+    for agent_id, ttl in ttls.items():
+        try:
+            out[agent_id] = float(ttl)
+        except (TypeError, ValueError):
+            logging.warning("CHAT_ANSWER_CACHE_TTLS: ignoring %s=%r (not a number of seconds)", agent_id, ttl)
+    return out
+
+CHAT_ANSWER_CACHE_TTLS = _agent_ttls(os.getenv("CHAT_ANSWER_CACHE_TTLS"))   # per agent, e.g. {"asst_admin": 60}
+
+_answer_cache = _TTLCache(CHAT_ANSWER_CACHE_TTL, CHAT_ANSWER_CACHE_SIZE)
+
+def _answer_cache_key(agent_id: str, thread_id: str | None, text: str):
+    """
+    (agent_id, normalized prompt) for first-turn prompts, None when the answer must not be
+    cached: ongoing thread, cache off for this agent, or a time-sensitive (news) query.
+    """
+    if thread_id or _answer_ttl(agent_id) <= 0 or _is_time_sensitive(text):
+        return None
+    prompt = re.sub(r"\s+", " ", text.lower()).strip().rstrip("?!. ")
+    return (agent_id, prompt) if prompt else None
+
+def _answer_ttl(agent_id: str) -> float:
+    return CHAT_ANSWER_CACHE_TTLS.get(agent_id, CHAT_ANSWER_CACHE_TTL)
+
+def _cache_answer(key, result: payloads.Answer):
+    if key and result.answer_md:
+        _answer_cache.put(key, result, ttl=_answer_ttl(key[0]))
+
+# --- Per-thread admission: one run per thread, messages sent meanwhile ride on the next run ---
+CHAT_THREAD_QUEUE     = int(os.getenv("CHAT_THREAD_QUEUE", "4"))          # messages that may wait on a busy thread (0 = busy at once)
+CHAT_THREAD_WAIT_SECS = float(os.getenv("CHAT_THREAD_WAIT_SECS", "30"))    # a waiting message not posted by then is withdrawn (busy)
+CHAT_BUSY_RETRY_SECS  = int(os.getenv("CHAT_BUSY_RETRY_SECS", "5"))        # Retry-After of busy answers
+
+class _ThreadBusy(Exception):
+    """The thread has an active run and this message can't wait for the next one."""
+
+def _is_active_run_error(e: Exception) -> bool:
+    """The service refusing a message or run because the thread already has an active run."""
+    msg = str(e).lower()
+    return "while a run" in msg or "already has an active run" in msg
+
+async def _post_and_run(thread_id: str, agent_id: str, texts: list[str], deadline: float | None = None):
+    """Post the user message(s), then answer them with one run."""
+    if deadline is not None and time.monotonic() >= deadline:
+        raise _RunTimeout(thread_id, None)   # nobody is waiting any more: don't post
+    for text in texts:
+        await _add_user_message(thread_id, text)
+    return await _run_and_wait(thread_id, agent_id=agent_id, user_query="\n".join(texts), deadline=deadline)
+
+class _Batch:
+    __slots__ = ("agent_id", "texts", "deadline", "started", "done", "result", "error")
+
+    def __init__(self, agent_id: str):
+        self.agent_id = agent_id
+        self.texts = []
+        self.deadline = None   # earliest deadline of the callers in the batch
+        self.started = False
+        self.done = asyncio.Event()
+        self.result = None
+        self.error = None
+
+async def _wait(event: asyncio.Event, timeout: float) -> bool:
+    """event.wait() bounded by timeout seconds; False if it timed out."""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+class _ThreadGate:
+    """
+    One run per agent thread in this worker. Messages arriving while their thread runs join its
+    next batch (up to max_queued, same agent); when the run ends the batch is posted and answered
+    by a single run (bounded by the batch's earliest deadline), whose result every caller in the
+    batch gets. A full batch, another agent, or a batch that hasn't started within wait_secs
+    raises _ThreadBusy; a caller whose own deadline passes while the batch runs gets _RunTimeout.
+
+    State lives on the worker's event loop (no awaits between a check and its update, so no
+    lock); batches run as tasks on it.
+    """
+    def __init__(self, max_queued: int, wait_secs: float):
+        self.max_queued = max_queued
+        self.wait_secs = wait_secs
+        self._running = {}   # thread_id -> its next _Batch, or None while nothing waits
+
+    def busy(self, thread_id: str) -> bool:
+        return thread_id in self._running
+
+    async def run(self, thread_id: str, agent_id: str, text: str, deadline: float | None = None) -> tuple[dict, bool]:
+        """(result, coalesced): the run that answered text, and whether it answered other messages too."""
+        batch = None
+        if thread_id not in self._running:
+            self._running[thread_id] = None
+        else:
+            batch = self._running[thread_id]
+            if batch is None:
+                batch = self._running[thread_id] = _Batch(agent_id)
+            if batch.agent_id != agent_id or len(batch.texts) >= self.max_queued:
+                raise _ThreadBusy(f"A run is active on {thread_id} and no more messages can wait for it")
+            batch.texts.append(text)
+            if deadline is not None and (batch.deadline is None or deadline < batch.deadline):
+                batch.deadline = deadline
+        if batch is None:
+            result = None
+            try:
+                result = await _post_and_run(thread_id, agent_id, [text], deadline)
+                return result, False
+            finally:
+                self._release(thread_id, result)
+        if not await _wait(batch.done, self.wait_secs):
+            if not batch.started:
+                batch.texts.remove(text)
+                raise _ThreadBusy(f"A run is still active on {thread_id}")
+            limit = deadline if deadline is not None else time.monotonic() + _HTTP_RESPONSE_LIMIT_SECS
+            if not await _wait(batch.done, max(0.0, limit - time.monotonic()) + _BATCH_GRACE_SECS):
+                raise _RunTimeout(thread_id, None, "Deadline exceeded while waiting for the thread's batched run")
+        if batch.error is not None:
+            raise batch.error
+        return batch.result, len(batch.texts) > 1
+
+    def _release(self, thread_id: str, result: dict | None):
+        batch = self._running.pop(thread_id, None)
+        if batch is None or not batch.texts:
+            return
+        self._running[thread_id] = None
+        _spawn(self._run_batch(thread_id, batch))
+
+    async def _run_batch(self, thread_id: str, batch: _Batch):
+        if not batch.texts:   # every caller gave up before it started
+            self._release(thread_id, None)   # admits a batch that formed meanwhile
+            batch.done.set()
+            return
+        batch.started = True   # from here on callers wait for the result
+        result = None
+        try:
+            result = batch.result = await _post_and_run(thread_id, batch.agent_id, batch.texts, batch.deadline)
+        except Exception as e:
+            batch.error = e
+        finally:
+            self._release(thread_id, result)   # before waking the callers, so their next message is admitted
+            batch.done.set()
+
+_HTTP_RESPONSE_LIMIT_SECS = 230   # the Azure front end drops HTTP responses that take longer
+_BATCH_GRACE_SECS = 5             # lets a run cut off at the deadline report its partial answer first
+
+_thread_gate = _ThreadGate(CHAT_THREAD_QUEUE, CHAT_THREAD_WAIT_SECS)
+
+async def _timeout_response(e: _RunTimeout, user_query: str | None) -> func.HttpResponse:
+    """504 with whatever the cancelled run had already written (no answer fields if nothing)."""
+    payload = payloads.Answer(error="Timed out", detail=str(e), thread_id=e.thread_id, run_id=e.run_id)
+    if e.run_id:
+        try:
+            partial = await _collect_last_assistant(e.thread_id, user_query=user_query, run_id=e.run_id)
+            payload = replace(partial, error=payload.error, detail=payload.detail, thread_id=e.thread_id, run_id=e.run_id)
+        except Exception as ex:
+            logging.warning("could not read the partial answer of run %s: %s", e.run_id, ex)
+    return _json_response(payload, status_code=504)
+
+def _needs_action_response(e: _RunNeedsAction) -> func.HttpResponse:
+    """502: the agent stopped on an action this app can't take, and its run was cancelled."""
+    payload = payloads.Answer(error="Run cancelled", detail=str(e), thread_id=e.thread_id, run_id=e.run_id, status="cancelled")
+    return _json_response(payload, status_code=502)
+
+def _busy_payload(detail: str) -> dict:
+    return {"error": "Thread busy", "detail": detail, "retry_after": CHAT_BUSY_RETRY_SECS}
+
+def _busy_headers(status: int) -> dict | None:
+    """Retry-After for busy (429) answers."""
+    return {"Retry-After": str(CHAT_BUSY_RETRY_SECS)} if status == 429 else None
+
+def _busy_response(detail: str) -> func.HttpResponse:
+    return _json_response(_busy_payload(detail), status_code=429, headers=_busy_headers(429))
 
 # --------------------------------- HTTP Trigger: Chat ---------------------------------
 @app.route(route="chat", methods=[func.HttpMethod.POST])
-def chat(req: func.HttpRequest) -> func.HttpResponse:
+async def chat(req: func.HttpRequest) -> func.HttpResponse:
     # Check init
+    _init_client()
     if init_error:
-        return func.HttpResponse(
-            json.dumps({"error": "Initialization failed", "detail": init_error}),
-            status_code=503,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "Initialization failed", "detail": init_error},
+            status_code=503
         )
 
     if not client:
-        return func.HttpResponse(
-            json.dumps({"error": "AI service unavailable", "detail": "Azure AI Foundry client not initialized"}),
-            status_code=503,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "AI service unavailable", "detail": "Azure AI Foundry client not initialized"},
+            status_code=503
         )
 
     try:
         body = req.get_json()
         if not body:
-            return func.HttpResponse(
-                json.dumps({"error": "No JSON body provided"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "No JSON body provided"},
+                status_code=400
             )
 
         text = body.get("input")
         if not text:
-            return func.HttpResponse(
-                json.dumps({"error": "Missing input"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "Missing input"},
+                status_code=400
             )
         
         thread_id = body.get("thread_id")
+        deadline = _request_deadline(req.headers, body)
 
         # Read role from APIM header and pick the proper agent
         role_header = req.headers.get("x-user-role")
         agent_id = pick_agent_id(role_header)
         
+        # Repeated first-turn prompt: serve the earlier answer without a run (no thread is created)
+        cache_key = None if body.get("async") is True else _answer_cache_key(agent_id, thread_id, text)
+        cached = _answer_cache.get(cache_key) if cache_key else None
+        if cached:
+            payload = replace(cached, thread_id=None, agent_id=agent_id, cached=True)
+            return _json_response(payload)
+
         # Process the request
-        thread_id = _ensure_thread(thread_id)
-        _add_user_message(thread_id, text)
-        result = _run_and_wait(thread_id, agent_id=agent_id, user_query=text)
-
-        payload = {
-            "answer": result.get("answer"),
-            "answer_md": result.get("answer_md"),
-            "sources": result.get("sources", []),
-            "thread_id": thread_id,
-            "agent_id": agent_id
-        }
-        return func.HttpResponse(
-            json.dumps(payload),
-            status_code=200,
-            mimetype="application/json"
-        )
+        requested, thread_id = thread_id, await _ensure_thread(thread_id)
+        moved = {"compacted_from": requested} if requested and requested != thread_id else {}
+
+        # Async mode: start the run and hand back ids; poll GET /chat/runs/{run_id}?thread_id=...
+        if body.get("async") is True:
+            if _thread_gate.busy(thread_id):
+                return _busy_response(f"A run is active on {thread_id}")
+            await _add_user_message(thread_id, text)
+            metadata = {"user_query": text[:512]}   # lets the status endpoint rebuild sources statelessly
+            if deadline is not None:                 # wall clock: any instance may serve the polls
+                metadata["deadline_at"] = str(round(time.time() + deadline - time.monotonic(), 1))
+            run = await client.agents.runs.create(
+                thread_id=thread_id,
+                agent_id=agent_id,
+                metadata=metadata,
+                **_run_options()
+            )
+            status_url = f"chat/runs/{run.id}?thread_id={quote_plus(thread_id)}"
+            return _json_response(
+                {"run_id": run.id, "thread_id": thread_id, "agent_id": agent_id,
+                 "status": _run_status(run), "status_url": status_url, **moved},
+                status_code=202,
+                headers={"Location": status_url, "Retry-After": str(CHAT_POLL_AFTER_SECS)}
+            )
+
+        # One run per thread: a message sent while it runs is answered by the next run (coalesced)
+        result, coalesced = await _thread_gate.run(thread_id, agent_id, text, deadline)
+        _cache_answer(cache_key, result)
+
+        payload = replace(result, thread_id=thread_id, agent_id=agent_id, **moved)   # result may be shared / cached
+        if coalesced:
+            payload.coalesced = True
+        return _json_response(payload)
         
+    except _ThreadBusy as e:
+        return _busy_response(str(e))
+    except _RunTimeout as e:
+        return await _timeout_response(e, text)
+    except _RunNeedsAction as e:
+        return _needs_action_response(e)
     except ValueError:
-        return func.HttpResponse(
-            json.dumps({"error": "Invalid JSON"}),
-            status_code=400,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "Invalid JSON"},
+            status_code=400
         )
     except Exception as e:
-        return func.HttpResponse(
-            json.dumps({"error": "Agent error", "detail": str(e)}),
-            status_code=500,
-            mimetype="application/json"
+        if _is_active_run_error(e):   # a run started elsewhere (another instance, async mode)
+            return _busy_response(str(e))
+        return _json_response(
+            {"error": "Agent error", "detail": str(e)},
+            status_code=500
+        )
+
+# --------------------------------- HTTP Trigger: Chat run status (async mode) ---------------------------------
+CHAT_POLL_AFTER_SECS = int(os.getenv("CHAT_POLL_AFTER_SECS", "2"))   # Retry-After hint for pending runs
+_RUN_DONE   = ("completed",)
+_RUN_FAILED = ("failed", "cancelled", "expired")
+
+def _run_status(run) -> str:
+    status = getattr(run, "status", None)
+    return str(getattr(status, "value", status) or "unknown").lower()
+
+@app.route(route="chat/runs/{run_id}", methods=[func.HttpMethod.GET])
+async def chat_run_status(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Status of a run started with {"async": true}. Pending runs return 200 with "status" and a
+    Retry-After header; completed runs return the /chat payload; failed runs carry "error".
+    """
+    _init_client()
+    if init_error or not client:
+        return _json_response(
+            {"error": "AI service unavailable", "detail": init_error or "Azure AI Foundry client not initialized"},
+            status_code=503
         )
+    run_id = req.route_params.get("run_id")
+    thread_id = req.params.get("thread_id")
+    if not run_id or not thread_id:
+        return _json_response({"error": "run_id and thread_id are required"}, status_code=400)
+
+    try:
+        run = await client.agents.runs.get(thread_id=thread_id, run_id=run_id)
+        status = _run_status(run)
+        payload = payloads.Answer(run_id=run_id, thread_id=thread_id, status=status)
+        if status in _RUN_DONE:
+            user_query = (getattr(run, "metadata", None) or {}).get("user_query")
+            result = await _collect_last_assistant(thread_id, user_query=user_query, run_id=run_id)
+            payload = replace(result, run_id=run_id, thread_id=thread_id, status=status, agent_id=getattr(run, "agent_id", None))
+            return _json_response(payload)
+        deadline_at = (getattr(run, "metadata", None) or {}).get("deadline_at")
+        if status not in _RUN_FAILED and deadline_at and time.time() > float(deadline_at):
+            await _cancel_run(thread_id, run_id)
+            payload.status, payload.error, payload.timed_out = "cancelled", "Deadline exceeded; the run was cancelled", True
+            return _json_response(payload)
+        if status in _RUN_FAILED:
+            err = getattr(run, "last_error", None)
+            payload.error = getattr(err, "message", None) or (str(err) if err else status)
+            return _json_response(payload)
+        return _json_response(payload, headers={"Retry-After": str(CHAT_POLL_AFTER_SECS)})
+    except Exception as e:
+        return _json_response({"error": "Agent error", "detail": str(e)}, status_code=500)
+
+# --------------------------------- HTTP Trigger: Chat (streaming) ---------------------------------
+# POST /chat/stream answers with NDJSON frames, one JSON object per line:
+#   {"type": "delta", "text": "..."}                    as the agent generates text (raw, markers included)
+#   {"type": "final", "answer", "answer_md", "sources", "thread_id", "agent_id"}   same payload as /chat
+#   {"type": "error", "detail": "..."}                   ("timed_out": true when the deadline cancelled the run)
+# With azurefunctions-extensions-http-fastapi (in requirements.txt) and PYTHON_ENABLE_INIT_INDEXING=1 the
+# frames are sent as they are produced; without either the same frames come back in one buffered body.
+_StreamRequest = None
+if os.getenv("PYTHON_ENABLE_INIT_INDEXING", "").lower() in ("1", "true"):   # the worker only loads the extension then
+    try:
+        from azurefunctions.extensions.http.fastapi import Request as _StreamRequest, StreamingResponse, JSONResponse
+    except ImportError:  # optional dependency
+        _StreamRequest = None
+
+async def _ndjson(frames):
+    async for frame in frames:
+        yield payloads.dumps(frame) + b"\n"
+
+async def _frames(*frames):
+    for frame in frames:
+        yield frame
+
+def _until(deadline: float | None):
+    """asyncio.timeout scope ending at the time.monotonic() deadline (none if None)."""
+    return asyncio.timeout(None if deadline is None else deadline - time.monotonic())
+
+async def _stream_run(thread_id: str, agent_id: str, user_query: str | None, cache_key=None, deadline: float | None = None,
+                      compacted_from: str | None = None):
+    """
+    Run the agent with the streaming API: yield delta frames, then the final (or error) frame.
+    Past the deadline the run is cancelled and an error frame with "timed_out" ends the stream.
+    compacted_from is the thread the caller named when the message went to its compacted copy.
+    """
+    from azure.ai.agents.models import AgentStreamEvent, MessageDeltaChunk, ThreadRun
+
+    run = None
+    try:
+        async with _until(deadline):
+            stream = await client.agents.runs.stream(thread_id=thread_id, agent_id=agent_id, **_run_options())
+        async with stream:
+            events = aiter(stream)
+            while True:
+                # bounded per wait rather than around the loop: a timeout scope can't span the yields
+                async with _until(deadline):
+                    event = await anext(events, None)
+                if event is None:
+                    break
+                event_type, data, _ = event
+                if isinstance(data, MessageDeltaChunk):
+                    if data.text:
+                        yield {"type": "delta", "text": data.text}
+                elif isinstance(data, ThreadRun):
+                    run = data
+                    status = _run_status(data)
+                    if status == "requires_action":
+                        unmet = _unmet_action(data)
+                        if unmet:
+                            await _cancel_run(thread_id, data.id, unmet)
+                            yield {"type": "error", "detail": str(_RunNeedsAction(thread_id, data.id, unmet))}
+                            return
+                    if status not in _RUN_FAILED:
+                        continue
+                    err = getattr(data, "last_error", None)
+                    yield {"type": "error", "detail": f"Run {status}: {getattr(err, 'message', None) or err or ''}".strip()}
+                    return
+                elif event_type == AgentStreamEvent.ERROR:
+                    yield {"type": "error", "detail": str(data)}
+                    return
+    except TimeoutError:
+        if run is not None:
+            await _cancel_run(thread_id, run.id)
+        yield {"type": "error", "detail": str(_RunTimeout(thread_id, getattr(run, "id", None))), "timed_out": True}
+        return
+    except Exception as e:
+        yield {"type": "error", "detail": str(e)}
+        return
+    try:
+        seen = {}
+        result = await _collect_last_assistant(thread_id, user_query=user_query, run_id=getattr(run, "id", None), seen=seen)
+    except Exception as e:
+        yield {"type": "error", "detail": str(e)}
+        return
+    _cache_answer(cache_key, result)
+    _maybe_compact(thread_id, agent_id, run, seen)
+    final = replace(result, type="final", thread_id=thread_id, agent_id=agent_id)
+    if compacted_from:
+        final.compacted_from = compacted_from
+    yield final
+
+async def _start_stream(body, role_header: str | None, deadline: float | None = None):
+    """
+    Validate and post the user message. Returns (status, error dict) or (200, async frame generator).
+    A thread with an active run answers 429 like /chat; the stream itself doesn't wait for it.
+    """
+    _init_client()
+    if init_error:
+        return 503, {"error": "Initialization failed", "detail": init_error}
+    if not client:
+        return 503, {"error": "AI service unavailable", "detail": "Azure AI Foundry client not initialized"}
+    if not body:
+        return 400, {"error": "No JSON body provided"}
+    text = body.get("input")
+    if not text:
+        return 400, {"error": "Missing input"}
+    try:
+        agent_id = pick_agent_id(role_header)
+        cache_key = _answer_cache_key(agent_id, body.get("thread_id"), text)
+        cached = _answer_cache.get(cache_key) if cache_key else None
+        if cached:
+            return 200, _frames(replace(cached, type="final", thread_id=None, agent_id=agent_id, cached=True))
+        requested = body.get("thread_id")
+        thread_id = await _ensure_thread(requested)
+        if _thread_gate.busy(thread_id):
+            return 429, _busy_payload(f"A run is active on {thread_id}")
+        await _add_user_message(thread_id, text)
+    except Exception as e:
+        if _is_active_run_error(e):   # a run started elsewhere (another instance, async mode)
+            return 429, _busy_payload(str(e))
+        return 500, {"error": "Agent error", "detail": str(e)}
+    moved_from = requested if requested and requested != thread_id else None
+    return 200, _stream_run(thread_id, agent_id, text, cache_key, deadline, compacted_from=moved_from)
+
+if _StreamRequest is not None:
+    @app.route(route="chat/stream", methods=[func.HttpMethod.POST])
+    async def chat_stream(req: _StreamRequest):
+        try:
+            body = await req.json()
+        except ValueError:
+            return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+        status, out = await _start_stream(body, req.headers.get("x-user-role"), _request_deadline(req.headers, body))
+        if status != 200:
+            return JSONResponse(out, status_code=status, headers=_busy_headers(status))
+        return StreamingResponse(_ndjson(out), media_type="application/x-ndjson")
+else:
+    @app.route(route="chat/stream", methods=[func.HttpMethod.POST])
+    async def chat_stream(req: func.HttpRequest) -> func.HttpResponse:
+        try:
+            body = req.get_json()
+        except ValueError:
+            return _json_response({"error": "Invalid JSON"}, status_code=400)
+        status, out = await _start_stream(body, req.headers.get("x-user-role"), _request_deadline(req.headers, body))
+        if status != 200:
+            return _json_response(out, status_code=status, headers=_busy_headers(status))
+        return func.HttpResponse(b"".join([chunk async for chunk in _ndjson(out)]), status_code=200,
+                                 mimetype="application/x-ndjson")
 
 # --------------------------------- HTTP Trigger: Send as user (OBO → Graph) ---------------------------------
 # >>> NEW (OBO / Graph)
@@ -334,20 +1138,192 @@ BACKEND_SECRET   = os.environ.get("BACKEND_CLIENT_SECRET")  # client secret (or
 GRAPH_SCOPE      = ["https://graph.microsoft.com/.default"]
 GRAPH_ENDPOINT   = os.environ.get("GRAPH_ENDPOINT", "https://graph.microsoft.com/v1.0")
 
-def _obo_get_graph_token(user_assertion: str) -> str:
+_msal_lock = threading.Lock()
+_msal_cca = None
+
+def _msal_app():
+    """ConfidentialClientApplication built once on the first OBO call (its token cache then spans requests)."""
+    global _msal_cca
+    if _msal_cca is None:
+        with _msal_lock:
+            if _msal_cca is None:
+                from msal import ConfidentialClientApplication
+                _msal_cca = ConfidentialClientApplication(
+                    client_id=BACKEND_APP_ID,
+                    authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+                    client_credential=BACKEND_SECRET
+                )
+    return _msal_cca
+
+# -------------------- Pooled HTTP sessions: one keep-alive connection pool per upstream --------------------
+# Graph and Search are called through one aiohttp.ClientSession each (_http_send), cited-page fetches
+# (which run in threads, see source_meta.py) through one requests.Session. Their connections stay open
+# between calls, so a sequential search scan pages over one TCP+TLS connection. TCP keep-alive probes
+# stop idle pooled connections from being dropped by the platform's SNAT / load balancer.
+HTTP_POOL_MAXSIZE     = int(os.getenv("HTTP_POOL_MAXSIZE", "100"))       # open connections per host
+HTTP_RETRIES          = int(os.getenv("HTTP_RETRIES", "3"))              # transport-level retries; 0 = off
+HTTP_RETRY_BACKOFF    = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))    # seconds, doubled per retry
+HTTP_RETRY_AFTER_MAX  = float(os.getenv("HTTP_RETRY_AFTER_MAX", "10"))   # cap on a Retry-After wait
+HTTP_KEEPALIVE_SECS   = int(os.getenv("HTTP_KEEPALIVE_SECS", "60"))      # idle seconds before keep-alive probes; 0 = off
+_POOL_IDLE_SECS       = 120                                              # an unused pooled aiohttp connection is closed after this
+
+# upstream -> (statuses retried, retry read errors). Connect errors are always retried (nothing was
+# sent). Graph sendMail / event creation aren't idempotent, so only a 429 is repeated there;
+# "sources" fetches have their own time budget and failure cache and aren't retried.
+_RETRY_RULES = {
+    "graph":  ((429,), False),                     # a throttled call wasn't run
+    "search": ((429, 500, 502, 503, 504), True),   # queries are read-only
+}
+
+def _keepalive_options(idle: int) -> list:
+    opts = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", max(1, idle // 4)), ("TCP_KEEPCNT", 4)):
+        if hasattr(socket, name):   # not on every platform
+            opts.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return opts
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send TCP keep-alive probes; stats() counts connection reuse."""
+
+    def __init__(self, keepalive_secs: int = 0, **kwargs):
+        self._keepalive_secs = keepalive_secs   # before super().__init__, which builds the pool manager
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._keepalive_secs > 0:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + _keepalive_options(self._keepalive_secs)
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self) -> dict:
+        """Requests sent and connections opened by the live host pools."""
+        sent = opened = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return {"requests": sent, "connections": opened, "reused": max(0, sent - opened)}
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+
+def _http_session(name: str) -> requests.Session:
+    """Process-wide pooled requests.Session per blocking upstream ("sources"), created on first use."""
+    s = _sessions.get(name)
+    if s is None:
+        with _sessions_lock:
+            s = _sessions.get(name)
+            if s is None:
+                s = requests.Session()
+                adapter = _PooledAdapter(keepalive_secs=HTTP_KEEPALIVE_SECS, pool_maxsize=HTTP_POOL_MAXSIZE)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _sessions[name] = s
+    return s
+
+def _keepalive_socket(addr_info) -> socket.socket:
+    """aiohttp socket_factory: a plain TCP socket with keep-alive probes."""
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    for level, opt, value in _keepalive_options(HTTP_KEEPALIVE_SECS):
+        sock.setsockopt(level, opt, value)
+    return sock
+
+_aio_sessions = {}   # upstream -> (event loop, aiohttp.ClientSession, stats)
+
+def _aio_session(name: str):
+    """Pooled aiohttp.ClientSession per async upstream ("graph", "search"), created on first use on the running loop."""
+    loop = asyncio.get_running_loop()
+    entry = _aio_sessions.get(name)
+    if entry is None or entry[0] is not loop:   # a session can't outlive its loop (one per worker in the host)
+        import aiohttp
+        stats = {"requests": 0, "connections": 0}
+
+        async def on_request(session, ctx, params):
+            stats["requests"] += 1
+
+        async def on_connect(session, ctx, params):
+            stats["connections"] += 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request)
+        trace.on_connection_create_end.append(on_connect)
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=HTTP_POOL_MAXSIZE, keepalive_timeout=_POOL_IDLE_SECS,
+                                         socket_factory=_keepalive_socket if HTTP_KEEPALIVE_SECS > 0 else None)
+        entry = _aio_sessions[name] = (loop, aiohttp.ClientSession(connector=connector, trace_configs=[trace]), stats)
+    return entry[1]
+
+class _Reply:
+    """A response read in full (so its connection goes back to the pool), shaped like requests.Response."""
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        try:
+            return json.loads(self.text)
+        except json.JSONDecodeError as e:
+            raise requests.JSONDecodeError(e.msg, e.doc, e.pos) from e
+
+def _retry_after(headers) -> float | None:
+    try:
+        return min(float(headers.get("Retry-After")), HTTP_RETRY_AFTER_MAX)
+    except (TypeError, ValueError):
+        return None
+
+async def _http_send(name: str, method: str, url: str, *, timeout: float = 30, **kwargs) -> _Reply:
+    """
+    One call on the upstream's pooled aiohttp session, retried per _RETRY_RULES (HTTP_RETRIES,
+    HTTP_RETRY_BACKOFF doubled per retry, Retry-After capped at HTTP_RETRY_AFTER_MAX). Transport
+    failures raise requests.ConnectionError / requests.Timeout, the types the callers already handle.
+    """
+    import aiohttp
+    statuses, retry_read = _RETRY_RULES.get(name, ((), False))
+    attempt = 0
+    while True:
+        try:
+            async with _aio_session(name).request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as r:
+                reply = _Reply(r.status, r.headers, await r.read())
+            if reply.status_code not in statuses or attempt >= HTTP_RETRIES:
+                return reply
+            wait = _retry_after(reply.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            connect = isinstance(e, aiohttp.ClientConnectorError)   # nothing was sent
+            if attempt >= HTTP_RETRIES or not (connect or retry_read):
+                err = requests.Timeout if isinstance(e, asyncio.TimeoutError) else requests.ConnectionError
+                raise err(f"{method} {url}: {type(e).__name__} {e}") from e
+            wait = None
+        await asyncio.sleep(wait if wait is not None else HTTP_RETRY_BACKOFF * (2 ** attempt))
+        attempt += 1
+
+def _http_stats(name: str) -> dict:
+    """Connection reuse of an upstream's session (zeros before its first call)."""
+    entry = _aio_sessions.get(name)
+    if entry is not None:
+        stats = entry[2]
+        return {**stats, "reused": max(0, stats["requests"] - stats["connections"])}
+    s = _sessions.get(name)
+    return s.get_adapter("https://").stats() if s is not None else {"requests": 0, "connections": 0, "reused": 0}
+
+async def _obo_get_graph_token(user_assertion: str) -> str:
     if not (TENANT_ID and BACKEND_APP_ID and BACKEND_SECRET):
         raise RuntimeError("OBO not configured. Set TENANT_ID, BACKEND_CLIENT_ID, BACKEND_CLIENT_SECRET.")
-    cca = ConfidentialClientApplication(
-        client_id=BACKEND_APP_ID,
-        authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-        client_credential=BACKEND_SECRET
-    )
-    result = cca.acquire_token_on_behalf_of(user_assertion=user_assertion, scopes=GRAPH_SCOPE)
+    # MSAL is blocking (a token-cache hit returns without a request); keep it off the event loop
+    result = await asyncio.to_thread(
+        lambda: _msal_app().acquire_token_on_behalf_of(user_assertion=user_assertion, scopes=GRAPH_SCOPE))
     if "access_token" not in result:
         raise RuntimeError(f"OBO failed: {result.get('error')}: {result.get('error_description')}")
     return result["access_token"]
 
-def _graph_send_mail_as_user(graph_token: str, subject: str, body_html: str, recipients: list[str]):
+async def _graph_send_mail_as_user(graph_token: str, subject: str, body_html: str, recipients: list[str]):
     payload = {
         "message": {
             "subject": subject,
@@ -356,12 +1332,13 @@ def _graph_send_mail_as_user(graph_token: str, subject: str, body_html: str, rec
         },
         "saveToSentItems": True
     }
-    r = requests.post(
-        f"{GRAPH_ENDPOINT}/me/sendMail",
+    r = await _http_send(
+        "graph", "POST", f"{GRAPH_ENDPOINT}/me/sendMail",
         headers={"Authorization": f"Bearer {graph_token}", "Content-Type": "application/json"},
         json=payload,
         timeout=30
     )
+    logging.info("graph pool: %s", _http_stats("graph"))
     if r.status_code >= 300:
         raise RuntimeError(f"Graph sendMail failed {r.status_code}: {r.text}")
 
@@ -374,23 +1351,21 @@ def _coerce_recipients(v):
     return []
 
 @app.route(route="send-as-user", methods=[func.HttpMethod.POST])
-def send_as_user(req: func.HttpRequest) -> func.HttpResponse:
+async def send_as_user(req: func.HttpRequest) -> func.HttpResponse:
     try:
         authz = req.headers.get("Authorization", "")
         if not authz.startswith("Bearer "):
-            return func.HttpResponse(
-                json.dumps({"error": "Missing bearer token"}),
-                status_code=401,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "Missing bearer token"},
+                status_code=401
             )
         user_token = authz.split(" ", 1)[1]
 
         body = req.get_json()
         if not body:
-            return func.HttpResponse(
-                json.dumps({"error": "No JSON body provided"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "No JSON body provided"},
+                status_code=400
             )
 
         recipients = _coerce_recipients(body.get("recipients"))
@@ -398,32 +1373,27 @@ def send_as_user(req: func.HttpRequest) -> func.HttpResponse:
         body_html  = body.get("bodyHtml") or ""
 
         if not recipients or not subject or not body_html:
-            return func.HttpResponse(
-                json.dumps({"error": "Missing required fields: recipients[], subject, bodyHtml"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "Missing required fields: recipients[], subject, bodyHtml"},
+                status_code=400
             )
 
-        graph_token = _obo_get_graph_token(user_token)
-        _graph_send_mail_as_user(graph_token, subject, body_html, recipients)
+        graph_token = await _obo_get_graph_token(user_token)
+        await _graph_send_mail_as_user(graph_token, subject, body_html, recipients)
 
-        return func.HttpResponse(
-            json.dumps({"status": "sent", "recipients": recipients, "subject": subject}),
-            status_code=200,
-            mimetype="application/json"
+        return _json_response(
+            {"status": "sent", "recipients": recipients, "subject": subject}
         )
 
     except ValueError:
-        return func.HttpResponse(
-            json.dumps({"error": "Invalid JSON"}),
-            status_code=400,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "Invalid JSON"},
+            status_code=400
         )
     except Exception as e:
-        return func.HttpResponse(
-            json.dumps({"error": "send-as-user failed", "detail": str(e)}),
-            status_code=500,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "send-as-user failed", "detail": str(e)},
+            status_code=500
         )
 
 # -------------------------- NEW: schedule-as-user (OBO → Graph /me/events) --------------------------
@@ -437,7 +1407,7 @@ def _build_attendees(required: list[str], optional: list[str]):
             attendees.append({"emailAddress": {"address": a}, "type": "optional"})
     return attendees
 
-def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
+async def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
     """
     Create a Teams meeting as the logged-in user using Graph:
     - POST /me/events   (primary calendar), or
@@ -480,8 +1450,8 @@ def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
     else:
         url = f"{GRAPH_ENDPOINT}/me/events"
 
-    r = requests.post(
-        url,
+    r = await _http_send(
+        "graph", "POST", url,
         headers={
             "Authorization": f"Bearer {graph_token}",
             "Content-Type": "application/json",
@@ -490,6 +1460,7 @@ def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
         json=body,
         timeout=30
     )
+    logging.info("graph pool: %s", _http_stats("graph"))
     if r.status_code >= 300:
         raise RuntimeError(f"Graph create event failed {r.status_code}: {r.text}")
 
@@ -501,7 +1472,7 @@ def _graph_create_event_as_user(graph_token: str, payload: dict) -> dict:
     }
 
 @app.route(route="schedule-as-user", methods=[func.HttpMethod.POST])
-def schedule_as_user(req: func.HttpRequest) -> func.HttpResponse:
+async def schedule_as_user(req: func.HttpRequest) -> func.HttpResponse:
     """
     Request body (example):
     {
@@ -519,19 +1490,17 @@ def schedule_as_user(req: func.HttpRequest) -> func.HttpResponse:
     try:
         authz = req.headers.get("Authorization", "")
         if not authz.startswith("Bearer "):
-            return func.HttpResponse(
-                json.dumps({"error": "Missing bearer token"}),
-                status_code=401,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "Missing bearer token"},
+                status_code=401
             )
         user_token = authz.split(" ", 1)[1]
 
         body = req.get_json()
         if not body:
-            return func.HttpResponse(
-                json.dumps({"error": "No JSON body provided"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "No JSON body provided"},
+                status_code=400
             )
 
         subject = (body.get("subject") or "").strip()
@@ -541,28 +1510,26 @@ def schedule_as_user(req: func.HttpRequest) -> func.HttpResponse:
         req_att = body.get("requiredAttendees")
         # Basic validation (keep minimal)
         if not subject or not start or not end:
-            return func.HttpResponse(
-                json.dumps({"error": "Missing required fields: subject, start, end"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "Missing required fields: subject, start, end"},
+                status_code=400
             )
         # Require at least one attendee for invitations
         coerced_required = _coerce_recipients(req_att)
         if not coerced_required:
-            return func.HttpResponse(
-                json.dumps({"error": "requiredAttendees must include at least one recipient"}),
-                status_code=400,
-                mimetype="application/json"
+            return _json_response(
+                {"error": "requiredAttendees must include at least one recipient"},
+                status_code=400
             )
         body["requiredAttendees"] = coerced_required
         # Optional attendees normalization
         body["optionalAttendees"] = _coerce_recipients(body.get("optionalAttendees"))
 
-        graph_token = _obo_get_graph_token(user_token)
-        result = _graph_create_event_as_user(graph_token, body)
+        graph_token = await _obo_get_graph_token(user_token)
+        result = await _graph_create_event_as_user(graph_token, body)
 
-        return func.HttpResponse(
-            json.dumps({
+        return _json_response(
+            {
                 "ok": True,
                 "subject": subject,
                 "start": start,
@@ -571,22 +1538,18 @@ def schedule_as_user(req: func.HttpRequest) -> func.HttpResponse:
                 "webLink": result.get("webLink"),
                 "joinUrl": result.get("joinUrl"),
                 "iCalUId": result.get("iCalUId")
-            }),
-            status_code=200,
-            mimetype="application/json"
+            }
         )
 
     except ValueError:
-        return func.HttpResponse(
-            json.dumps({"error": "Invalid JSON"}),
-            status_code=400,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "Invalid JSON"},
+            status_code=400
         )
     except Exception as e:
-        return func.HttpResponse(
-            json.dumps({"error": "schedule-as-user failed", "detail": str(e)}),
-            status_code=500,
-            mimetype="application/json"
+        return _json_response(
+            {"error": "schedule-as-user failed", "detail": str(e)},
+            status_code=500
         )
 
 # ------------------------------ NEW: Secured Search (aligned to APIM headers) ------------------------------
@@ -597,6 +1560,31 @@ AZURE_SEARCH_INDEX    = os.getenv("AZURE_SEARCH_INDEX", "salesdata-index")
 AZURE_SEARCH_API_KEY  = os.getenv("AZURE_SEARCH_API_KEY")
 AZURE_SEARCH_API_VER  = os.getenv("AZURE_SEARCH_API_VERSION", "2024-07-01")
 
+# popular_product aggregation: "facet" lets the index sum UnitSold per Product (falls back to
+# "scan" when the facet result is incomplete); "scan" pages every document and sums here;
+# "rollup" answers popular_product / product_revenue from the in-process _SalesRollup.
+SECURED_SEARCH_AGG_MODE    = os.getenv("SECURED_SEARCH_AGG_MODE", "facet").lower()
+AZURE_SEARCH_FACET_API_VER = os.getenv("AZURE_SEARCH_FACET_API_VERSION", "2025-08-01-preview")  # facet aggregations are preview-only
+AZURE_SEARCH_FACET_BUCKETS = int(os.getenv("AZURE_SEARCH_FACET_BUCKETS", "1000"))
+AZURE_SEARCH_FACET_RETRY_SECS = float(os.getenv("AZURE_SEARCH_FACET_RETRY_SECS", "600"))  # scan-only after a failed facet call
+SECURED_SEARCH_FETCH_WORKERS = int(os.getenv("SECURED_SEARCH_FETCH_WORKERS", "4"))  # concurrent page requests; 1 = sequential
+SECURED_SEARCH_PAGING        = os.getenv("SECURED_SEARCH_PAGING", "skip").lower()    # skip | keyset
+SECURED_SEARCH_MAX_DOCS      = int(os.getenv("SECURED_SEARCH_MAX_DOCS", "5000"))     # per scan; 0 = no cap
+_KEYSET_FIELD = "Id"    # index key, filterable & sortable
+_SKIP_LIMIT   = 100000  # Azure AI Search rejects larger $skip values
+SECURED_SEARCH_ROLLUP_REFRESH_SECS = float(os.getenv("SECURED_SEARCH_ROLLUP_REFRESH_SECS", "60"))     # incremental (new Ids)
+SECURED_SEARCH_ROLLUP_REBUILD_SECS = float(os.getenv("SECURED_SEARCH_ROLLUP_REBUILD_SECS", "86400"))  # full (updates/deletes)
+SECURED_SEARCH_ROLLUP_CURSOR       = os.getenv("SECURED_SEARCH_ROLLUP_CURSOR", "IdNum")  # Edm.Int64 copy of Id, filterable & sortable
+
+def _search_url(api_version: str | None = None) -> str:
+    return f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX}/docs/search?api-version={api_version or AZURE_SEARCH_API_VER}"
+
+def _search_headers() -> dict:
+    headers = {"Content-Type": "application/json"}
+    if AZURE_SEARCH_API_KEY:
+        headers["api-key"] = AZURE_SEARCH_API_KEY
+    return headers
+
 def _norm_region(s: str) -> str:
     return re.sub(r"[^a-z0-9]", "", s.lower()) if isinstance(s, str) else ""
 
@@ -605,67 +1593,531 @@ def _region_in_scope(doc_region: str, scope: str) -> bool:
         return True
     return _norm_region(doc_region) == _norm_region(scope)
 
-def _iterate_search_batches(select_cols, max_docs=5000, batch=1000):
-    """Simple pager over /docs/search."""
-    url = f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX}/docs/search?api-version={AZURE_SEARCH_API_VER}"
-    loaded, skip = 0, 0
-    headers = {"Content-Type": "application/json"}
-    if AZURE_SEARCH_API_KEY:
-        headers["api-key"] = AZURE_SEARCH_API_KEY
-    while loaded < max_docs:
-        body = {
-            "search": "*",
-            "queryType": "simple",
-            "searchMode": "any",
-            "top": batch,
-            "skip": skip,
-            "select": ",".join(select_cols)
-        }
-        r = requests.post(url, headers=headers, json=body, timeout=30)
-        if r.status_code >= 400:
-            raise requests.HTTPError(r.text, response=r)
-        vals = r.json().get("value", [])
-        if not vals:
-            break
-        for d in vals:
-            yield d
-        loaded += len(vals)
-        if len(vals) < batch:
-            break
-        skip += batch
+def _odata_str(value: str) -> str:
+    """Quote a value as an OData string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
 
-def _search_top_product(region_scope: str, allow_revenue: bool):
-    """Aggregate UnitSold per Product within region_scope."""
-    if not AZURE_SEARCH_ENDPOINT or not AZURE_SEARCH_API_KEY:
-        raise RuntimeError("Azure Search not configured (AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_API_KEY).")
+def _odata_literal(value) -> str:
+    """Numbers as OData numeric literals, anything else quoted as a string."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return _odata_str(value)
+
+def _region_guard(scope: str):
+    """Per-row RLS check for client-side aggregation, or None when every region is in scope."""
+    if not scope or scope.strip() in ("*", "all"):
+        return None
+    return lambda doc_region: _region_in_scope(doc_region, scope)
+
+SECURED_SEARCH_REGION_INDEX_TTL = float(os.getenv("SECURED_SEARCH_REGION_INDEX_TTL", "600"))  # seconds between Region facet refreshes
+_REGION_MISS_REFRESH_SECS = 30   # a scope matching no stored value reloads at most this often (new regions)
+
+class _RegionIndex:
+    """
+    Region values stored in the index (plain Region facet), keyed by _norm_region, so RLS can be
+    pushed into $filter as the exact stored spellings ('Region-3', 'region_3', 'East', ...).
+
+    spellings() returns None when the values can't be listed (facet failed, or hit
+    AZURE_SEARCH_FACET_BUCKETS); callers then scope rows with the client-side guard only.
+    """
+
+    def __init__(self):
+        self._values = {}         # norm key -> [stored spellings]
+        self.complete = False
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()   # one facet load at a time; readers use the swapped-in values
+
+    async def refresh(self, force: bool = False):
+        async with self._lock:
+            now = time.monotonic()
+            if not force and self._loaded_at and now - self._loaded_at < SECURED_SEARCH_REGION_INDEX_TTL:
+                return
+            self._loaded_at = now   # a failed load is retried after the ttl, not on every request
+            body = {"search": "*", "top": 0, "filter": "Region ne null",
+                    "facets": [f"Region,count:{AZURE_SEARCH_FACET_BUCKETS}"]}
+            try:
+                buckets = ((await _search_page(body)).get("@search.facets") or {}).get("Region") or []
+            except Exception:
+                self.complete = False
+                raise
+            values = {}
+            for b in buckets:
+                value = b.get("value")
+                if isinstance(value, str):
+                    values.setdefault(_norm_region(value), []).append(value)
+            self._values, self.complete = values, len(buckets) < AZURE_SEARCH_FACET_BUCKETS
+
+    def invalidate(self):
+        """Reload on next use (e.g. after an indexer run)."""
+        self._loaded_at = 0.0
+
+    async def spellings(self, scope: str) -> list[str] | None:
+        """Stored Region values in scope ([] if none), or None when they can't be listed."""
+        key = _norm_region(scope)
+        try:
+            await self.refresh()
+            if key not in self._values and time.monotonic() - self._loaded_at >= _REGION_MISS_REFRESH_SECS:
+                await self.refresh(force=True)
+        except requests.RequestException as e:
+            logging.warning("region facet unavailable, scoping rows client-side: %s", str(e)[:300])
+        if not self.complete:
+            return None
+        return list(self._values.get(key, ()))
+
+_regions = _RegionIndex()
+
+def _region_variants(scope: str) -> list[str]:
+    """
+    Spellings of a region scope as it may be stored in the index ('region3' → 'region3',
+    'Region3', 'Region 3', ...), for when the stored values have no entry for it.
+    """
+    m = re.match(r"^\s*([a-z]+)\s*([0-9]+)\s*$", scope or "", re.IGNORECASE)
+    if not m:
+        return [(scope or "").strip()]
+    word, num = m.group(1).lower(), m.group(2)
+    out = [f"{w}{sep}{num}" for w in (word, word.title(), word.upper()) for sep in ("", " ")]
+    return list(dict.fromkeys(out))
+
+async def _region_filter(scope: str) -> str | None:
+    """
+    OData $filter on Region for a scope: the stored spellings that _norm_region-match it.
+    None means all regions, or that the stored values couldn't be listed; rows must then be
+    scoped by _region_guard (which the scan paths always apply).
+    """
+    if not scope or scope.strip() in ("*", "all"):
+        return None
+    values = await _regions.spellings(scope)
+    if values is None:
+        return None
+    values = [v.replace("'", "''") for v in values or _region_variants(scope) if v and "|" not in v]
+    return f"search.in(Region, '{'|'.join(values)}', '|')"
 
+async def _facet_product_totals(region_scope: str, allow_revenue: bool):
+    """
+    Ask the index for per-Product sums (facet aggregations) within region_scope.
+    Returns {product: {"UnitSold": float, "TotalRevenue": float|None}}, or None when the
+    facet result is incomplete (truncated buckets, missing metrics, counts that don't add up).
+    """
+    metrics = ["UnitSold"] + (["TotalRevenue"] if allow_revenue else [])
+    # sibling aggregations under one facet are separated by ";" ("," separates a field's parameters)
+    facet = f"Product,count:{AZURE_SEARCH_FACET_BUCKETS} > (" + "; ".join(f"{m}, metric: sum" for m in metrics) + ")"
+    flt = "Product ne null"
+    region_flt = await _region_filter(region_scope)
+    if region_flt:
+        flt = f"{region_flt} and {flt}"
+    elif _region_guard(region_scope) is not None:
+        return None   # the scope can't be pushed down and facets have no per-row guard: scan
+
+    body = {"search": "*", "top": 0, "count": True, "filter": flt, "facets": [facet]}
+    r = await _http_send("search", "POST", _search_url(AZURE_SEARCH_FACET_API_VER), headers=_search_headers(), json=body, timeout=30)
+    if r.status_code >= 400:
+        raise requests.HTTPError(r.text, response=r)
+    res = r.json()
+
+    buckets = (res.get("@search.facets") or {}).get("Product")
+    if buckets is None or len(buckets) >= AZURE_SEARCH_FACET_BUCKETS:
+        return None
+    totals, counted = {}, 0
+    for b in buckets:
+        sums = {}
+        for m in metrics:
+            agg = ((b.get("@search.facets") or {}).get(m) or [{}])[0]   # nested results use the wire key too
+            if not isinstance(agg.get("sum"), (int, float)):
+                return None
+            sums[m] = float(agg["sum"])
+        totals[b.get("value")] = {"UnitSold": sums["UnitSold"], "TotalRevenue": sums.get("TotalRevenue")}
+        counted += b.get("count") or 0
+    if counted != res.get("@odata.count"):
+        return None
+    return totals
+
+async def _search_page(body: dict) -> dict:
+    """One POST to /docs/search; raises requests.HTTPError on failure."""
+    r = await _http_send("search", "POST", _search_url(), headers=_search_headers(), json=body, timeout=30)
+    if r.status_code >= 400:
+        raise requests.HTTPError(r.text, response=r)
+    return r.json()
+
+def _keyset_filter(filter_expr: str | None, last, field: str = _KEYSET_FIELD) -> str:
+    """filter_expr restricted to documents past the keyset cursor."""
+    key_flt = f"{field} gt {_odata_literal(last)}"
+    return f"({filter_expr}) and {key_flt}" if filter_expr else key_flt
+
+async def _has_more(base: dict, skip: int = 0) -> bool:
+    """True if at least one more document matches base past skip."""
+    return bool((await _search_page({**base, "top": 1, "skip": skip})).get("value"))
+
+async def _iterate_search_batches(select_cols, max_docs=5000, batch=1000, filter_expr: str | None = None,
+                                  order_by: str | None = None, workers: int | None = None,
+                                  paging: str | None = None, scan: dict | None = None, keyset_field: str = _KEYSET_FIELD):
+    """
+    Simple async pager over /docs/search. filter_expr / order_by are sent as OData $filter / $orderby.
+    With workers > 1 the first page is fetched with the matching document count; if that says
+    there are more pages up to workers of them are fetched ahead of the consumer. Documents are
+    still yielded in page order.
+
+    paging="keyset" orders by keyset_field (Id) and continues with "Id gt <last seen>" instead
+    of skip, so page cost stays flat and the skip limit doesn't apply. max_docs falsy means no cap.
+    If a scan dict is passed it receives {"docs": n, "truncated": bool}.
+    """
+    paging = (paging or SECURED_SEARCH_PAGING).lower()
+    max_docs = max_docs or float("inf")
+    scan = scan if scan is not None else {}
+    scan.update(docs=0, truncated=False)
+    cols = list(select_cols)
+    if paging == "keyset" and keyset_field not in cols:
+        cols.append(keyset_field)
+    base = {
+        "search": "*",
+        "queryType": "simple",
+        "searchMode": "any",
+        "select": ",".join(cols)
+    }
+    if filter_expr:
+        base["filter"] = filter_expr
+    if order_by:
+        base["orderby"] = order_by
+
+    if paging == "keyset":
+        base["orderby"] = f"{keyset_field} asc"
+        last = None
+        while True:
+            body = {**base, "top": int(min(batch, max_docs - scan["docs"]))}
+            if last is not None:
+                body["filter"] = _keyset_filter(filter_expr, last, keyset_field)
+            vals = (await _search_page(body)).get("value", [])
+            for d in vals:
+                yield d
+            scan["docs"] += len(vals)
+            if len(vals) < body["top"]:
+                return
+            last = vals[-1].get(keyset_field)
+            if last is None:   # not in the index (or not retrievable): paging would repeat this page
+                raise RuntimeError(f"keyset paging needs {keyset_field} on every document")
+            if scan["docs"] >= max_docs:
+                scan["truncated"] = await _has_more({**base, "filter": _keyset_filter(filter_expr, last, keyset_field)})
+                return
+
+    workers = SECURED_SEARCH_FETCH_WORKERS if workers is None else workers
+    skip = 0
+    if workers > 1:
+        # the first page carries the count, so a one-page scan stays one request
+        top = int(min(batch, max_docs))
+        first = await _search_page({**base, "top": top, "skip": 0, "count": True})
+        vals = first.get("value", [])
+        for d in vals:
+            yield d
+        scan["docs"] += len(vals)
+        if len(vals) < top:
+            return
+        skip = top
+        total = first.get("@odata.count")
+        if isinstance(total, int):
+            n = int(min(total, max_docs, _SKIP_LIMIT + batch))
+            scan["truncated"] = total > n
+            skips = range(skip, n, batch)
+            if not skips:
+                return
+            # at most `workers` pages in flight or waiting to be read, so memory stays at a few pages
+            bodies = iter([{**base, "top": min(batch, n - s), "skip": s} for s in skips])
+            pages = deque()
+            try:
+                for body in bodies:
+                    pages.append(asyncio.ensure_future(_search_page(body)))
+                    if len(pages) >= workers:
+                        break
+                while pages:
+                    vals = (await pages.popleft()).get("value", [])
+                    body = next(bodies, None)
+                    if body is not None:
+                        pages.append(asyncio.ensure_future(_search_page(body)))
+                    scan["docs"] += len(vals)
+                    for d in vals:
+                        yield d
+            finally:   # a failed page or an abandoned scan doesn't leave requests running
+                for page in pages:
+                    page.cancel()
+                await asyncio.gather(*pages, return_exceptions=True)
+            return
+
+    while scan["docs"] < max_docs:
+        if skip > _SKIP_LIMIT:
+            scan["truncated"] = True
+            return
+        top = int(min(batch, max_docs - scan["docs"]))
+        vals = (await _search_page({**base, "top": top, "skip": skip})).get("value", [])
+        for d in vals:
+            yield d
+        scan["docs"] += len(vals)
+        if len(vals) < top:
+            return
+        skip += top
+    scan["truncated"] = skip > _SKIP_LIMIT or await _has_more(base, skip)
+
+async def _fold_pages(docs, fold, size: int = 1000):
+    """Feed an async document stream to fold(rows) size rows at a time: a scan holds one page, not all of it."""
+    rows = []
+    async for doc in docs:
+        rows.append(doc)
+        if len(rows) >= size:
+            fold(rows)
+            rows = []
+    if rows:
+        fold(rows)
+
+async def _scan_product_totals(region_scope: str, allow_revenue: bool, scan: dict | None = None):
+    """Client-side sum of UnitSold (and TotalRevenue) per Product within region_scope."""
     select_cols = ["Id", "Region", "Product", "UnitSold"]
     if allow_revenue:
         select_cols.append("TotalRevenue")
 
-    totals = {}
-    for doc in _iterate_search_batches(select_cols):
-        reg = doc.get("Region", "")
-        if not _region_in_scope(reg, region_scope):
-            continue
+    # RLS is pushed into $filter; the in-scope check stays as a guard on what came back
+    docs = _iterate_search_batches(select_cols, max_docs=SECURED_SEARCH_MAX_DOCS,
+                                   filter_expr=await _region_filter(region_scope), scan=scan)
+    totals, guard = {}, _region_guard(region_scope)
+    await _fold_pages(docs, lambda rows: sales_agg.product_totals(rows, allow_revenue, region_ok=guard, totals=totals))
+    return totals
+
+class _SalesRollup:
+    """
+    Region × Product → [UnitSold, TotalRevenue, rows], built with one full scan and then
+    extended with documents past the high-water mark of SECURED_SEARCH_ROLLUP_CURSOR.
+
+    The cursor is a numeric copy of Id (IdNum): the index key itself is an Edm.String, where
+    "10" sorts before "9", so unpadded new Ids would never be picked up. Updates and deletes are
+    picked up by the periodic full rebuild, or the next one after invalidate() (indexer run).
+
+    A refresh scans into new tables and swaps them in once the scan succeeded, so a failed scan
+    leaves the previous build in place. Only one request scans at a time; once a build exists the
+    others answer from it meanwhile instead of waiting. All of it runs on the worker's event loop,
+    so the swap needs no lock.
+    """
+
+    _COLS = ["Id", "Region", "Product", "UnitSold", "TotalRevenue"]
+
+    def __init__(self, batch: int = 1000):
+        self.batch = batch
+        self._cells = {}          # norm_region -> {product: [units, revenue, rows]}
+        self._hwm = None          # highest cursor value applied
+        self._built_at = 0.0
+        self._refreshed_at = 0.0
+        self._rebuild = False     # set by invalidate(): the next refresh is a full rebuild
+        self._refresh_lock = asyncio.Lock()    # held for the scan
+
+    @staticmethod
+    def _apply(cells: dict, doc: dict):
         prod = doc.get("Product")
-        units = doc.get("UnitSold") or 0
-        rev = doc.get("TotalRevenue") if allow_revenue else None
+        try:
+            units = float(doc.get("UnitSold") or 0)
+        except Exception:
+            return
         if not prod:
-            continue
+            return
         try:
-            units = float(units)
+            rev = float(doc.get("TotalRevenue") or 0)
         except Exception:
-            continue
-        if prod not in totals:
-            totals[prod] = {"UnitSold": 0.0, "TotalRevenue": 0.0 if allow_revenue else None}
-        totals[prod]["UnitSold"] += units
-        if allow_revenue and rev is not None:
+            rev = 0.0
+        cell = cells.setdefault(_norm_region(doc.get("Region", "")), {}).setdefault(prod, [0.0, 0.0, 0])
+        cell[0] += units
+        cell[1] += rev
+        cell[2] += 1
+
+    def invalidate(self):
+        """Rebuild on next use (e.g. after an indexer run, which may have updated or deleted rows)."""
+        self._rebuild = True
+
+    async def refresh(self, force: bool = False):
+        """Rebuild when stale, otherwise pull documents with cursor > high-water mark."""
+        if self._built_at and self._refresh_lock.locked():
+            return   # another request is scanning; answer from the current build
+        async with self._refresh_lock:
+            now = time.monotonic()
+            rebuild = force or self._rebuild or not self._built_at or now - self._built_at >= SECURED_SEARCH_ROLLUP_REBUILD_SECS
+            if not rebuild and now - self._refreshed_at < SECURED_SEARCH_ROLLUP_REFRESH_SECS:
+                return
+            if rebuild:
+                cells, hwm, self._rebuild = {}, None, False
+            else:
+                cells = {r: {p: list(c) for p, c in prods.items()} for r, prods in self._cells.items()}
+                hwm = self._hwm
+            cursor = SECURED_SEARCH_ROLLUP_CURSOR
+            try:
+                flt = _keyset_filter(None, hwm, cursor) if hwm is not None else None
+                async for doc in _iterate_search_batches(self._COLS, max_docs=0, batch=self.batch, filter_expr=flt,
+                                                         paging="keyset", keyset_field=cursor):
+                    self._apply(cells, doc)
+                    if doc.get(cursor) is not None:
+                        hwm = doc[cursor]
+            except Exception:
+                self._refreshed_at = now   # retried after SECURED_SEARCH_ROLLUP_REFRESH_SECS
+                self._rebuild = self._rebuild or rebuild
+                raise
+            self._cells, self._hwm, self._refreshed_at = cells, hwm, now
+            if rebuild:
+                self._built_at = now
+
+    async def product_totals(self, region_scope: str, allow_revenue: bool) -> dict:
+        """Per-Product sums within region_scope; TotalRevenue is None unless allow_revenue (CLS)."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            if not self._built_at:
+                raise
+            logging.warning("sales rollup refresh failed, answering from the previous build: %s", str(e)[:300])
+        if not region_scope or region_scope.strip() in ("*", "all"):
+            regions = list(self._cells.values())
+        else:
+            regions = [self._cells.get(_norm_region(region_scope), {})]
+        totals = {}
+        for products in regions:
+            for prod, (units, rev, rows) in products.items():
+                t = totals.setdefault(prod, {"UnitSold": 0.0, "TotalRevenue": 0.0 if allow_revenue else None, "rows": 0})
+                t["UnitSold"] += units
+                t["rows"] += rows
+                if allow_revenue:
+                    t["TotalRevenue"] += rev
+        return totals
+
+_rollup = _SalesRollup()
+
+# --- Product-name index: resolve product_revenue's product to stored spellings before scanning ---
+SECURED_SEARCH_PRODUCT_INDEX_TTL = float(os.getenv("SECURED_SEARCH_PRODUCT_INDEX_TTL", "600"))  # seconds between facet refreshes
+_SUGGEST_LIMIT = 3
+
+def _norm_product(s: str) -> str:
+    """Lowercase, punctuation/whitespace runs collapsed to one space ('Data-Booster  1GB' → 'data booster 1gb')."""
+    return re.sub(r"[^a-z0-9]+", " ", s.lower()).strip() if isinstance(s, str) else ""
+
+def _trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance (two-row DP)."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+class _ProductIndex:
+    """
+    Product names known to the index (plain Product facet), keyed by _norm_product, with a
+    trigram → keys map for "did you mean" candidates. Refreshed every
+    SECURED_SEARCH_PRODUCT_INDEX_TTL seconds.
+
+    complete is False when the facet hit AZURE_SEARCH_FACET_BUCKETS; callers should then
+    not treat a miss as "no such product".
+    """
+
+    def __init__(self):
+        self._names = {}          # norm key -> [stored spellings]
+        self._grams = {}          # trigram -> {norm key}
+        self.complete = False
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()   # one facet load at a time; readers use the swapped-in names
+
+    async def refresh(self, force: bool = False):
+        async with self._lock:
+            now = time.monotonic()
+            if not force and self._loaded_at and now - self._loaded_at < SECURED_SEARCH_PRODUCT_INDEX_TTL:
+                return
+            self._loaded_at = now   # a failed load is retried after the ttl, not on every request
+            body = {"search": "*", "top": 0, "filter": "Product ne null",
+                    "facets": [f"Product,count:{AZURE_SEARCH_FACET_BUCKETS}"]}
             try:
-                totals[prod]["TotalRevenue"] += float(rev)
+                buckets = ((await _search_page(body)).get("@search.facets") or {}).get("Product") or []
             except Exception:
-                pass
+                self.complete = False
+                raise
+            names, grams = {}, {}
+            for b in buckets:
+                value = b.get("value")
+                key = _norm_product(value)
+                if not key:
+                    continue
+                names.setdefault(key, []).append(value)
+                for g in _trigrams(key):
+                    grams.setdefault(g, set()).add(key)
+            self._names, self._grams, self.complete = names, grams, len(buckets) < AZURE_SEARCH_FACET_BUCKETS
+
+    def invalidate(self):
+        """Reload on next use (e.g. after an indexer run)."""
+        self._loaded_at = 0.0
+
+    async def resolve(self, product_name: str) -> tuple[list[str], list[str]]:
+        """(stored spellings matching product_name, up to _SUGGEST_LIMIT close names if none do)."""
+        await self.refresh()
+        key = _norm_product(product_name)
+        names, index = self._names, self._grams
+        if key in names:
+            return list(names[key]), []
+        grams = _trigrams(key)
+        shared = {}
+        for g in grams:
+            for k in index.get(g, ()):
+                shared[k] = shared.get(k, 0) + 1
+        scored = []
+        for k, n in shared.items():
+            jaccard = n / (len(grams) + len(_trigrams(k)) - n)
+            dist = _edit_distance(key, k)
+            if jaccard >= 0.3 or dist <= max(2, len(key) // 4):
+                scored.append((dist, -jaccard, k))
+        scored.sort()
+        return [], [names[k][0] for _, _, k in scored[:_SUGGEST_LIMIT]]
+
+_products = _ProductIndex()
+
+_facet_state = {"failed_at": float("-inf")}   # monotonic time of the last failed facet call
+
+async def _product_totals(region_scope: str, allow_revenue: bool, scan: dict | None = None) -> dict:
+    """Per-Product sums within region_scope from the configured SECURED_SEARCH_AGG_MODE."""
+    if not AZURE_SEARCH_ENDPOINT or not AZURE_SEARCH_API_KEY:
+        raise RuntimeError("Azure Search not configured (AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_API_KEY).")
 
+    totals = None
+    if SECURED_SEARCH_AGG_MODE == "rollup":
+        totals = await _rollup.product_totals(region_scope, allow_revenue)
+    elif SECURED_SEARCH_AGG_MODE == "facet" and time.monotonic() - _facet_state["failed_at"] >= AZURE_SEARCH_FACET_RETRY_SECS:
+        try:
+            totals = await _facet_product_totals(region_scope, allow_revenue)
+        except requests.RequestException as e:
+            # e.g. service / API version without facet aggregations, or the call didn't get through:
+            # the scan below still answers (JSON decode errors are RequestExceptions too), and so
+            # does every request until the retry window is over
+            _facet_state["failed_at"] = time.monotonic()
+            response = getattr(e, "response", None)
+            status = response.status_code if response is not None else type(e).__name__
+            logging.warning("facet aggregation failed (%s), scanning for %.0f s: %s",
+                            status, AZURE_SEARCH_FACET_RETRY_SECS, str(e)[:500])
+            totals = None
+    if totals is None:
+        totals = await _scan_product_totals(region_scope, allow_revenue, scan=scan)
+    return totals
+
+def _merge_spellings(totals: dict) -> dict:
+    """
+    Per-Product totals folded by _norm_product ('Data Booster 1GB' + 'data booster 1gb'):
+    {norm key: (first stored spelling, {"UnitSold", "TotalRevenue", "rows"})}.
+    """
+    merged = {}
+    for prod, t in totals.items():
+        key = _norm_product(prod)
+        if key not in merged:
+            merged[key] = (prod, dict(t))
+            continue
+        sums = merged[key][1]
+        for m in ("UnitSold", "TotalRevenue", "rows"):
+            if sums.get(m) is not None and t.get(m) is not None:
+                sums[m] += t[m]
+    return merged
+
+def _top_product(totals: dict, region_scope: str, allow_revenue: bool, scan: dict | None = None) -> list:
+    """[top-by-UnitSold row] from per-Product totals ([] when there are none)."""
     if not totals:
         return []
     top_prod, agg = max(totals.items(), key=lambda kv: kv[1]["UnitSold"])
@@ -676,9 +2128,17 @@ def _search_top_product(region_scope: str, allow_revenue: bool):
     }
     if allow_revenue:
         result["TotalRevenue"] = agg["TotalRevenue"]
+    if (scan or {}).get("truncated"):
+        result.update(truncated=True, scanned_docs=scan["docs"])
     return [result]
 
-def _search_total_revenue(region_scope: str, product_name: str):
+async def _search_top_product(region_scope: str, allow_revenue: bool):
+    """Aggregate UnitSold per Product within region_scope."""
+    scan = {}
+    totals = _merge_spellings(await _product_totals(region_scope, allow_revenue, scan=scan))
+    return _top_product(dict(totals.values()), region_scope, allow_revenue, scan)
+
+async def _search_total_revenue(region_scope: str, product_name: str):
     """Sum TotalRevenue for a given product within region_scope."""
     if not AZURE_SEARCH_ENDPOINT or not AZURE_SEARCH_API_KEY:
         raise RuntimeError("Azure Search not configured (AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_API_KEY).")
@@ -687,25 +2147,330 @@ def _search_total_revenue(region_scope: str, product_name: str):
     if not norm_target:
         return {"found": False, "total_revenue": 0.0}
 
+    # Resolve the name against the product index first: a typo costs one facet lookup, not a scan
+    try:
+        names, suggestions = await _products.resolve(product_name)
+    except requests.RequestException:
+        names, suggestions = [], []          # Product not facetable / index unreachable → plain scan
+    if not names and _products.complete:
+        agg = {"found": False, "total_revenue": 0.0}
+        if suggestions:
+            agg["did_you_mean"] = suggestions
+        return agg
+
+    if SECURED_SEARCH_AGG_MODE == "rollup":
+        totals = await _rollup.product_totals(region_scope, allow_revenue=True)
+        wanted = set(names) if names else None
+        hits = [t for prod, t in totals.items()
+                if (prod in wanted if wanted else prod.strip().lower() == norm_target)]
+        agg = {"found": bool(hits), "total_revenue": sum(t["TotalRevenue"] for t in hits)}
+        if names:
+            agg["product"] = names[0]
+        return agg
+
     select_cols = ["Product", "Region", "TotalRevenue"]
-    total = 0.0
-    matched = False
-    for doc in _iterate_search_batches(select_cols):
-        reg = doc.get("Region", "")
-        if not _region_in_scope(reg, region_scope):
-            continue
-        prod = (doc.get("Product") or "").strip()
-        if prod.lower() != norm_target:
-            continue
-        matched = True
-        rev = doc.get("TotalRevenue")
-        try:
-            if rev is not None:
-                total += float(rev)
-        except Exception:
-            pass
+    flt = await _region_filter(region_scope)
+    if names:
+        product_flt = " or ".join(f"Product eq {_odata_str(n)}" for n in names)
+        flt = f"{flt} and ({product_flt})" if flt else product_flt
+    scan = {}
+    docs = _iterate_search_batches(select_cols, max_docs=SECURED_SEARCH_MAX_DOCS, filter_expr=flt, scan=scan)
+    # product_revenue matches case-insensitively: one call per spelling would count "X" / "x" twice
+    targets = list(dict.fromkeys(n.strip().lower() for n in names)) or [norm_target]
+    guard, found = _region_guard(region_scope), {"matched": False, "total": 0.0}
+
+    def fold(rows):
+        for target in targets:
+            hit, rev = sales_agg.product_revenue(rows, target, region_ok=guard)
+            found["matched"], found["total"] = found["matched"] or hit, found["total"] + rev
+
+    await _fold_pages(docs, fold)
+    matched, total = found["matched"], found["total"]
+
+    agg = {"found": matched, "total_revenue": total}
+    if names:
+        agg["product"] = names[0]
+    if scan.get("truncated"):
+        agg.update(truncated=True, scanned_docs=scan["docs"])
+    return agg
+
+def _truncation_note(data: dict | None) -> str:
+    """Markdown note for answers computed from a truncated scan ('' otherwise)."""
+    if not (data or {}).get("truncated"):
+        return ""
+    return f"\n\n_Note: only the first {data.get('scanned_docs')} matching rows were scanned; the result may be incomplete._"
+
+# --- In-process aggregate cache (the indexer refreshes a few times a day at most) ---
+SECURED_SEARCH_CACHE_TTL       = float(os.getenv("SECURED_SEARCH_CACHE_TTL", "300"))   # seconds; 0 disables
+SECURED_SEARCH_CACHE_SIZE      = int(os.getenv("SECURED_SEARCH_CACHE_SIZE", "256"))
+AZURE_SEARCH_INDEXER           = os.getenv("AZURE_SEARCH_INDEXER")                      # e.g. salesdata-indexer (optional)
+AZURE_SEARCH_INDEXER_CHECK_SECS = float(os.getenv("AZURE_SEARCH_INDEXER_CHECK_SECS", "60"))
+
+_agg_cache = _TTLCache(SECURED_SEARCH_CACHE_TTL, SECURED_SEARCH_CACHE_SIZE)
+_indexer_state = {"checked_at": 0.0, "last_run": None}
+
+async def _indexer_last_run() -> str | None:
+    """endTime of the indexer's last run (None if unknown)."""
+    url = f"{AZURE_SEARCH_ENDPOINT}/indexers/{AZURE_SEARCH_INDEXER}/status?api-version={AZURE_SEARCH_API_VER}"
+    r = await _http_send("search", "GET", url, headers=_search_headers(), timeout=10)
+    if r.status_code >= 400:
+        return None
+    return (r.json().get("lastResult") or {}).get("endTime")
+
+async def _invalidate_on_indexer_run():
+    """Drop cached aggregates (and rebuild the rollup) once the indexer has run since we last looked (rate-limited)."""
+    if not AZURE_SEARCH_INDEXER:
+        return
+    now = time.monotonic()
+    if now - _indexer_state["checked_at"] < AZURE_SEARCH_INDEXER_CHECK_SECS:
+        return
+    _indexer_state["checked_at"] = now
+    try:
+        last_run = await _indexer_last_run()
+    except requests.RequestException:
+        return
+    if last_run and last_run != _indexer_state["last_run"]:
+        if _indexer_state["last_run"] is not None:
+            _agg_cache.clear()
+            _products.invalidate()
+            _regions.invalidate()
+            _rollup.invalidate()
+        _indexer_state["last_run"] = last_run
+
+async def _cached_aggregate(operation: str, effective_scope: str, allow_revenue: bool, product: str | None, compute):
+    """Serve await compute() from _agg_cache, keyed by operation, scope and column policy."""
+    await _invalidate_on_indexer_run()
+    key = (operation, _norm_region(effective_scope) or effective_scope, allow_revenue, (product or "").strip().lower())
+    hit = _agg_cache.get(key)
+    if hit is not None:
+        return hit
+    value = await compute()
+    _agg_cache.put(key, value)
+    return value
+
+# --- Response payloads (shared by single operations and batches) ---
+def _popular_payload(docs: list, effective_scope: str, allow_revenue: bool) -> payloads.SearchResult:
+    if not docs:
+        return payloads.SearchResult(
+            answer="No data found.",
+            answer_md="No data found.",
+            region_scope=effective_scope,
+            allow_revenue=allow_revenue
+        )
+    top = docs[0]
+    product = top.get("Product")
+    units = top.get("UnitSold")
+    revenue = top.get("TotalRevenue") if allow_revenue else None
+    scope_text = "all regions" if effective_scope in ("*", "all") else effective_scope
+
+    answer_md = f"Top product ({scope_text}): {product}\n\nUnits Sold: {units}"
+    if allow_revenue and revenue is not None:
+        answer_md += f"\nTotal Revenue: {revenue}"
+    answer_md += _truncation_note(top)
+    return payloads.SearchResult(answer_md, answer_md, data=top)
+
+def _revenue_denied_payload() -> payloads.SearchResult:
+    answer_md = "Sorry, you're not permitted to view revenue for your role."
+    return payloads.SearchResult(answer_md, answer_md)
+
+def _revenue_payload(agg: dict, product: str, effective_scope: str) -> payloads.SearchResult:
+    if not agg["found"]:
+        answer_md = "No revenue records found."
+        if agg.get("did_you_mean"):
+            answer_md += " Did you mean " + " or ".join(f"**{p}**" for p in agg["did_you_mean"]) + "?"
+        answer_md += _truncation_note(agg)
+        return payloads.SearchResult(answer_md, answer_md, did_you_mean=agg.get("did_you_mean"))
+    product = agg.get("product") or product
+    scope_text = "all regions" if effective_scope in ("*", "all") else effective_scope
+    answer_md = f'**Total revenue** for **{product}** in **{scope_text}** is **{agg["total_revenue"]}**.'
+    answer_md += _truncation_note(agg)
+    return payloads.SearchResult(answer_md, answer_md, data=agg)
+
+# --- Batches: several operations answered from one per-Product aggregation ---
+_MAX_BATCH_OPS = 20
+
+async def _batch_totals(effective_scope: str, allow_revenue: bool) -> dict:
+    """{"totals": per-Product sums, plus truncated/scanned_docs when the scan hit the cap}."""
+    scan = {}
+    snap = {"totals": await _product_totals(effective_scope, allow_revenue, scan=scan)}
+    if scan.get("truncated"):
+        snap.update(truncated=True, scanned_docs=scan["docs"])
+    return snap
+
+async def _batch_payloads(ops: list, effective_scope: str, allow_revenue: bool) -> list[payloads.SearchResult]:
+    """
+    Evaluate ops in order against a single aggregation of effective_scope.
+    {"operation": "product_revenue", "product_from": "<id>"} takes the Product of an earlier
+    popular_product op, so "revenue of the most popular product" is one request.
+    """
+    snap = await _cached_aggregate("product_totals", effective_scope, allow_revenue, None,
+                                   lambda: _batch_totals(effective_scope, allow_revenue))
+    totals = _merge_spellings(snap["totals"])   # every op reads the same per-product numbers
+    partial = {k: snap[k] for k in ("truncated", "scanned_docs") if k in snap}
+
+    results, done = [], {}
+    for i, item in enumerate(ops):
+        op_id = str(item.get("id") or i)
+        op = item["operation"]
+        if op == "popular_product":
+            top = _top_product(dict(totals.values()), effective_scope, allow_revenue)
+            if top and partial:
+                top[0].update(partial)
+            payload = _popular_payload(top, effective_scope, allow_revenue)
+        elif not allow_revenue:
+            payload = _revenue_denied_payload()
+        else:
+            product = item.get("product", "")
+            ref = item.get("product_from")
+            if ref is not None:
+                product = (getattr(done.get(str(ref)), "data", None) or {}).get("Product") or ""
+            name, sums = totals.get(_norm_product(product), (None, None))
+            agg = {"found": name is not None, "total_revenue": sums["TotalRevenue"] if sums else 0.0, **partial}
+            if name is not None:
+                agg["product"] = name
+            elif product:
+                try:
+                    agg["did_you_mean"] = (await _products.resolve(product))[1]
+                except requests.RequestException:
+                    pass
+            payload = _revenue_payload(agg, product, effective_scope)
+        payload = replace(payload, id=op_id, operation=op)
+        done[op_id] = payload
+        results.append(payload)
+    return results
+
+# --- Declarative group-by / top-k ("query" operation) ---
+_QUERY_GROUP_FIELDS  = ("Region", "Product")
+_QUERY_METRIC_FIELDS = ("UnitSold", "TotalRevenue")
+_QUERY_AGGS          = ("sum", "avg", "count")
+_QUERY_MAX_TOP       = 100
+
+def _canonical(value, allowed: tuple, what: str) -> str:
+    for a in allowed:
+        if isinstance(value, str) and value.strip().lower() == a.lower():
+            return a
+    raise ValueError(f"Unsupported {what} '{value}' (expected one of: {', '.join(allowed)})")
+
+def _metric_name(m: dict) -> str:
+    return "count" if m["agg"] == "count" else f"{m['field']}_{m['agg']}"
+
+def _as_list(value, what: str) -> list:
+    """A single name or object as a one-item list; None as []."""
+    if value is None:
+        return []
+    if isinstance(value, (str, dict)):
+        return [value]
+    if not isinstance(value, list):
+        raise ValueError(f"{what} must be a name or a list of names")
+    return value
+
+def _parse_query(body: dict) -> dict:
+    """
+    Normalize a query request; raises ValueError on anything unsupported.
+      group_by: "Product" | ["Region", "Product"] | []          (default ["Product"])
+      metrics:  "count" | ["UnitSold:sum", "TotalRevenue:avg", "count"] or [{"field": ..., "agg": ...}]
+      sort:     {"by": "<metric name or group field>", "order": "desc|asc"}  (default first metric, desc)
+      top:      1-100                                            (default 5)
+    """
+    group_by = _as_list(body.get("group_by", ["Product"]), "group_by")
+    group_by = list(dict.fromkeys(_canonical(g, _QUERY_GROUP_FIELDS, "group_by field") for g in group_by))
+
+    metrics = []
+    for m in _as_list(body.get("metrics") or ["UnitSold:sum"], "metrics"):
+        if isinstance(m, str):
+            field, _, agg = m.rpartition(":")
+            m = {"field": field, "agg": agg}
+        if not isinstance(m, dict):
+            raise ValueError(f"Unsupported metric {m!r}")
+        agg = _canonical(m.get("agg") or "sum", _QUERY_AGGS, "aggregation")
+        field = None if agg == "count" else _canonical(m.get("field"), _QUERY_METRIC_FIELDS, "metric field")
+        metrics.append({"field": field, "agg": agg})
+    metrics = list({_metric_name(m): m for m in metrics}.values())
+
+    sort = body.get("sort") or {}
+    if isinstance(sort, str):
+        sort = {"by": sort}
+    if not isinstance(sort, dict):
+        raise ValueError('sort must be a metric / group field name or {"by": ..., "order": ...}')
+    names = [_metric_name(m) for m in metrics] + group_by
+    by = _canonical(sort.get("by") or names[0], tuple(names), "sort key")
+    order = _canonical(sort.get("order") or "desc", ("desc", "asc"), "sort order")
 
-    return {"found": matched, "total_revenue": total}
+    try:
+        top = int(body.get("top", 5))
+    except (TypeError, ValueError):
+        raise ValueError("top must be an integer")
+    if not 1 <= top <= _QUERY_MAX_TOP:
+        raise ValueError(f"top must be between 1 and {_QUERY_MAX_TOP}")
+    return {"group_by": group_by, "metrics": metrics, "sort": {"by": by, "order": order}, "top": top}
+
+def _query_uses_revenue(spec: dict) -> bool:
+    return any(m["field"] == "TotalRevenue" for m in spec["metrics"])
+
+async def _run_query(spec: dict, region_scope: str) -> dict:
+    """Scan region_scope once through sales_agg.group_totals and return the top-k groups."""
+    if not AZURE_SEARCH_ENDPOINT or not AZURE_SEARCH_API_KEY:
+        raise RuntimeError("Azure Search not configured (AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_API_KEY).")
+    group_by, metrics = spec["group_by"], spec["metrics"]
+    fields = [f for f in _QUERY_METRIC_FIELDS if any(m["field"] == f for m in metrics)]
+    select_cols = list(dict.fromkeys(["Id", "Region", *group_by, *fields]))
+
+    scan = {}
+    docs = _iterate_search_batches(select_cols, max_docs=SECURED_SEARCH_MAX_DOCS,
+                                   filter_expr=await _region_filter(region_scope), scan=scan)
+    groups, guard = {}, _region_guard(region_scope)
+    await _fold_pages(docs, lambda rows: sales_agg.group_totals(rows, group_by, fields, region_ok=guard, groups=groups))
+
+    # fold Region spellings ("Region 2", "region2") into one group
+    merged = {}
+    for key, acc in groups.items():
+        key = tuple(_norm_region(v) if g == "Region" else v for g, v in zip(group_by, key))
+        into = merged.get(key)
+        if into is None:
+            merged[key] = {"count": acc["count"], **{f: list(acc[f]) for f in fields}}
+            continue
+        into["count"] += acc["count"]
+        for f in fields:
+            into[f][0] += acc[f][0]
+            into[f][1] += acc[f][1]
+
+    rows = []
+    for key, acc in merged.items():
+        row = dict(zip(group_by, key))
+        for m in metrics:
+            if m["agg"] == "count":
+                row["count"] = acc["count"]
+            elif m["agg"] == "sum":
+                row[_metric_name(m)] = acc[m["field"]][0]
+            else:
+                total, n = acc[m["field"]]
+                row[_metric_name(m)] = total / n if n else None
+        rows.append(row)
+
+    by, desc = spec["sort"]["by"], spec["sort"]["order"] == "desc"
+    present = sorted((r for r in rows if r.get(by) is not None), key=lambda r: r[by], reverse=desc)
+    rows = present + [r for r in rows if r.get(by) is None]
+
+    result = {"rows": rows[:spec["top"]], "groups": len(merged)}
+    if scan.get("truncated"):
+        result.update(truncated=True, scanned_docs=scan["docs"])
+    return result
+
+def _query_payload(result: dict, spec: dict, effective_scope: str) -> payloads.SearchResult:
+    rows = result["rows"]
+    if not rows:
+        answer_md = "No data found." + _truncation_note(result)
+        return payloads.SearchResult(answer_md, answer_md, data=result)
+    scope_text = "all regions" if effective_scope in ("*", "all") else effective_scope
+    cols = spec["group_by"] + [_metric_name(m) for m in spec["metrics"]]
+    what = " × ".join(spec["group_by"]) or "overall"
+    lines = [f"Top {len(rows)} ({what}, {scope_text}) by {spec['sort']['by']} {spec['sort']['order']}:", "",
+             "| " + " | ".join(cols) + " |", "|" + "---|" * len(cols)]
+    for r in rows:
+        cells = ["" if r.get(c) is None else f"{r[c]:,.2f}" if isinstance(r[c], float) else str(r[c]) for c in cols]
+        lines.append("| " + " | ".join(cells) + " |")
+    answer_md = "\n".join(lines) + _truncation_note(result)
+    return payloads.SearchResult(answer_md, answer_md, data=result, query=spec)
 
 # --- Infer requested region from any string anywhere in the body (nested) ---
 _REGION_RE = re.compile(r'\bregion\s*([0-9]+)\b|\b(region[0-9]+)\b', re.IGNORECASE)
@@ -750,11 +2515,21 @@ def _find_requested_region_anywhere(obj) -> str | None:
     return None
 
 @app.route(route="secured-search", methods=[func.HttpMethod.POST])
-def secured_search(req: func.HttpRequest) -> func.HttpResponse:
+async def secured_search(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        return await _secured_search(req)
+    finally:
+        logging.info("search pool: %s", _http_stats("search"))
+
+async def _secured_search(req: func.HttpRequest) -> func.HttpResponse:
     """
     Operations:
       - {"operation":"popular_product", "requested_region":"region3"}  # optional
       - {"operation":"product_revenue","product":"Data Booster 1GB"}
+      - {"operations":[{"id":"top","operation":"popular_product"},
+                       {"operation":"product_revenue","product_from":"top"}]}  # batch, one aggregation
+      - {"operation":"query","group_by":["Product"],"metrics":["UnitSold:sum","count"],
+         "sort":{"by":"UnitSold_sum","order":"desc"},"top":5}   # ad-hoc group-by / top-k
       - (robust) If requested_region is not given, we search ANY string field(s)
         in the JSON body (even nested) to infer "regionX" from natural language.
 
@@ -770,7 +2545,7 @@ def secured_search(req: func.HttpRequest) -> func.HttpResponse:
 
         # Hard stop if APIM handed us no region for non-admin
         if role != "admin" and region_scope == "deny":
-            return func.HttpResponse(json.dumps({"error": "No region access"}), status_code=403, mimetype="application/json")
+            return _json_response({"error": "No region access"}, status_code=403)
 
         try:
             body = req.get_json()
@@ -794,56 +2569,61 @@ def secured_search(req: func.HttpRequest) -> func.HttpResponse:
             and _norm_region(requested_region) != _norm_region(region_scope)
         ):
             msg = f"Sorry, you're not permitted to access data for **{requested_region}**."
-            return func.HttpResponse(json.dumps({"answer": msg, "answer_md": msg, "data": None, "note": msg}), status_code=200, mimetype="application/json")
+            return _json_response(payloads.SearchResult(msg, msg, note=msg))
 
         # Effective scope: honor requested_region when allowed, else use user's scope
         effective_scope = requested_region or region_scope
 
+        ops = (body or {}).get("operations")
+        if ops is not None:
+            if not isinstance(ops, list) or not ops or len(ops) > _MAX_BATCH_OPS:
+                return _json_response({"error": f"'operations' must be a list of 1-{_MAX_BATCH_OPS} operations"}, status_code=400)
+            bad = [o.get("operation") if isinstance(o, dict) else o for o in ops
+                   if not isinstance(o, dict) or o.get("operation") not in ("popular_product", "product_revenue")]
+            if bad:
+                return _json_response({"error": f"Unsupported operation '{bad[0]}'"}, status_code=400)
+            results = await _batch_payloads(ops, effective_scope, allow_revenue)
+            answer_md = "\n\n".join(r.answer_md for r in results)
+            payload = payloads.SearchResult(answer_md, answer_md, results=results)
+            return _json_response(payload)
+
         if op == "popular_product":
-            docs = _search_top_product(effective_scope, allow_revenue)
-            if not docs:
-                resp = {
-                    "answer": "No data found.",
-                    "answer_md": "No data found.",
-                    "data": None,
-                    "region_scope": effective_scope,
-                    "allow_revenue": allow_revenue
-                }
-                return func.HttpResponse(json.dumps(resp), status_code=200, mimetype="application/json")
-
-            top = docs[0]
-            product = top.get("Product")
-            units = top.get("UnitSold")
-            revenue = top.get("TotalRevenue") if allow_revenue else None
-            scope_text = "all regions" if effective_scope in ("*", "all") else effective_scope
-
-            answer_md = f"Top product ({scope_text}): {product}\n\nUnits Sold: {units}"
-            if allow_revenue and revenue is not None:
-                answer_md += f"\nTotal Revenue: {revenue}"
-
-            payload = {"answer": answer_md, "answer_md": answer_md, "data": top}
-            return func.HttpResponse(json.dumps(payload), status_code=200, mimetype="application/json")
+            docs = await _cached_aggregate(op, effective_scope, allow_revenue, None,
+                                           lambda: _search_top_product(effective_scope, allow_revenue))
+            payload = _popular_payload(docs, effective_scope, allow_revenue)
+            return _json_response(payload)
 
         elif op == "product_revenue":
             # friendly denial instead of 403 (keeps UI clean)
             if not allow_revenue:
-                answer_md = "Sorry, you're not permitted to view revenue for your role."
-                return func.HttpResponse(json.dumps({"answer": answer_md, "answer_md": answer_md, "data": None}), status_code=200, mimetype="application/json")
+                return _json_response(_revenue_denied_payload())
 
             product = (body or {}).get("product", "")
-            agg = _search_total_revenue(effective_scope, product)
-            if not agg["found"]:
-                return func.HttpResponse(json.dumps({"answer": "No revenue records found.", "answer_md": "No revenue records found.", "data": None}), status_code=200, mimetype="application/json")
-            scope_text = "all regions" if effective_scope in ("*", "all") else effective_scope
-            answer_md = f'**Total revenue** for **{product}** in **{scope_text}** is **{agg["total_revenue"]}**.'
-            payload = {"answer": answer_md, "answer_md": answer_md, "data": agg}
-            return func.HttpResponse(json.dumps(payload), status_code=200, mimetype="application/json")
+            agg = await _cached_aggregate(op, effective_scope, allow_revenue, product,
+                                          lambda: _search_total_revenue(effective_scope, product))
+            payload = _revenue_payload(agg, product, effective_scope)
+            return _json_response(payload)
+
+        elif op == "query":
+            try:
+                spec = _parse_query(body or {})
+            except ValueError as e:
+                return _json_response({"error": str(e)}, status_code=400)
+            # CLS: revenue metrics need x-allow-revenue
+            if _query_uses_revenue(spec) and not allow_revenue:
+                return _json_response(_revenue_denied_payload())
+            result = await _cached_aggregate(op, effective_scope, allow_revenue, json.dumps(spec, sort_keys=True),
+                                             lambda: _run_query(spec, effective_scope))
+            payload = _query_payload(result, spec, effective_scope)
+            return _json_response(payload)
 
         else:
-            return func.HttpResponse(json.dumps({"error": f"Unsupported operation '{op}'"}), status_code=400, mimetype="application/json")
+            return _json_response({"error": f"Unsupported operation '{op}'"}, status_code=400)
 
     except requests.HTTPError as e:
         detail = e.response.text if getattr(e, "response", None) else str(e)
-        return func.HttpResponse(json.dumps({"error": "Search query failed", "detail": detail}), status_code=502, mimetype="application/json")
+        return _json_response({"error": "Search query failed", "detail": detail}, status_code=502)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": "Secured search error", "detail": str(e)}), status_code=500, mimetype="application/json")
+        return _json_response({"error": "Secured search error", "detail": str(e)}, status_code=500)
+
+logging.info("function_app imported in %.0f ms", (time.perf_counter() - _IMPORT_STARTED) * 1000)
@@ -0,0 +1,92 @@
+"""
+Find JSON objects embedded in agent output (prose, markdown, ```json fences) in one pass.
+
+The scanner walks the text once, matching braces outside JSON string literals (with backslash
+escapes), and hands each balanced top-level {...} span to json's raw_decode. If a span doesn't
+parse (prose in braces around a real object, say), only its direct children are tried, so the
+work stays linear in the input: no regex backtracking on long, brace-heavy answers.
+
+The same file is used by the function app and the Streamlit app; keep the copies identical.
+"""
+import json
+import re
+
+_TOKEN = re.compile(r'[{}"]')
+_STRING_END = re.compile(r'["\\\n]')    # a raw newline can't be inside a JSON string
+_OBJECT_START = re.compile(r'\{\s*["}]')   # cheap pre-check before decoding a span
+_FENCE_OPEN = re.compile(r"```(?:json)?\s*\Z", re.IGNORECASE)
+_decode = json.JSONDecoder().raw_decode
+
+def _spans(text: str) -> list:
+    """
+    Balanced {...} spans not nested in another balanced span, as [start, end, children] with the
+    children (their direct balanced sub-spans) in the same shape.
+    """
+    opened = []     # offsets of the braces still open
+    closed = []     # spans closed so far whose parent hasn't closed yet, by start
+    pos = 0
+    while True:
+        if not opened:   # outside braces only '{' matters (prose quotes are not strings)
+            pos = text.find("{", pos)
+            if pos == -1:
+                break
+        m = _TOKEN.search(text, pos)
+        if m is None:
+            break
+        k, c = m.start(), m.group()
+        pos = k + 1
+        if c == "{":
+            opened.append(k)
+        elif c == "}":
+            start = opened.pop()
+            children = []
+            while closed and closed[-1][0] > start:
+                children.append(closed.pop())
+            children.reverse()
+            closed.append([start, k + 1, children])
+        else:   # '"' inside braces: skip the string literal
+            q = _STRING_END.search(text, pos)
+            while q is not None and q.group() == "\\":
+                q = _STRING_END.search(text, q.start() + 2)
+            if q is not None and q.group() == '"':
+                pos = q.end()
+            # else: no closing quote on this line, a stray quote in prose rather than a string
+    return closed
+
+def _parse(text: str, start: int, end: int):
+    if not _OBJECT_START.match(text, start):
+        return None
+    try:
+        # decode the span on its own: a decode error locates itself by counting lines from the
+        # start of the string it was given, which on the whole text would make this quadratic
+        obj, stop = _decode(text[start:end])
+    except (ValueError, RecursionError):
+        return None
+    return obj if stop == end - start and isinstance(obj, dict) else None
+
+def iter_json_objects(text: str):
+    """Yield (start, end, obj) for the JSON objects in text, in order of appearance."""
+    if not text:
+        return
+    for start, end, children in _spans(text):
+        obj = _parse(text, start, end)
+        if obj is not None:
+            yield start, end, obj
+            continue
+        for c_start, c_end, _ in children:
+            obj = _parse(text, c_start, c_end)
+            if obj is not None:
+                yield c_start, c_end, obj
+
+def is_fenced(text: str, start: int, end: int) -> bool:
+    """True when text[start:end] is the body of a ``` / ```json fence."""
+    return (_FENCE_OPEN.search(text, max(0, start - 32), start) is not None
+            and text[end:end + 32].lstrip().startswith("```"))
+
+def json_objects(text: str) -> list[dict]:
+    """The JSON objects in text: those in ```json fences first, then the rest, each in order."""
+    found = list(iter_json_objects(text))
+    fenced = [obj for start, end, obj in found if is_fenced(text, start, end)]
+    if len(fenced) == len(found):
+        return fenced
+    return fenced + [obj for start, end, obj in found if not is_fenced(text, start, end)]
@@ -0,0 +1,80 @@
+"""
+Response models of the function routes and the JSON serializer they go out through.
+
+Answer (chat, run status, stream frames) and SearchResult (secured search) are slotted
+dataclasses; citations.Source is their source record. dumps() writes them, and any dicts / lists
+holding them, leaving out model fields that are None, "" or empty lists / dicts (plain dicts are
+written as they are). orjson is used when installed, json otherwise; both give compact UTF-8.
+tools/bench_payloads.py compares cost and size with the hand-built dicts + json.dumps.
+"""
+import json
+from dataclasses import dataclass, field, fields
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+@dataclass(slots=True)
+class Answer:
+    type: str | None = None            # stream frames only ("final")
+    answer: str | None = None
+    answer_md: str | None = None
+    sources: list = field(default_factory=list)
+    thread_id: str | None = None
+    agent_id: str | None = None
+    run_id: str | None = None
+    status: str | None = None          # run status endpoint
+    error: str | None = None
+    detail: str | None = None
+    compacted_from: str | None = None
+    coalesced: bool | None = None
+    cached: bool | None = None
+    timed_out: bool | None = None
+
+@dataclass(slots=True)
+class SearchResult:
+    answer: str
+    answer_md: str
+    data: dict | None = None
+    id: str | None = None              # batch entries
+    operation: str | None = None
+    query: dict | None = None
+    did_you_mean: list | None = None
+    region_scope: str | None = None
+    allow_revenue: bool | None = None
+    note: str | None = None
+    results: list | None = None        # batch
+
+_FIELDS = {}
+_EMPTY_TYPES = frozenset((str, list, dict, tuple))
+
+def to_dict(obj) -> dict:
+    """A model's fields, without the ones that are None, "" or empty."""
+    names = _FIELDS.get(type(obj))
+    if names is None:
+        names = _FIELDS[type(obj)] = tuple(f.name for f in fields(obj))
+    out = {}
+    for name in names:
+        v = getattr(obj, name)
+        if v is None or (type(v) in _EMPTY_TYPES and not v):
+            continue
+        out[name] = v
+    return out
+
+def _default(obj):
+    if hasattr(type(obj), "__dataclass_fields__"):
+        return to_dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+
+def dumps(obj) -> bytes:
+    """UTF-8 JSON for obj (models compacted by to_dict)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:   # e.g. an int beyond 64 bits: json copes
+            pass
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
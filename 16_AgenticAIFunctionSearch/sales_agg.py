@@ -0,0 +1,107 @@
+"""
+Aggregations over secured-search result rows (Region, Product, UnitSold, TotalRevenue).
+
+One pass per scan; the RLS guard (region_ok) runs once per distinct Region value rather than
+once per row, which is where a scan's time went (tools/bench_sales_agg.py).
+group_totals is a streaming group-by for the ad-hoc "query" operation. product_totals and
+group_totals take an earlier result to add to, so a scan can be folded in one page at a time.
+"""
+
+# -------------------- product totals --------------------
+
+def _memoized(region_ok):
+    """region_ok evaluated once per distinct Region value (a scan has a handful)."""
+    if region_ok is None:
+        return None
+    seen = {}
+
+    def ok(region) -> bool:
+        hit = seen.get(region)
+        if hit is None:
+            hit = seen[region] = bool(region_ok(region))
+        return hit
+    return ok
+
+def product_totals(docs, allow_revenue: bool, region_ok=None, totals: dict | None = None) -> dict:
+    """
+    {product: {"UnitSold": float, "TotalRevenue": float|None}} in first-seen order.
+    totals (an earlier result) is added to and returned.
+    """
+    totals = {} if totals is None else totals
+    region_ok = _memoized(region_ok)
+    for doc in docs:
+        if region_ok and not region_ok(doc.get("Region", "")):
+            continue
+        prod = doc.get("Product")
+        units = doc.get("UnitSold") or 0
+        rev = doc.get("TotalRevenue") if allow_revenue else None
+        if not prod:
+            continue
+        try:
+            units = float(units)
+        except Exception:
+            continue
+        if prod not in totals:
+            totals[prod] = {"UnitSold": 0.0, "TotalRevenue": 0.0 if allow_revenue else None}
+        totals[prod]["UnitSold"] += units
+        if allow_revenue and rev is not None:
+            try:
+                totals[prod]["TotalRevenue"] += float(rev)
+            except Exception:
+                pass
+    return totals
+
+def product_revenue(docs, product_name: str, region_ok=None) -> tuple[bool, float]:
+    """(found, sum of TotalRevenue) for rows whose Product matches product_name (case-insensitive)."""
+    norm_target = (product_name or "").strip().lower()
+    total, matched = 0.0, False
+    region_ok = _memoized(region_ok)
+    for doc in docs:
+        if region_ok and not region_ok(doc.get("Region", "")):
+            continue
+        prod = (doc.get("Product") or "").strip()
+        if prod.lower() != norm_target:
+            continue
+        matched = True
+        rev = doc.get("TotalRevenue")
+        try:
+            if rev is not None:
+                total += float(rev)
+        except Exception:
+            pass
+    return matched, total
+
+# -------------------- streaming group-by --------------------
+
+def group_totals(docs, group_by: list, fields: list, region_ok=None, groups: dict | None = None) -> dict:
+    """
+    One pass over docs, memory bounded by the number of groups:
+    {group key tuple: {"count": rows, field: [sum, rows with a number], ...}}.
+    Rows with an empty group value are skipped; malformed or missing numbers are left out of
+    that field's sum and count. region_ok is evaluated once per distinct Region value.
+    groups (an earlier result) is added to and returned.
+    """
+    groups = {} if groups is None else groups
+    region_ok = _memoized(region_ok)
+    for doc in docs:
+        if region_ok and not region_ok(doc.get("Region") or ""):
+            continue
+        key = tuple(doc.get(g) for g in group_by)
+        if any(k is None or k == "" for k in key):
+            continue
+        acc = groups.get(key)
+        if acc is None:
+            acc = groups[key] = {"count": 0, **{f: [0.0, 0] for f in fields}}
+        acc["count"] += 1
+        for f in fields:
+            v = doc.get(f)
+            if v is None:
+                continue
+            try:
+                v = float(v)
+            except (TypeError, ValueError):
+                continue
+            cell = acc[f]
+            cell[0] += v
+            cell[1] += 1
+    return groups
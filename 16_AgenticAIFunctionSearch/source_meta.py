@@ -0,0 +1,333 @@
+"""
+Title, publisher and date for source URLs, read from the page <head> and cached in SQLite.
+
+Enricher.enrich fills the placeholder fields of URL sources in place. Cached URLs are answered
+from the cache. The rest are fetched concurrently, at most per_host at a time per host, and
+whatever has arrived when the time budget runs out is used. URLs past a host's limit wait in that
+host's queue, not in a pool worker, so a burst of links to one site doesn't hold up the others.
+Fetches still in flight finish in the background and land in the cache, so the next answer citing
+the URL gets them; failures are cached too, for a shorter time. The URLs come from agent output, so addresses that aren't public
+(loopback, private, link-local) are refused unless allow_private is set: the host is checked before
+the request, and the address each connection actually reached is checked again before anything is
+sent on it (a host can resolve differently the second time).
+tools/source_standin.py serves pages locally to exercise this offline.
+"""
+import ipaddress
+import json
+import logging
+import re
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_TITLE_KEYS = ("og:title", "twitter:title")
+_PUBLISHER_KEYS = ("og:site_name", "application-name", "publisher", "dc.publisher")
+_DATE_KEYS = ("article:published_time", "datepublished", "date", "pubdate", "publishdate", "publish-date",
+              "dc.date", "dc.date.issued", "parsely-pub-date", "article:modified_time")
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_SPACE_RE = re.compile(r"\s+")
+_MAX_REDIRECTS = 3
+_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; source-metadata/1.0)", "Accept": "text/html,application/xhtml+xml"}
+
+# -------------------- cache --------------------
+
+class MetaCache:
+    """url -> metadata dict in a SQLite file; entries expire after the ttl they were stored with."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")   # readers in other worker processes don't block writers
+        self._db.execute("CREATE TABLE IF NOT EXISTS source_meta (url TEXT PRIMARY KEY, meta TEXT NOT NULL, expires REAL NOT NULL)")
+        self._db.execute("DELETE FROM source_meta WHERE expires < ?", (time.time(),))
+
+    def get_many(self, urls) -> dict:
+        urls = list(urls)
+        if not urls:
+            return {}
+        marks = ",".join("?" * len(urls))
+        with self._lock:
+            rows = self._db.execute(f"SELECT url, meta FROM source_meta WHERE expires >= ? AND url IN ({marks})",
+                                    (time.time(), *urls)).fetchall()
+        return {url: json.loads(meta) for url, meta in rows}
+
+    def put(self, url: str, meta: dict, ttl: float):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO source_meta (url, meta, expires) VALUES (?, ?, ?)",
+                             (url, json.dumps(meta), time.time() + ttl))
+
+# -------------------- page metadata --------------------
+
+class _HeadParser(HTMLParser):
+    """<title> and <meta> tags up to the end of <head>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.title = None
+        self._title_parts = None
+        self._done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self._done:
+            return
+        if tag == "meta":
+            a = dict(attrs)
+            key = (a.get("property") or a.get("name") or a.get("itemprop") or "").lower()
+            content = (a.get("content") or "").strip()
+            if key and content:
+                self.meta.setdefault(key, content)
+        elif tag == "title" and self.title is None:
+            self._title_parts = []
+        elif tag == "body":
+            self._done = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self._title_parts is not None:
+            self.title = "".join(self._title_parts)
+            self._title_parts = None
+        elif tag == "head":
+            self._done = True
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+def _first(meta: dict, keys) -> str:
+    for k in keys:
+        if meta.get(k):
+            return meta[k]
+    return ""
+
+def parse_head(html: str) -> dict:
+    """{"title", "publisher", "date"} from a page's <head> (empty strings for what it lacks)."""
+    p = _HeadParser()
+    try:
+        p.feed(html)
+    except Exception:   # malformed markup: keep what was read
+        pass
+    title = _SPACE_RE.sub(" ", _first(p.meta, _TITLE_KEYS) or p.title or "").strip()[:300]
+    publisher = _SPACE_RE.sub(" ", _first(p.meta, _PUBLISHER_KEYS)).strip()[:120]
+    date = _first(p.meta, _DATE_KEYS)
+    m = _ISO_DATE_RE.match(date)
+    return {"title": title, "publisher": publisher, "date": m.group(0) if m else date[:40]}
+
+def _global_ip(addr: str) -> bool:
+    return ipaddress.ip_address(addr.split("%")[0]).is_global
+
+def _public_host(host: str) -> bool:
+    """True when every address host resolves to is globally routable."""
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except OSError:
+        return False
+    return bool(infos) and all(_global_ip(info[4][0]) for info in infos)
+
+class _PublicPeer:
+    """Connection mixin: refuse the socket unless the address it reached is public."""
+
+    def _new_conn(self):
+        sock = super()._new_conn()
+        peer = sock.getpeername()[0]
+        if not _global_ip(peer):
+            sock.close()
+            raise ValueError(f"not a public address: {self.host} connected to {peer}")
+        return sock
+
+class _PublicHTTPConnection(_PublicPeer, HTTPConnection):
+    pass
+
+class _PublicHTTPSConnection(_PublicPeer, HTTPSConnection):
+    pass
+
+class _PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PublicHTTPConnection
+
+class _PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PublicHTTPSConnection
+
+_PUBLIC_POOLS = {"http": _PublicHTTPConnectionPool, "https": _PublicHTTPSConnectionPool}
+_guard_lock = threading.Lock()
+
+def public_only(session):
+    """
+    Make the direct connections of session's http / https adapters check their peer address (see
+    _PublicPeer), so a host that passed _public_host and then resolved to a private address (DNS
+    rebinding) is refused before the request is sent. Requests through a proxy are resolved by
+    the proxy and not checked here. Idempotent; returns session.
+    """
+    with _guard_lock:
+        for prefix in ("http://", "https://"):
+            manager = getattr(session.get_adapter(prefix), "poolmanager", None)
+            if manager is None or manager.pool_classes_by_scheme is _PUBLIC_POOLS:
+                continue
+            manager.clear()   # pools opened before the guard use the plain connection classes
+            manager.pool_classes_by_scheme = _PUBLIC_POOLS
+    return session
+
+def fetch_meta(session, url: str, timeout: float = 5.0, max_bytes: int = 65536, allow_private: bool = False) -> dict:
+    """Fetch url (following up to 3 redirects) and parse its <head>; raises on any failure."""
+    if not allow_private:
+        public_only(session)
+    for _ in range(_MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"unsupported URL: {url}")
+        if not allow_private and not _public_host(parts.hostname):
+            raise ValueError(f"not a public address: {parts.hostname}")
+        with session.get(url, headers=_HEADERS, timeout=timeout, stream=True, allow_redirects=False) as r:
+            if r.is_redirect:
+                url = urljoin(url, r.headers["location"])
+                continue
+            r.raise_for_status()
+            ctype = r.headers.get("content-type", "").lower()
+            if "html" not in ctype:
+                raise ValueError(f"not an HTML page: {ctype or 'no content-type'}")
+            head, end = b"", -1
+            for chunk in r.iter_content(16384):
+                head += chunk
+                end = head.lower().find(b"</head")
+                if end >= 0 or len(head) >= max_bytes:
+                    break
+            head = head[:end] if end >= 0 else head[:max_bytes]   # HTMLParser is slow; don't hand it the body
+            meta = parse_head(head.decode(r.encoding if "charset" in ctype else "utf-8", "replace"))
+        if not meta["publisher"]:
+            host = urlsplit(url).hostname or ""
+            meta["publisher"] = host[4:] if host.startswith("www.") else host
+        return meta
+    raise ValueError(f"too many redirects: {url}")
+
+# -------------------- enrichment --------------------
+
+def needs_meta(source) -> bool:
+    """URL source still carrying the placeholder title or no publisher."""
+    return bool(source.url) and (source.title in ("", "Source") or not source.publisher)
+
+def _apply(source, meta: dict):
+    if meta.get("title") and source.title in ("", "Source"):
+        source.title = meta["title"]
+    if meta.get("publisher") and not source.publisher:
+        source.publisher = meta["publisher"]
+    if meta.get("date") and not source.date:
+        source.date = meta["date"]
+
+class Enricher:
+    """Concurrent, cached metadata lookups for Source records (see module docstring)."""
+
+    def __init__(self, session_factory, cache: MetaCache | None = None, per_host: int = 2, workers: int = 16,
+                 ttl: float = 86400, fail_ttl: float = 3600, fetch_timeout: float = 5.0,
+                 max_bytes: int = 65536, allow_private: bool = False):
+        self._session = session_factory
+        self._cache = cache
+        self.per_host = max(1, per_host)
+        self.ttl = ttl
+        self.fail_ttl = fail_ttl
+        self.fetch_timeout = fetch_timeout
+        self.max_bytes = max_bytes
+        self.allow_private = allow_private
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="source-meta")
+        self._lock = threading.Lock()
+        self._hosts = {}      # host -> {"active": fetches running (<= per_host), "queue": (url, Future) waiting}
+        self._inflight = {}   # url -> Future, shared by answers citing the same URL
+        self.stats = {"cached": 0, "fetched": 0, "failed": 0, "late": 0}
+
+    def enrich(self, sources, budget: float, limit: int = 0) -> int:
+        """
+        Fill title / publisher / date of the sources that need it, waiting at most budget seconds.
+        At most `limit` URLs (0 = no limit) are fetched per call. Returns how many sources changed.
+        """
+        started = time.monotonic()
+        pending = {}
+        for s in sources:
+            if needs_meta(s):
+                pending.setdefault(s.url, []).append(s)
+        if not pending:
+            return 0
+        found = {}
+        if self._cache is not None:
+            try:
+                found = self._cache.get_many(pending)
+            except sqlite3.Error as e:
+                logging.warning("source cache read failed: %s", e)
+        with self._lock:
+            self.stats["cached"] += len(found)
+        misses = [u for u in pending if u not in found]
+        if limit > 0:
+            misses = misses[:limit]
+        if misses:
+            futures = {self._submit(u): u for u in misses}
+            done, not_done = wait(futures, timeout=max(0.0, budget - (time.monotonic() - started)))
+            with self._lock:
+                self.stats["late"] += len(not_done)
+            for f in done:
+                found[futures[f]] = f.result()
+        changed = 0
+        for url, meta in found.items():
+            for s in pending[url]:
+                before = (s.title, s.publisher, s.date)
+                _apply(s, meta)
+                changed += before != (s.title, s.publisher, s.date)
+        return changed
+
+    def _submit(self, url: str) -> Future:
+        host = (urlsplit(url).hostname or "").lower()
+        with self._lock:
+            f = self._inflight.get(url)
+            if f is not None:
+                return f
+            f = self._inflight[url] = Future()
+            state = self._hosts.setdefault(host, {"active": 0, "queue": deque()})
+            start = state["active"] < self.per_host
+            if start:
+                state["active"] += 1
+            else:
+                state["queue"].append((url, f))
+        f.add_done_callback(lambda _, u=url: self._forget(u))
+        if start:
+            self._pool.submit(self._run, host, url, f)
+        return f
+
+    def _forget(self, url: str):
+        with self._lock:
+            self._inflight.pop(url, None)
+
+    def _run(self, host: str, url: str, f: Future):
+        """Fetch url into f, then hand the host's slot to the next queued URL (or free it)."""
+        try:
+            f.set_result(self._fetch(url))
+        except Exception as e:
+            f.set_exception(e)
+        finally:
+            with self._lock:
+                state = self._hosts[host]
+                nxt = state["queue"].popleft() if state["queue"] else None
+                if nxt is None:
+                    state["active"] -= 1
+                    if not state["active"]:
+                        del self._hosts[host]
+            if nxt is not None:
+                self._pool.submit(self._run, host, *nxt)
+
+    def _fetch(self, url: str) -> dict:
+        try:
+            meta, ttl, outcome = fetch_meta(self._session(), url, self.fetch_timeout, self.max_bytes,
+                                            self.allow_private), self.ttl, "fetched"
+        except Exception as e:
+            logging.info("source metadata for %s unavailable: %s", url, e)
+            meta, ttl, outcome = {}, self.fail_ttl, "failed"
+        with self._lock:
+            self.stats[outcome] += 1
+        if self._cache is not None:
+            try:
+                self._cache.put(url, meta, ttl)
+            except sqlite3.Error as e:
+                logging.warning("source cache write failed: %s", e)
+        return meta
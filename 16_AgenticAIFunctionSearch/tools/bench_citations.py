@@ -0,0 +1,154 @@
+"""
+Benchmark: answer post-processing (_answer_from) per agent response, legacy vs. citations.py.
+
+Responses are read from a JSONL file, one {"query": ..., "message": <ThreadMessage as REST JSON>} per
+line, and rebuilt as SDK ThreadMessage objects. tools/agent_responses.jsonl holds Bing-grounded,
+file-search, structured-JSON and plain answers in that shape; to measure your own traffic, dump
+`{"query": q, "message": msg.as_dict()}` lines from a thread and pass them with --responses.
+
+The legacy pipeline is copied below. "same" compares answer text and source keys (URL / file id);
+titles differ by design, url_citation sources now carry the citation's title.
+
+    python tools/bench_citations.py
+    python tools/bench_citations.py --responses my_threads.jsonl --repeat 200
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from urllib.parse import quote_plus
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from azure.ai.agents.models import ThreadMessage  # noqa: E402
+import function_app as fa  # noqa: E402
+
+# -------------------- legacy pipeline --------------------
+
+_URL_RE = re.compile(r'https?://[^\s\]\)]+', re.IGNORECASE)
+_CITATION_MARKER_RE = re.compile(r'【[^】]+】')
+_BING_MARKER_RE = re.compile(r'【\d+:\d+†source】')
+
+def legacy_dedup_sources(items):
+    seen = set()
+    out = []
+    for s in items:
+        url = (s or {}).get("url", "") or ""
+        key = url or f"file:{(s or {}).get('file_id','')}"
+        if key and key not in seen:
+            seen.add(key)
+            out.append(s)
+    return out
+
+def legacy_extract_sources_from_text(md, user_query=None):
+    if not md:
+        return md, []
+    has_bing_markers = bool(_BING_MARKER_RE.search(md))
+    md_clean = _CITATION_MARKER_RE.sub('', md)
+    urls = list(dict.fromkeys(_URL_RE.findall(md_clean)))
+    sources = [{"title": "Source", "url": u, "publisher": "", "date": ""} for u in urls]
+    if not sources and user_query:
+        if has_bing_markers or fa._is_time_sensitive(user_query):
+            sources.append({"title": "Bing News results",
+                            "url": f"https://www.bing.com/news/search?q={quote_plus(user_query)}",
+                            "publisher": "Bing", "date": ""})
+    return md_clean.strip(), sources
+
+def legacy_collect(messages, user_query):
+    last_text = None
+    ann_sources = []
+    for msg in messages:
+        if getattr(msg, "role", None) == "assistant":
+            chunks = []
+            for c in getattr(msg, "content", []) or []:
+                if hasattr(c, "text"):
+                    tv = getattr(c.text, "value", None)
+                    chunks.append(tv if tv else str(c.text))
+                    for an in getattr(c.text, "annotations", None) or []:
+                        if hasattr(an, "file_citation") and an.file_citation:
+                            fc = an.file_citation
+                            ann_sources.append({"title": "Document citation", "url": "", "publisher": "", "date": "",
+                                                "file_id": getattr(fc, "file_id", "unknown"), "quote": getattr(fc, "quote", "")})
+                        elif hasattr(an, "file_path") and an.file_path:
+                            ann_sources.append({"title": "File attachment", "url": "", "publisher": "", "date": "",
+                                                "file_id": getattr(an.file_path, "file_id", "unknown")})
+                        else:
+                            url = getattr(an, "url", None)
+                            if url:
+                                ann_sources.append({"title": "Source", "url": url, "publisher": "", "date": ""})
+                            else:
+                                try:
+                                    s = str(an)
+                                except Exception:
+                                    s = ""
+                                m = re.search(r'https?://[^\s\'">,]+', s)
+                                if m:
+                                    ann_sources.append({"title": "Source", "url": m.group(0), "publisher": "", "date": ""})
+            if chunks:
+                last_text = "\n\n".join(chunks)
+            if last_text:
+                break
+    if not last_text:
+        return {"answer_md": None, "answer": "(no assistant message)", "sources": []}
+    obj = fa._extract_json_block(last_text)
+    if isinstance(obj, dict) and ("answer_md" in obj or "answer" in obj):
+        sources = obj.get("sources", [])
+        if not isinstance(sources, list):
+            sources = []
+        answer_md = obj.get("answer_md") or obj.get("answer") or ""
+        if not sources:
+            answer_md, mined = legacy_extract_sources_from_text(answer_md, user_query=user_query)
+            sources = legacy_dedup_sources(ann_sources + mined)
+        else:
+            sources = legacy_dedup_sources(sources + ann_sources)
+        return {"answer_md": answer_md, "answer": obj.get("answer") or answer_md, "sources": sources}
+    clean_md, mined = legacy_extract_sources_from_text(last_text, user_query=user_query)
+    return {"answer_md": clean_md, "answer": clean_md, "sources": legacy_dedup_sources(ann_sources + mined)}
+
+# -------------------- timing --------------------
+
+def current_collect(messages, user_query):
+    return fa._answer_from(messages, user_query)
+
+def _same(a: dict, b) -> bool:
+    """Legacy dict vs. payloads.Answer: same text and the same sources in the same order."""
+    keys = [s.get("url") or f"file:{s.get('file_id', '')}" for s in a["sources"]]
+    return a["answer_md"] == b.answer_md and keys == [s.key for s in b.sources]
+
+def _best_of(fn, messages, query, repeat: int) -> tuple[float, dict]:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(messages, query)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+def load(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [(r.get("query"), [ThreadMessage(r["message"])]) for r in rows]
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--responses", default=os.path.join(HERE, "agent_responses.jsonl"))
+    ap.add_argument("--repeat", type=int, default=50)
+    args = ap.parse_args()
+
+    print(f"{'message':<10}{'chars':>8}{'anns':>6}{'sources':>9}{'legacy us':>12}{'current us':>12}{'same':>6}")
+    total_old = total_new = 0.0
+    for query, messages in load(args.responses):
+        msg = messages[0]
+        text = "".join(c.text.value for c in msg.content if getattr(c, "text", None))
+        anns = sum(len(c.text.annotations or []) for c in msg.content if getattr(c, "text", None))
+        t_old, r_old = _best_of(legacy_collect, messages, query, args.repeat)
+        t_new, r_new = _best_of(current_collect, messages, query, args.repeat)
+        total_old += t_old
+        total_new += t_new
+        print(f"{msg.id:<10}{len(text):>8}{anns:>6}{len(r_new.sources):>9}{t_old * 1e6:>12.1f}{t_new * 1e6:>12.1f}"
+              f"{'yes' if _same(r_old, r_new) else 'no':>6}")
+    print(f"{'total':<33}{total_old * 1e6:>12.1f}{total_new * 1e6:>12.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark: json_scan vs. the regexes it replaced, on adversarial ~100 KB agent outputs.
+
+The legacy patterns are copied below (function app _extract_json_block and the Streamlit
+email/meeting heuristics). Each legacy run happens in a child process and is stopped after
+--limit seconds, because several of them are quadratic on these inputs.
+
+    python tools/bench_json_scan.py
+    python tools/bench_json_scan.py --size 20000 --limit 5
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import json_scan  # noqa: E402
+
+# -------------------- legacy parsers --------------------
+
+def legacy_extract_json_block(text: str):
+    m = re.search(r"```json\s*(\{.*?\})\s*```", text, re.DOTALL | re.IGNORECASE)
+    if m:
+        try:
+            return json.loads(m.group(1))
+        except Exception:
+            pass
+    m2 = re.search(r"(\{.*\})", text, re.DOTALL)
+    if m2:
+        try:
+            return json.loads(m2.group(1))
+        except Exception:
+            pass
+    return None
+
+_FENCE = re.compile(r"```(?:json)?\s*({.*?})\s*```", re.DOTALL | re.IGNORECASE)
+_EMAIL = re.compile(r"(\{[^{}]*?(\"subject\"|\'subject\')[^{}]*?(\"bodyHtml\"|\'bodyHtml\')[\s\S]*?\})")
+_MEETING = re.compile(r"(\{[^{}]*?(\"subject\"|\'subject\')[\s\S]*?(\"start\"|\'start\')[\s\S]*?(\"end\"|\'end\')[\s\S]*?\})")
+
+def legacy_ui_candidates(text: str):
+    """What try_extract_email_payload + try_extract_meeting_payload matched before json_scan."""
+    fenced = [m.group(1) for m in _FENCE.finditer(text)]
+    if fenced:
+        return fenced
+    return [m.group(1) for m in (_EMAIL.search(text), _MEETING.search(text)) if m]
+
+# -------------------- inputs --------------------
+
+def inputs(size: int) -> dict:
+    reply = {"subject": "Quarterly numbers", "start": "2026-10-20T10:00", "end": "2026-10-20T10:30",
+             "bodyHtml": "<p>See {attached} figures</p>", "recipients": ["a@contoso.com"]}
+    obj = json.dumps(reply)
+    def fill(unit: str) -> str:
+        return unit * (size // len(unit))
+    return {
+        "typical answer (2 KB)": "Here is the draft.\n\n" + "Some prose. " * 150 + f"\n```json\n{obj}\n```\n",
+        "open braces": fill("{"),
+        "brace-heavy prose": fill("{x} ") + obj,
+        "unclosed objects": fill('{"subject": "a", '),
+        "unterminated fences": fill("```json\n{ "),
+        "quotes and escapes": "{" + fill('"a\\" {", ') + "}" + obj,
+    }
+
+# -------------------- timing --------------------
+
+def _found(result) -> bool:
+    """Did the parser recover the reply object (the one with a "subject")?"""
+    items = result if isinstance(result, list) else [result]
+    return any(isinstance(o, dict) and "subject" in o or isinstance(o, str) and '"subject"' in o for o in items)
+
+def _best_of(fn, text: str, repeat: int) -> tuple[float, bool]:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(text)
+        best = min(best, time.perf_counter() - t0)
+    return best, _found(result)
+
+def _child(fn, text, repeat, out):
+    out.put(_best_of(fn, text, repeat))
+
+def _best_of_limited(fn, text: str, repeat: int, limit: float) -> tuple[float, bool] | None:
+    """_best_of in a child process, or None if it ran longer than limit seconds."""
+    out = mp.Queue()
+    proc = mp.Process(target=_child, args=(fn, text, repeat, out), daemon=True)
+    proc.start()
+    proc.join(limit)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+        return None
+    return out.get()
+
+def new_function(text: str):
+    objects = json_scan.json_objects(text)
+    return objects[0] if objects else None
+
+def new_ui(text: str):
+    return json_scan.json_objects(text)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--size", type=int, default=100_000, help="characters per adversarial input")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--limit", type=float, default=10.0, help="seconds before a legacy run is stopped")
+    args = ap.parse_args()
+
+    print(f"{'input':<24}{'parser':<10}{'legacy ms':>12}{'found':>7}{'json_scan ms':>14}{'found':>7}")
+    for name, text in inputs(args.size).items():
+        for label, old, new in (("function", legacy_extract_json_block, new_function), ("ui", legacy_ui_candidates, new_ui)):
+            old_run = _best_of_limited(old, text, args.repeat, args.limit)
+            t_new, found_new = _best_of(new, text, args.repeat)
+            if old_run is None:
+                old_s, found_old = f"> {args.limit * 1000:.0f}", "-"
+            else:
+                old_s, found_old = f"{old_run[0] * 1000:.2f}", "yes" if old_run[1] else "no"
+            print(f"{name:<24}{label:<10}{old_s:>12}{found_old:>7}{t_new * 1000:>14.2f}{'yes' if found_new else 'no':>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark: /chat response serialization, hand-built dicts + json.dumps vs. payloads.dumps.
+
+The answer carries N sources, mostly Bing-style URL placeholders (no publisher / date), some
+file citations and some enriched entries. "legacy" is the dict shape and json.dumps call the
+routes used before payloads.py; "models json" is payloads.dumps without orjson.
+
+    python tools/bench_payloads.py
+    python tools/bench_payloads.py --sizes 100 5000 --repeat 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import citations  # noqa: E402
+import payloads  # noqa: E402
+
+def make_sources(n: int) -> list:
+    out = []
+    for i in range(n):
+        if i % 10 == 9:
+            out.append(citations.Source("Document citation", file_id=f"assistant-{i:06d}", quote=""))
+        elif i % 10 == 8:
+            out.append(citations.Source(f"Contoso Q3 results, part {i}", f"https://news.contoso.example/2026/10/{i}",
+                                        publisher="Contoso News", date="2026-10-16"))
+        else:
+            out.append(citations.Source("Source", f"https://www.example.com/articles/{i}?utm=agent"))
+    return out
+
+def legacy(answer_md: str, sources: list) -> bytes:
+    payload = {
+        "answer": answer_md,
+        "answer_md": answer_md,
+        "sources": [s.as_dict() for s in sources],   # the dicts _collect_last_assistant used to build
+        "thread_id": "thread_abc123",
+        "agent_id": "asst_search"
+    }
+    return json.dumps(payload).encode()
+
+def current(answer_md: str, sources: list) -> bytes:
+    return payloads.dumps(payloads.Answer(answer=answer_md, answer_md=answer_md, sources=sources,
+                                          thread_id="thread_abc123", agent_id="asst_search"))
+
+def current_json(answer_md: str, sources: list) -> bytes:
+    saved, payloads.orjson = payloads.orjson, None
+    try:
+        return current(answer_md, sources)
+    finally:
+        payloads.orjson = saved
+
+def _best_of(fn, args, repeat: int) -> tuple[float, int]:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, len(out)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    ap.add_argument("--repeat", type=int, default=10)
+    args = ap.parse_args()
+
+    answer_md = "Here is what I found. " * 40
+    variants = [("legacy", legacy), ("models json", current_json)]
+    if payloads.orjson is not None:
+        variants.append(("models orjson", current))
+    print(f"{'sources':>8}  " + "".join(f"{name + ' ms':>18}{'bytes':>10}" for name, _ in variants))
+    for n in args.sizes:
+        sources = make_sources(n)
+        assert json.loads(legacy(answer_md, sources))["sources"][0]["url"] == json.loads(current(answer_md, sources))["sources"][0]["url"]
+        cells = []
+        for _, fn in variants:
+            secs, size = _best_of(fn, (answer_md, sources), args.repeat)
+            cells.append(f"{secs * 1000:>18.3f}{size:>10}")
+        print(f"{n:>8}  " + "".join(cells))
+
+if __name__ == "__main__":
+    main()
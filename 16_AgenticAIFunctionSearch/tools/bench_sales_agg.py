@@ -0,0 +1,170 @@
+"""
+Benchmark: secured-search aggregation, the original per-row loops vs. sales_agg.
+
+The original loops (copied below) call the RLS guard on every row; sales_agg calls it once per
+distinct Region value. Generates synthetic SalesData rows (with a sprinkle of malformed values),
+checks that both give the same totals on them and on a set of edge rows (bools, "nan" strings,
+empty strings, huge ints, missing fields), and prints the timings.
+
+    python tools/bench_sales_agg.py                 # 100k, 300k, 1M rows
+    python tools/bench_sales_agg.py --rows 250000
+"""
+import argparse
+import math
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import sales_agg  # noqa: E402
+
+PRODUCTS = ["Mobile Plan A", "Mobile Plan B", "Mobile Plan C", "Internet 50Mbps", "Internet 100Mbps",
+            "TV Package Basic", "TV Package Premium", "Data Booster 1GB", "Roaming Pack", "Home Phone",
+            "Unlimited Data Plan", "International Call Pack", "Smart Home Bundle", "Gaming Addon Pack", "Student Plan"]
+REGIONS = ["region1", "region2", "region3", "region4"]
+
+EDGE_ROWS = [
+    {"Region": "region2", "Product": "A", "UnitSold": "x", "TotalRevenue": 5},
+    {"Region": "region2", "Product": "A", "UnitSold": True, "TotalRevenue": 1},
+    {"Region": "region2", "Product": "B", "UnitSold": "nan", "TotalRevenue": "nan"},
+    {"Region": "Region 2", "Product": "C", "UnitSold": "", "TotalRevenue": ""},
+    {"Region": "region2", "Product": "C", "UnitSold": " 7 ", "TotalRevenue": "1e3"},
+    {"Region": "region2", "Product": "D", "UnitSold": 10 ** 400, "TotalRevenue": 3},
+    {"Region": "region2", "Product": "d", "UnitSold": None, "TotalRevenue": 10 ** 400},
+    {"Region": None, "Product": "E", "UnitSold": 2, "TotalRevenue": None},
+    {"Product": "E", "UnitSold": 3},
+    {"Region": "region3", "Product": "A", "UnitSold": 100, "TotalRevenue": 100},
+    {"Region": "region2", "Product": "", "UnitSold": 1, "TotalRevenue": 1},
+    {"Region": "region2", "Product": "F", "UnitSold": "inf", "TotalRevenue": False},
+]
+
+def _norm_region(s: str) -> str:
+    # same RLS guard as function_app._region_in_scope
+    return re.sub(r"[^a-z0-9]", "", s.lower()) if isinstance(s, str) else ""
+
+def _region_in_scope(doc_region: str, scope: str) -> bool:
+    return _norm_region(doc_region) == _norm_region(scope)
+
+# -------------------- original loops --------------------
+
+def legacy_product_totals(docs, allow_revenue: bool, region_ok=None) -> dict:
+    totals = {}
+    for doc in docs:
+        if region_ok and not region_ok(doc.get("Region", "")):
+            continue
+        prod = doc.get("Product")
+        units = doc.get("UnitSold") or 0
+        rev = doc.get("TotalRevenue") if allow_revenue else None
+        if not prod:
+            continue
+        try:
+            units = float(units)
+        except Exception:
+            continue
+        if prod not in totals:
+            totals[prod] = {"UnitSold": 0.0, "TotalRevenue": 0.0 if allow_revenue else None}
+        totals[prod]["UnitSold"] += units
+        if allow_revenue and rev is not None:
+            try:
+                totals[prod]["TotalRevenue"] += float(rev)
+            except Exception:
+                pass
+    return totals
+
+def legacy_product_revenue(docs, product_name: str, region_ok=None) -> tuple[bool, float]:
+    norm_target = (product_name or "").strip().lower()
+    total, matched = 0.0, False
+    for doc in docs:
+        if region_ok and not region_ok(doc.get("Region", "")):
+            continue
+        prod = (doc.get("Product") or "").strip()
+        if prod.lower() != norm_target:
+            continue
+        matched = True
+        rev = doc.get("TotalRevenue")
+        try:
+            if rev is not None:
+                total += float(rev)
+        except Exception:
+            pass
+    return matched, total
+
+# -------------------- timing --------------------
+
+def make_rows(n: int, seed: int = 7, bad_ratio: float = 0.001) -> list[dict]:
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        units = rnd.randint(1, 200)
+        revenue = units * rnd.choice([5, 20, 30, 50, 80, 120])
+        r = rnd.random()
+        if r < bad_ratio:
+            units = "n/a"
+        elif r < 2 * bad_ratio:
+            revenue = None
+        elif r < 3 * bad_ratio:
+            units = str(units)
+        rows.append({"Id": str(i), "Region": rnd.choice(REGIONS), "Product": rnd.choice(PRODUCTS),
+                     "UnitSold": units, "TotalRevenue": revenue})
+    return rows
+
+def _best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def _same_number(x, y) -> bool:
+    if x is None or y is None:
+        return x is y
+    return (math.isnan(x) and math.isnan(y)) or x == y
+
+def _same(a, b) -> bool:
+    if isinstance(a, tuple):
+        return a[0] == b[0] and _same_number(a[1], b[1])
+    return list(a) == list(b) and all(_same_number(a[k][m], b[k][m]) for k in a for m in ("UnitSold", "TotalRevenue"))
+
+def check_edge_rows() -> bool:
+    ok = True
+    for scope in (None, "region2"):
+        guard = (lambda r, s=scope: _region_in_scope(r, s)) if scope else None
+        for allow_revenue in (True, False):
+            a = legacy_product_totals(EDGE_ROWS, allow_revenue, guard)
+            b = sales_agg.product_totals(EDGE_ROWS, allow_revenue, guard)
+            ok &= _same(a, b)
+        for product in ("a", "c", "d", "f"):
+            ok &= _same(legacy_product_revenue(EDGE_ROWS, product, guard), sales_agg.product_revenue(EDGE_ROWS, product, guard))
+    return ok
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, nargs="*", default=[100_000, 300_000, 1_000_000])
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    if not check_edge_rows():
+        sys.exit("edge rows: sales_agg and the original loops disagree")
+    print("edge rows: same totals")
+
+    region_ok = lambda r: _region_in_scope(r, "region2")  # noqa: E731
+    print(f"{'rows':>9}  {'case':<26}{'loop s':>9}{'sales_agg s':>13}{'speed-up':>10}")
+    for n in args.rows:
+        rows = make_rows(n)
+        cases = [
+            ("popular_product (all)", lambda f: f(rows, True), legacy_product_totals, sales_agg.product_totals),
+            ("popular_product (region)", lambda f: f(rows, True, region_ok), legacy_product_totals, sales_agg.product_totals),
+            ("product_revenue (region)", lambda f: f(rows, "data booster 1gb", region_ok),
+             legacy_product_revenue, sales_agg.product_revenue),
+        ]
+        for name, call, old_fn, new_fn in cases:
+            old = lambda call=call, f=old_fn: call(f)  # noqa: E731
+            new = lambda call=call, f=new_fn: call(f)  # noqa: E731
+            assert _same(old(), new()), name
+            t_old, t_new = _best_of(old, args.repeat), _best_of(new, args.repeat)
+            print(f"{n:>9}  {name:<26}{t_old:>9.3f}{t_new:>13.3f}{t_old / t_new:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
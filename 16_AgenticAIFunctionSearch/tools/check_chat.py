@@ -0,0 +1,404 @@
+"""
+Offline checks for the chat helpers in function_app, against an in-process agent service.
+
+_Agents stands in for client.agents (aio): runs.get walks a scripted list of run states, and
+runs.stream replays scripted events (a float in the script is a pause of that many seconds).
+Every call is recorded, so a check can tell what the handler asked the service to do.
+
+    python tools/check_chat.py              # all scenarios
+    python tools/check_chat.py gate         # some of them
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import types
+
+os.environ.setdefault("AGENT_ID", "asst_standin")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import azure.functions as func  # noqa: E402
+from azure.ai.agents.models import MessageDeltaChunk, ThreadRun  # noqa: E402
+
+import function_app as fa  # noqa: E402
+
+# -------------------- fake agent service --------------------
+
+def _run(status: str, **fields) -> ThreadRun:
+    return ThreadRun({"id": "run_1", "thread_id": "thread_1", "status": status, **fields})
+
+def _needs(*calls) -> dict:
+    """required_action fields of a run waiting for outputs of calls (("function", name) / ("azure_function", name))."""
+    return {"required_action": {"type": "submit_tool_outputs", "submit_tool_outputs": {"tool_calls": [
+        {"id": f"call_{i}", "type": kind, kind: {"name": name, "arguments": "{}"}} for i, (kind, name) in enumerate(calls)]}}}
+
+def _delta(text: str) -> MessageDeltaChunk:
+    return MessageDeltaChunk({"id": "msg_1", "delta": {"content": [{"index": 0, "type": "text", "text": {"value": text}}]}})
+
+class _Stream:
+    def __init__(self, script: list):
+        self.script = script
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for item in self.script:
+            if isinstance(item, float):
+                await asyncio.sleep(item)
+            else:
+                yield type(item).__name__, item, None
+
+class _Agents:
+    """
+    Stand-in for client.agents. runs.create, then each runs.get, return the next of states (the
+    last one repeats). runs.create_and_process waits run_secs and completes, or raises error.
+    Threads get new ids; messages.create keeps (thread_id, content) in posted.
+    """
+
+    def __init__(self, states=(), stream=(), answer: str = "Stand-in answer.", run_secs: float = 0.0,
+                 error: Exception | None = None):
+        self.states = list(states)
+        self.script = list(stream)
+        self.run_secs = run_secs
+        self.error = error
+        self.calls = []
+        self.posted = []
+        self.deleted = []
+        seq = iter(range(1, 1 << 30))
+        message = types.SimpleNamespace(role="assistant", run_id="run_1", content=[types.SimpleNamespace(
+            text=types.SimpleNamespace(value=answer, annotations=[]))])
+
+        def record(op, result=None):
+            async def call(*args, **kw):
+                self.calls.append(op)
+                return result(*args, **kw) if callable(result) else result
+            return call
+
+        async def messages(**kw):
+            self.calls.append("messages.list")
+            yield message
+
+        async def stream(**kw):
+            self.calls.append("runs.stream")
+            return _Stream(self.script)
+
+        async def create_and_process(**kw):
+            self.calls.append("runs.create_and_process")
+            await asyncio.sleep(self.run_secs)
+            if self.error is not None:
+                raise self.error
+            return _run("completed")
+
+        self.threads = types.SimpleNamespace(create=record("threads.create", lambda **kw: types.SimpleNamespace(id=f"thread_{next(seq)}")),
+                                             delete=record("threads.delete", self.deleted.append))
+        self.messages = types.SimpleNamespace(create=record("messages.create", lambda **kw: self.posted.append((kw["thread_id"], kw["content"]))),
+                                              list=messages)
+        self.runs = types.SimpleNamespace(create=record("runs.create", lambda **kw: self._next()),
+                                          get=record("runs.get", lambda **kw: self._next()),
+                                          cancel=record("runs.cancel", lambda **kw: _run("cancelling")),
+                                          create_and_process=create_and_process, stream=stream)
+
+    def _next(self) -> ThreadRun:
+        return self.states.pop(0) if len(self.states) > 1 else self.states[0]
+
+async def _settle():
+    """Wait for function_app's background tasks (refills, compactions, batches)."""
+    while fa._background:
+        await asyncio.gather(*list(fa._background), return_exceptions=True)
+
+def _use(agents):
+    """Point function_app at agents (returns what to hand back to _restore)."""
+    saved = fa.client, fa.init_error, fa._init_done, fa.CHAT_RUN_POLL_SECS
+    fa.client, fa.init_error, fa._init_done, fa.CHAT_RUN_POLL_SECS = types.SimpleNamespace(agents=agents), None, True, 0.01
+    return saved
+
+def _restore(saved):
+    fa.client, fa.init_error, fa._init_done, fa.CHAT_RUN_POLL_SECS = saved
+
+async def _post(body: dict, headers: dict | None = None) -> tuple[int, dict, dict]:
+    """(status, payload, headers) of POST /api/chat, on the running loop."""
+    req = func.HttpRequest(method="POST", url="/api/chat", headers={"x-user-role": "user", **(headers or {})},
+                           body=json.dumps(body).encode())
+    r = await fa.chat(req)
+    return r.status_code, json.loads(r.get_body() or b"{}"), dict(r.headers)
+
+def _chat(body: dict, headers: dict | None = None) -> tuple[int, dict, float]:
+    """(status, payload, seconds) of POST /api/chat."""
+    t0 = time.monotonic()
+    status, out, _ = asyncio.run(_post(body, headers))
+    return status, out, time.monotonic() - t0
+
+def _check(name: str, ok: bool, detail: str) -> bool:
+    print(f"{'ok ' if ok else 'FAIL'} {name:<36}{detail}")
+    return ok
+
+# -------------------- scenarios --------------------
+
+def check_run_action() -> list:
+    """A run with a deadline that stops on requires_action it can't meet is cancelled at once (502), not polled to a 504."""
+    results = []
+    for label, fields in (("function tool", _needs(("function", "get_weather"))),
+                          ("no tool calls", _needs()),
+                          ("other action", {"required_action": {"type": "open_browser"}})):
+        agents = _Agents([_run("queued"), _run("requires_action", **fields)])
+        saved = _use(agents)
+        try:
+            status, out, secs = _chat({"input": f"weather? ({label})"}, {fa.CHAT_DEADLINE_HEADER: "5"})
+        finally:
+            _restore(saved)
+        results.append(_check(f"requires_action {label}", status == 502 and out.get("status") == "cancelled"
+                              and agents.calls.count("runs.cancel") == 1 and secs < 1,
+                              f"{status} after {secs:.2f} s, {agents.calls.count('runs.cancel')} cancel(s): {out.get('detail')}"))
+    # tools the service runs itself (azure_function) are waited for, as create_and_process does
+    agents = _Agents([_run("queued"), _run("requires_action", **_needs(("azure_function", "lookup"))),
+                      _run("in_progress"), _run("completed")])
+    saved = _use(agents)
+    try:
+        status, out, _ = _chat({"input": "lookup"}, {fa.CHAT_DEADLINE_HEADER: "5"})
+    finally:
+        _restore(saved)
+    results.append(_check("requires_action azure_function", status == 200 and out.get("answer") == "Stand-in answer."
+                          and "runs.cancel" not in agents.calls, f"{status}, {agents.calls.count('runs.get')} poll(s)"))
+    return results
+
+def _frames(agents, deadline_secs: float | None) -> tuple[list, float]:
+    saved = _use(agents)
+    deadline = None if deadline_secs is None else time.monotonic() + deadline_secs
+
+    async def collect():
+        return [frame async for frame in fa._stream_run("thread_1", "asst_1", "q", deadline=deadline)]
+    t0 = time.monotonic()
+    try:
+        frames = asyncio.run(collect())
+    finally:
+        _restore(saved)
+    return frames, time.monotonic() - t0
+
+def check_stream_deadline() -> list:
+    """A stream that goes quiet is cut off at the deadline (not at its next event), and the run is cancelled."""
+    agents = _Agents(stream=[_run("in_progress"), _delta("Part"), 5.0, _delta("ial"), _run("completed")])
+    frames, secs = _frames(agents, 0.3)
+    last = frames[-1] if frames else {}
+    results = [_check("stream quiet past deadline", last.get("timed_out") is True and secs < 1
+                      and agents.calls.count("runs.cancel") == 1,
+                      f"{len(frames)} frame(s) in {secs:.2f} s, last {last.get('type')}: {last.get('detail')}")]
+    agents = _Agents(stream=[_run("in_progress"), _delta("Stand-in "), _delta("answer."), _run("completed")])
+    frames, _ = _frames(agents, 5)
+    final = frames[-1] if frames else None
+    results.append(_check("stream within deadline", getattr(final, "type", None) == "final"
+                          and [f["text"] for f in frames[:-1]] == ["Stand-in ", "answer."], f"{len(frames)} frame(s)"))
+    return results
+
+def check_stream_action() -> list:
+    """A streamed run stopping on a function tool call is cancelled with an error frame."""
+    agents = _Agents(stream=[_run("in_progress"), _run("requires_action", **_needs(("function", "get_weather"))), 5.0])
+    frames, secs = _frames(agents, None)
+    last = frames[-1] if frames and isinstance(frames[-1], dict) else {}
+    return [_check("stream requires_action", last.get("type") == "error" and "get_weather" in last.get("detail", "")
+                   and agents.calls.count("runs.cancel") == 1 and secs < 1, f"{secs:.2f} s: {last.get('detail')}")]
+
+def _swap(**values) -> dict:
+    """Set function_app globals, returning their old values for _unswap."""
+    saved = {name: getattr(fa, name) for name in values}
+    for name, value in values.items():
+        setattr(fa, name, value)
+    return saved
+
+def _unswap(saved: dict):
+    for name, value in saved.items():
+        setattr(fa, name, value)
+
+def _gated(agents, scenario, max_queued: int = 4, wait_secs: float = 5.0):
+    """asyncio.run(scenario()) against agents, behind a fresh _ThreadGate."""
+    saved, swapped = _use(agents), _swap(_thread_gate=fa._ThreadGate(max_queued, wait_secs))
+    try:
+        return asyncio.run(scenario())
+    finally:
+        _unswap(swapped)
+        _restore(saved)
+
+async def _burst(texts: list, thread_id: str = "thread_x", gap: float = 0.05, headers: dict | None = None) -> list:
+    """POST texts to one thread: the first, then the rest together gap seconds later (while it runs)."""
+    first = asyncio.create_task(_post({"input": texts[0], "thread_id": thread_id}, headers))
+    await asyncio.sleep(gap)
+    rest = [asyncio.create_task(_post({"input": t, "thread_id": thread_id}, headers)) for t in texts[1:]]
+    out = await asyncio.gather(first, *rest)
+    await _settle()
+    return out
+
+def check_gate() -> list:
+    """One run per thread: messages sent while it runs share the next run; a full queue is 429; errors and timeouts free the thread."""
+    results = []
+    agents = _Agents(run_secs=0.2)
+    out = _gated(agents, lambda: _burst(["one", "two", "three"]))
+    runs = agents.calls.count("runs.create_and_process")
+    results.append(_check("gate coalesces", [s for s, _, _ in out] == [200] * 3 and runs == 2
+                          and [o.get("coalesced") for _, o, _ in out] == [None, True, True]
+                          and [t for _, t in agents.posted] == ["one", "two", "three"],
+                          f"{runs} runs for 3 messages, coalesced {[o.get('coalesced') for _, o, _ in out]}"))
+
+    agents = _Agents(run_secs=0.2)
+    out = _gated(agents, lambda: _burst(["one", "two", "three"]), max_queued=1)
+    (s1, _, _), (s2, _, _), (s3, busy, headers) = out
+    results.append(_check("gate full queue 429", (s1, s2, s3) == (200, 200, 429)
+                          and headers.get("Retry-After") == str(fa.CHAT_BUSY_RETRY_SECS)
+                          and busy.get("retry_after") == fa.CHAT_BUSY_RETRY_SECS and "three" not in [t for _, t in agents.posted],
+                          f"{(s1, s2, s3)}, Retry-After {headers.get('Retry-After')}: {busy.get('detail')}"))
+
+    agents = _Agents(run_secs=0.3)
+    out = _gated(agents, lambda: _burst(["one", "two"]), wait_secs=0.1)
+    (s1, _, _), (s2, busy, headers) = out
+    results.append(_check("gate wait expires 429", (s1, s2) == (200, 429) and "Retry-After" in headers
+                          and [t for _, t in agents.posted] == ["one"], f"{(s1, s2)}: {busy.get('detail')}"))
+
+    agents = _Agents(run_secs=0.1, error=RuntimeError("service unavailable"))
+
+    async def error_then_retry():
+        out = await _burst(["one", "two"])
+        agents.error = None
+        return out + [await _post({"input": "three", "thread_id": "thread_x"})], fa._thread_gate.busy("thread_x")
+    out, busy_after = _gated(agents, error_then_retry)
+    statuses = [s for s, _, _ in out]
+    results.append(_check("gate released after error", statuses == [500, 500, 200] and not busy_after,
+                          f"{statuses}, busy afterwards: {busy_after}"))
+
+    agents = _Agents([_run("queued"), _run("in_progress")])
+
+    async def timeout_then_retry():
+        first = await _post({"input": "one", "thread_id": "thread_x"}, {fa.CHAT_DEADLINE_HEADER: "0.2"})
+        busy_after = fa._thread_gate.busy("thread_x")
+        agents.states = [_run("completed")]
+        return [first, await _post({"input": "two", "thread_id": "thread_x"})], busy_after
+    out, busy_after = _gated(agents, timeout_then_retry)
+    statuses = [s for s, _, _ in out]
+    results.append(_check("gate released after timeout", statuses == [504, 200] and not busy_after
+                          and agents.calls.count("runs.cancel") == 1, f"{statuses}, busy afterwards: {busy_after}"))
+    return results
+
+def check_compactions() -> list:
+    """A compacted copy is used once ready; a message to the original meanwhile discards it; a failure leaves the original."""
+    results = []
+    agents = _Agents(answer="Summary text.")
+    compactions = fa._Compactions(1, 60)
+    saved, swapped = _use(agents), _swap(_compactions=compactions)
+
+    async def scenario():
+        compactions.schedule("thread_a", "asst_1")
+        await _settle()
+        copy = compactions.resolve("thread_a")
+        ready = copy, compactions.resolve("thread_a")
+
+        compactions.schedule("thread_b", "asst_1")
+        compactions.touch("thread_b")   # posted to the original while the copy is being made
+        await _settle()
+        stale = compactions.resolve("thread_b"), "thread_b" in compactions._state
+
+        compactions.schedule("thread_c", "asst_1")
+        await _settle()
+        compactions.touch("thread_c")   # ...or after it is ready but before the next message moved over
+        await _settle()
+        touched = compactions.resolve("thread_c")
+
+        agents.error = RuntimeError("summary run failed")
+        compactions.schedule("thread_d", "asst_1")
+        await _settle()
+        return ready, stale, touched, compactions.resolve("thread_d"), "thread_d" in compactions._state
+    try:
+        (copy, again), stale, touched, failed, pending = asyncio.run(scenario())
+    finally:
+        _unswap(swapped)
+        _restore(saved)
+    summary = [c for t, c in agents.posted if t == copy]
+    results.append(_check("compaction copy used", copy not in ("thread_a", None) and again == copy
+                          and summary[:1] == ["Summary of our earlier conversation:\n\nSummary text."],
+                          f"thread_a -> {copy}, seeded with {summary[:1]}"))
+    results.append(_check("compaction stale copy dropped", stale == ("thread_b", False) and touched == "thread_c",
+                          f"resolve {stale[0]} / {touched}, {len(agents.deleted)} thread(s) deleted (scratch and stale copies)"))
+    results.append(_check("compaction failure keeps original", failed == "thread_d" and not pending,
+                          f"resolve {failed}, pending {pending}"))
+    return results
+
+def check_thread_pool() -> list:
+    """First turns take a pre-created thread; take() refills in the background; expired threads are deleted, not handed out."""
+    agents = _Agents()
+    pool, stale = fa._ThreadPool(2, 60), fa._ThreadPool(2, 0.05)
+    saved, swapped = _use(agents), _swap(_thread_pool=pool)
+
+    async def scenario():
+        pool.fill()
+        await _settle()
+        pooled = [t for _, t in pool._items]
+        created = agents.calls.count("threads.create")
+        status, out, _ = await _post({"input": "first turn"})
+        await _settle()
+        refilled = [t for _, t in pool._items]
+        taken = [pool.take() for _ in range(3)]   # the refill started by the first take hasn't run yet
+        await _settle()
+        stale.fill()
+        await _settle()
+        expired = [t for _, t in stale._items]
+        await asyncio.sleep(0.1)
+        late = stale.take()
+        await _settle()
+        return pooled, created, (status, out), refilled, taken, expired, late
+    try:
+        pooled, created, (status, out), refilled, taken, expired, late = asyncio.run(scenario())
+    finally:
+        _unswap(swapped)
+        _restore(saved)
+    return [_check("pool first turn", status == 200 and out.get("thread_id") == pooled[0] and created == 2,
+                   f"answered on pooled {out.get('thread_id')}, {created} thread(s) created ahead"),
+            _check("pool refills", taken == refilled + [None] and len(pool._items) == 2
+                   and pool.stats["hits"] == 3 and pool.stats["misses"] == 1,
+                   f"takes {taken}, {len(pool._items)} pooled after refill, stats {pool.stats}"),
+            _check("pool ttl", late is None and stale.stats["expired"] == 2 and set(expired) <= set(agents.deleted)
+                   and len(stale._items) == 2, f"take after ttl {late}, deleted {sorted(set(expired) & set(agents.deleted))}")]
+
+def check_answer_cache() -> list:
+    """Repeated first-turn prompts are answered from the cache until the ttl passes; the least recently used entry goes first."""
+    agents = _Agents()
+    saved = _use(agents)
+    swapped = _swap(_answer_cache=fa._TTLCache(0.3, 2), CHAT_ANSWER_CACHE_TTL=0.3, CHAT_ANSWER_CACHE_TTLS={})
+    runs = lambda: agents.calls.count("runs.create_and_process")  # noqa: E731
+
+    async def cached(text: str):
+        before = runs()
+        status, out, _ = await _post({"input": text})
+        return status == 200 and out.get("cached") is True and runs() == before
+
+    async def scenario():
+        hits = [await cached("What is the plan?"), await cached("  what is the PLAN ")]
+        await asyncio.sleep(0.35)
+        hits.append(await cached("What is the plan?"))
+        lru = [await cached(t) for t in ("Plan A?", "Plan B?", "Plan A?", "Plan C?", "Plan B?", "Plan C?")]
+        fa.CHAT_ANSWER_CACHE_TTLS = {"asst_standin": 0}   # per-agent override: not cached for this agent
+        off = [await cached("Plan D?"), await cached("Plan D?")]
+        return hits, lru, off
+    try:
+        hits, lru, off = asyncio.run(scenario())
+    finally:
+        _unswap(swapped)
+        _restore(saved)
+    return [_check("answer cache hit", hits[:2] == [False, True], f"hits {hits[:2]}"),
+            _check("answer cache ttl", hits[2] is False, "run again once the ttl has passed"),
+            _check("answer cache eviction", lru == [False, False, True, False, False, True],
+                   f"A B A C B C -> {lru} (C evicts B, the least recently used)"),
+            _check("answer cache agent ttl 0", off == [False, False], f"{off}")]
+
+SCENARIOS = {"run_action": check_run_action, "stream_deadline": check_stream_deadline, "stream_action": check_stream_action,
+             "gate": check_gate, "compactions": check_compactions, "thread_pool": check_thread_pool,
+             "answer_cache": check_answer_cache}
+
+def main():
+    names = sys.argv[1:] or list(SCENARIOS)
+    results = []
+    for name in names:
+        results += SCENARIOS[name]()
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    main()
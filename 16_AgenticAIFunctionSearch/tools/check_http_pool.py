@@ -0,0 +1,202 @@
+"""
+Local stand-in for the search endpoint and Graph, to check the pooled HTTP sessions offline.
+
+The server speaks HTTP/1.1 with keep-alive and counts the TCP connections it accepts, so the
+numbers don't depend on aiohttp's own counters (function_app._http_stats, also printed).
+Scenarios: five-page scans (skip, keyset, concurrent) against a fresh session, the same scan
+with a new connection per request as before the sessions existed, a 503 / 429 on search (retried),
+a refused connection (raised as requests.ConnectionError), and a 503 / 429 on Graph sendMail
+(only the 429 is retried).
+
+    python tools/check_http_pool.py
+    python tools/check_http_pool.py --docs 4500 --batch 1000 --latency-ms 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# -------------------- server --------------------
+
+class SearchStandIn:
+    """/indexes/<index>/docs/search over n synthetic documents, plus /v1.0/me/sendMail."""
+
+    def __init__(self, docs: int, latency: float):
+        self.docs = [{"Id": f"{i:08d}", "Region": f"region{i % 4 + 1}", "Product": f"P{i % 7}", "UnitSold": i % 5 + 1}
+                     for i in range(docs)]
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+        self.fail = []            # statuses to answer with before serving normally
+        self._lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep the connection open between requests
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with standin._lock:
+                    standin.connections += 1
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with standin._lock:
+                    standin.requests += 1
+                    status = standin.fail.pop(0) if standin.fail else 200
+                if status != 200:
+                    return standin._reply(self, status, {"error": "busy"}, {"Retry-After": "0"})
+                if urlsplit(self.path).path.endswith("/sendMail"):
+                    return standin._reply(self, 202, None)
+                time.sleep(standin.latency)
+                standin._reply(self, 200, standin._search(body))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _search(self, body: dict) -> dict:
+        docs = self.docs
+        flt = body.get("filter") or ""
+        if "Id gt '" in flt:
+            last = flt.split("Id gt '", 1)[1].split("'", 1)[0]
+            docs = [d for d in docs if d["Id"] > last]
+        out = {"value": docs[body.get("skip", 0):][:body.get("top", 50)]}
+        if body.get("count"):
+            out["@odata.count"] = len(docs)
+        return out
+
+    @staticmethod
+    def _reply(h: BaseHTTPRequestHandler, status: int, payload, headers: dict | None = None):
+        data = json.dumps(payload).encode() if payload is not None else b""
+        h.send_response(status)
+        h.send_header("Content-Type", "application/json")
+        h.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            h.send_header(k, v)
+        h.end_headers()
+        h.wfile.write(data)
+
+    def snapshot(self) -> tuple[int, int]:
+        with self._lock:
+            return self.connections, self.requests
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# -------------------- scenarios --------------------
+
+def _check(name: str, ok: bool, detail: str) -> bool:
+    print(f"{'ok ' if ok else 'FAIL'} {name:<30}{detail}")
+    return ok
+
+async def _scan(fa, srv, **kw) -> tuple[int, int, int]:
+    """(docs, connections opened, requests) for one full scan."""
+    c0, r0 = srv.snapshot()
+    docs = 0
+    async for _ in fa._iterate_search_batches(["Id", "Product"], max_docs=0, **kw):
+        docs += 1
+    c1, r1 = srv.snapshot()
+    return docs, c1 - c0, r1 - r0
+
+async def _fresh_sessions(fa):
+    """Close the pooled sessions so the next call opens new ones."""
+    for _, session, _ in list(fa._aio_sessions.values()):
+        await session.close()
+    fa._aio_sessions.clear()
+
+def run(args) -> bool:
+    return asyncio.run(_run(args))
+
+async def _run(args) -> bool:
+    srv = SearchStandIn(args.docs, args.latency_ms / 1000)
+    os.environ["AZURE_SEARCH_ENDPOINT"] = f"http://127.0.0.1:{srv.port}"
+    os.environ["GRAPH_ENDPOINT"] = f"http://127.0.0.1:{srv.port}/v1.0"
+    os.environ.setdefault("HTTP_RETRY_BACKOFF", "0")
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import aiohttp
+    import function_app as fa
+    import requests
+
+    pages = -(-args.docs // args.batch)
+    results = []
+    for paging, workers in (("skip", 1), ("keyset", 1), ("skip", args.workers)):
+        await _fresh_sessions(fa)
+        label = f"{paging} x{workers}"
+        docs, opened, sent = await _scan(fa, srv, batch=args.batch, paging=paging, workers=workers)
+        expect = 1 if workers == 1 else min(workers, pages)
+        results.append(_check(f"{label} cold", docs == args.docs and opened <= expect,
+                              f"{docs} docs, {sent} requests over {opened} connection(s); {fa._http_stats('search')}"))
+        docs, opened, sent = await _scan(fa, srv, batch=args.batch, paging=paging, workers=workers)
+        results.append(_check(f"{label} warm", docs == args.docs and opened == 0,
+                              f"{sent} requests over {opened} new connection(s)"))
+
+    # before the pooled sessions: a fresh connection per call
+    saved = fa._aio_session
+    unpooled = aiohttp.ClientSession(connector=aiohttp.TCPConnector(force_close=True))
+    fa._aio_session = lambda name: unpooled
+    try:
+        docs, opened, sent = await _scan(fa, srv, batch=args.batch, paging="skip", workers=1)
+    finally:
+        fa._aio_session = saved
+        await unpooled.close()
+    results.append(_check("unpooled (for comparison)", opened == sent, f"{sent} requests over {opened} connection(s)"))
+
+    # search: a 503 then a 429 are retried on the pooled connection
+    await _fresh_sessions(fa)
+    srv.fail = [503, 429]
+    docs, opened, sent = await _scan(fa, srv, batch=args.batch, paging="skip", workers=1)
+    results.append(_check("search 503/429 retried", docs == args.docs and sent == pages + 2,
+                          f"{docs} docs, {sent} requests over {opened} connection(s)"))
+
+    # search: nothing listening; the callers' requests.RequestException handling still applies
+    saved = fa.AZURE_SEARCH_ENDPOINT
+    fa.AZURE_SEARCH_ENDPOINT = "http://127.0.0.1:9"
+    try:
+        await fa._search_page({"search": "*", "top": 1})
+        outcome = "answered"
+    except requests.RequestException as e:
+        outcome = f"{type(e).__name__}: {str(e)[:60]}"
+    finally:
+        fa.AZURE_SEARCH_ENDPOINT = saved
+    results.append(_check("search refused", outcome.startswith("ConnectionError"), outcome))
+
+    # graph: a 503 is not retried (sendMail could have run), a 429 is
+    srv.fail = [503]
+    try:
+        await fa._graph_send_mail_as_user("token", "s", "<p>b</p>", ["a@contoso.example"])
+        outcome = "sent"
+    except RuntimeError as e:
+        outcome = str(e)
+    results.append(_check("graph 503 not retried", "503" in outcome and not srv.fail, outcome))
+    srv.fail = [429]
+    await fa._graph_send_mail_as_user("token", "s", "<p>b</p>", ["a@contoso.example"])
+    results.append(_check("graph 429 retried", not srv.fail, str(fa._http_stats("graph"))))
+
+    await _fresh_sessions(fa)
+    srv.close()
+    return all(results)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--docs", type=int, default=4500, help="documents in the index (4500 / 1000 = five pages)")
+    ap.add_argument("--batch", type=int, default=1000)
+    ap.add_argument("--workers", type=int, default=4, help="concurrent page fetches in the third scan")
+    ap.add_argument("--latency-ms", type=float, default=2)
+    args = ap.parse_args()
+    sys.exit(0 if run(args) else 1)
+
+if __name__ == "__main__":
+    main()
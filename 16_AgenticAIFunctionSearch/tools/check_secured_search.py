@@ -0,0 +1,490 @@
+"""
+Offline checks for the secured-search helpers in function_app, against an in-memory index.
+
+FakeIndex answers the /docs/search bodies the helpers send (select, filter, orderby, top, skip,
+count, plain "Field,count:N" facets) over a list of documents. Its $filter support covers what function_app writes: eq / ne /
+gt comparisons with string, number and null literals, search.in(...), and / or and parentheses.
+
+    python tools/check_secured_search.py            # all scenarios
+    python tools/check_secured_search.py rollup     # some of them
+"""
+import asyncio
+import logging
+import os
+import re
+import sys
+
+os.environ.setdefault("AZURE_SEARCH_ENDPOINT", "http://search.invalid")
+os.environ.setdefault("AZURE_SEARCH_API_KEY", "key")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import function_app as fa  # noqa: E402
+
+# -------------------- fake index --------------------
+
+_TOKEN_RE = re.compile(r"\s*(?:(?P<str>'(?:[^']|'')*')|(?P<num>-?\d+(?:\.\d+)?)|(?P<punct>[(),])|(?P<word>[\w.]+))")
+
+def _tokens(expr: str) -> list:
+    out, pos = [], 0
+    expr = expr.strip()
+    while pos < len(expr):
+        m = _TOKEN_RE.match(expr, pos)
+        if not m:
+            raise ValueError(f"bad filter at {expr[pos:]!r}")
+        pos = m.end()
+        if m.group("str") is not None:
+            out.append(("lit", m.group("str")[1:-1].replace("''", "'")))
+        elif m.group("num") is not None:
+            num = m.group("num")
+            out.append(("lit", float(num) if "." in num else int(num)))
+        elif m.group("punct"):
+            out.append((m.group("punct"), None))
+        elif m.group("word") == "null":
+            out.append(("lit", None))
+        else:
+            out.append(("word", m.group("word")))
+    return out
+
+class _Filter:
+    """Recursive-descent evaluator for the $filter subset (see module docstring)."""
+
+    def __init__(self, expr: str):
+        self.toks = _tokens(expr)
+        self.i = 0
+
+    def _next(self):
+        tok = self.toks[self.i]
+        self.i += 1
+        return tok
+
+    def _peek(self, word: str) -> bool:
+        return self.i < len(self.toks) and self.toks[self.i] == ("word", word)
+
+    def parse(self):
+        node = self._or()
+        if self.i != len(self.toks):
+            raise ValueError(f"trailing tokens {self.toks[self.i:]}")
+        return node
+
+    def _or(self):
+        left = self._and()
+        while self._peek("or"):
+            self.i += 1
+            left = (lambda a, b: lambda d: a(d) or b(d))(left, self._and())
+        return left
+
+    def _and(self):
+        left = self._atom()
+        while self._peek("and"):
+            self.i += 1
+            left = (lambda a, b: lambda d: a(d) and b(d))(left, self._atom())
+        return left
+
+    def _atom(self):
+        kind, val = self._next()
+        if kind == "(":
+            node = self._or()
+            assert self._next()[0] == ")"
+            return node
+        if val == "search.in":
+            assert self._next()[0] == "("
+            field = self._next()[1]
+            self._next()
+            values = self._next()[1]
+            sep = " ,"
+            if self._next()[0] == ",":
+                sep = self._next()[1]
+                self._next()
+            allowed = set(v for v in re.split("|".join(map(re.escape, sep)), values) if v)
+            return lambda d: d.get(field) in allowed
+        field, op, lit = val, self._next()[1], self._next()[1]
+        if op == "eq":
+            return lambda d: d.get(field) == lit
+        if op == "ne":
+            return lambda d: d.get(field) != lit
+        if op == "gt":
+            return lambda d: d.get(field) is not None and d.get(field) > lit
+        raise ValueError(f"unsupported operator {op}")
+
+class FakeIndex:
+    """
+    Stands in for fa._search_page (awaited like it; answer() is the same call for plain code) and
+    counts the requests it answers. facet_error is raised for facet requests.
+    """
+
+    def __init__(self, docs: list, facets: bool = True, facet_error: Exception | None = None):
+        self.docs = docs
+        self.facets = facets
+        self.facet_error = facet_error
+        self.requests = []
+
+    async def __call__(self, body: dict) -> dict:
+        return self.answer(body)
+
+    def answer(self, body: dict) -> dict:
+        self.requests.append(body)
+        docs = self.docs
+        if body.get("filter"):
+            keep = _Filter(body["filter"]).parse()
+            docs = [d for d in docs if keep(d)]
+        if body.get("orderby"):
+            field, _, order = body["orderby"].partition(" ")
+            docs = sorted(docs, key=lambda d: d.get(field), reverse=order.strip() == "desc")
+        out = {}
+        if body.get("count"):
+            out["@odata.count"] = len(docs)
+        for facet in body.get("facets") or []:
+            if self.facet_error is not None:
+                raise self.facet_error
+            if not self.facets:
+                raise fa.requests.HTTPError("facets disabled")
+            field, _, limit = facet.partition(",count:")
+            counts = {}
+            for d in docs:
+                counts[d.get(field)] = counts.get(d.get(field), 0) + 1
+            out.setdefault("@search.facets", {})[field] = [{"value": v, "count": n} for v, n in
+                                                            list(counts.items())[:int(limit or 10)]]
+        skip, top = body.get("skip", 0), body.get("top", 50)
+        cols = [c for c in (body.get("select") or "").split(",") if c]
+        out["value"] = [{c: d.get(c) for c in cols} if cols else dict(d) for d in docs[skip:skip + top]]
+        return out
+
+def _sales(n: int, first: int = 1) -> list:
+    return [{"Id": str(i), "IdNum": i, "Region": "region2" if i % 2 else "region3", "Product": f"Plan {i % 3}",
+             "UnitSold": 10, "TotalRevenue": 100.0} for i in range(first, first + n)]
+
+# -------------------- scenarios --------------------
+
+def _check(name: str, ok: bool, detail: str) -> bool:
+    print(f"{'ok ' if ok else 'FAIL'} {name:<36}{detail}")
+    return ok
+
+def _rollup_rows(cursor: str, docs: list) -> int:
+    """Rows in a rollup built over docs[:-1] and then refreshed once after docs[-1] was added."""
+    saved = fa._search_page, fa.SECURED_SEARCH_ROLLUP_CURSOR
+    index = FakeIndex(docs[:-1])
+    fa._search_page, fa.SECURED_SEARCH_ROLLUP_CURSOR = index, cursor
+    try:
+        rollup = fa._SalesRollup(batch=4)
+        asyncio.run(rollup.refresh(force=True))
+        index.docs = docs
+        rollup._refreshed_at -= fa.SECURED_SEARCH_ROLLUP_REFRESH_SECS
+        totals = asyncio.run(rollup.product_totals("*", allow_revenue=True))
+    finally:
+        fa._search_page, fa.SECURED_SEARCH_ROLLUP_CURSOR = saved
+    return sum(t["rows"] for t in totals.values())
+
+def check_rollup() -> list:
+    """Ids 1..20 built, Id 21 added: the refresh must cross the 9 -> 10 boundary of the string key."""
+    docs = _sales(21)
+    rows = _rollup_rows("IdNum", docs)
+    by_key = _rollup_rows("Id", docs)
+    return [_check("rollup picks up Id 21 (IdNum)", rows == 21, f"{rows} rows after refresh"),
+            _check("string key would miss it", by_key == 20, f"{by_key} rows with the Edm.String Id as cursor")]
+
+class _FailAfter:
+    """Answers like index for the first n requests, then raises ConnectionError."""
+
+    def __init__(self, index: FakeIndex, n: int):
+        self.index, self.n = index, n
+
+    async def __call__(self, body: dict) -> dict:
+        if len(self.index.requests) >= self.n:
+            raise fa.requests.ConnectionError("connection reset")
+        return self.index.answer(body)
+
+def check_rollup_failure() -> list:
+    """A rebuild that fails mid-scan keeps the previous build; invalidate() makes the next refresh a full rebuild."""
+    saved = fa._search_page, fa.SECURED_SEARCH_ROLLUP_CURSOR
+    index = FakeIndex(_sales(20))
+    fa._search_page, fa.SECURED_SEARCH_ROLLUP_CURSOR = index, "IdNum"
+    try:
+        rollup = fa._SalesRollup(batch=4)
+        asyncio.run(rollup.refresh(force=True))
+        index.requests.clear()
+        fa._search_page = _FailAfter(index, 2)
+        try:
+            asyncio.run(rollup.refresh(force=True))
+            raised = False
+        except fa.requests.ConnectionError:
+            raised = True
+        kept = sum(t["rows"] for t in asyncio.run(rollup.product_totals("*", allow_revenue=True)).values())
+
+        fa._search_page = index
+        index.docs = [dict(d, UnitSold=20) for d in index.docs]   # an indexer run updated rows in place
+        rollup._refreshed_at -= fa.SECURED_SEARCH_ROLLUP_REFRESH_SECS
+        rollup.invalidate()
+        units = sum(t["UnitSold"] for t in asyncio.run(rollup.product_totals("*", allow_revenue=False)).values())
+    finally:
+        fa._search_page, fa.SECURED_SEARCH_ROLLUP_CURSOR = saved
+    return [_check("failed rebuild keeps previous build", raised and kept == 20, f"{kept} rows after a failed rebuild"),
+            _check("invalidate rebuilds", units == 400, f"{units:.0f} units after invalidate (updated rows)")]
+
+class _FacetSend:
+    """Stands in for fa._http_send: records facet request bodies, answers with status."""
+
+    def __init__(self, status_code: int, payload):
+        self.bodies = []
+        self._reply = fa._Reply(status_code, {}, fa.json.dumps(payload).encode())
+
+    async def __call__(self, name, method, url, *, json=None, **kwargs):
+        self.bodies.append(json)
+        return self._reply
+
+class _Records(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def check_facet() -> list:
+    """
+    The facet expression separates sibling metrics with ";"; a rejected facet call is logged and
+    scanned instead, and later requests scan without asking again until the retry window is over.
+    """
+    saved = fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE
+    session = _FacetSend(400, {"error": {"message": "Invalid expression"}})
+    index = FakeIndex(_sales(12))
+    records = _Records()
+    logging.getLogger().addHandler(records)
+    fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE = session, index, "facet"
+    fa._facet_state["failed_at"] = float("-inf")
+    try:
+        totals = asyncio.run(fa._product_totals("*", allow_revenue=True))
+        again = asyncio.run(fa._product_totals("*", allow_revenue=True))
+        calls_in_window = len(session.bodies)
+        fa._facet_state["failed_at"] -= fa.AZURE_SEARCH_FACET_RETRY_SECS   # window over
+        asyncio.run(fa._product_totals("*", allow_revenue=True))
+    finally:
+        fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE = saved
+        fa._facet_state["failed_at"] = float("-inf")
+        logging.getLogger().removeHandler(records)
+    facet = session.bodies[0]["facets"][0]
+    expect = f"Product,count:{fa.AZURE_SEARCH_FACET_BUCKETS} > (UnitSold, metric: sum; TotalRevenue, metric: sum)"
+    warned = [r for r in records.records if r.levelno == logging.WARNING and "facet" in r.getMessage()]
+    return [_check("facet expression", facet == expect, facet),
+            _check("rejected facet logged as warning", bool(warned), warned[0].getMessage()[:60] if warned else "no warning"),
+            _check("scan answers instead", sum(t["UnitSold"] for t in totals.values()) == 120 and len(index.requests) > 0,
+                   f"{len(totals)} products from {len(index.requests)} page request(s)"),
+            _check("rejected facet not retried", calls_in_window == 1 and again == totals,
+                   f"{calls_in_window} facet call(s) for 2 requests inside the window"),
+            _check("facet retried after the window", len(session.bodies) == 2, f"{len(session.bodies)} facet call(s) in total")]
+
+class _FailingSend:
+    """Stands in for fa._http_send on a call that never gets an answer."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    async def __call__(self, name, method, url, **kwargs):
+        raise self.error
+
+def check_facet_transport() -> list:
+    """A facet call that fails in transport (reset, timeout, bad JSON) is scanned instead, not a 500."""
+    results = []
+    for error in (fa.requests.ConnectionError("connection reset"), fa.requests.Timeout("read timed out"),
+                  fa.requests.JSONDecodeError("Expecting value", "<html>", 0)):
+        saved = fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE
+        index = FakeIndex(_sales(12))
+        fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE = _FailingSend(error), index, "facet"
+        fa._facet_state["failed_at"] = float("-inf")
+        try:
+            totals = asyncio.run(fa._product_totals("*", allow_revenue=True))
+            units, detail = sum(t["UnitSold"] for t in totals.values()), f"{len(index.requests)} scan page(s)"
+        except Exception as e:
+            units, detail = None, f"raised {type(e).__name__}"
+        finally:
+            fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE = saved
+            fa._facet_state["failed_at"] = float("-inf")
+        results.append(_check(f"facet {type(error).__name__}", units == 120, detail))
+    return results
+
+def _facet_payload(docs: list) -> dict:
+    """A successful facet aggregation response, as the service sends it (nested results under "@search.facets")."""
+    buckets = {}
+    for d in docs:
+        b = buckets.setdefault(d["Product"], {"value": d["Product"], "count": 0, "@search.facets": {
+            "UnitSold": [{"sum": 0.0}], "TotalRevenue": [{"sum": 0.0}]}})
+        b["count"] += 1
+        for m in ("UnitSold", "TotalRevenue"):
+            b["@search.facets"][m][0]["sum"] += d[m]
+    return {"@odata.count": len(docs), "value": [], "@search.facets": {"Product": list(buckets.values())}}
+
+def check_facet_sums() -> list:
+    """An accepted facet aggregation answers by itself: no scan pages are requested."""
+    docs = _sales(12)
+    saved = fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE
+    session = _FacetSend(200, _facet_payload(docs))
+    index = FakeIndex(docs)
+    fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE = session, index, "facet"
+    try:
+        totals = asyncio.run(fa._product_totals("*", allow_revenue=True))
+    finally:
+        fa._http_send, fa._search_page, fa.SECURED_SEARCH_AGG_MODE = saved
+    units = sum(t["UnitSold"] for t in totals.values())
+    revenue = sum(t["TotalRevenue"] for t in totals.values())
+    return [_check("facet sums used", len(totals) == 3 and units == 120 and revenue == 1200 and not index.requests,
+                   f"{len(totals)} products, {units:.0f} units, {revenue:.0f} revenue, {len(index.requests)} scan page(s)")]
+
+def check_product_index() -> list:
+    """product_revenue when the Product facet fails: scan instead, and don't retry the facet on every request."""
+    results = []
+    for label, kw in (("not facetable", {"facets": False}),
+                      ("unreachable", {"facet_error": fa.requests.ConnectionError("connection reset")})):
+        saved = fa._search_page, fa.SECURED_SEARCH_AGG_MODE
+        index = FakeIndex(_sales(12), **kw)
+        fa._search_page, fa.SECURED_SEARCH_AGG_MODE = index, "scan"
+        fa._products.invalidate()
+        try:
+            answers = [asyncio.run(fa._search_total_revenue("*", "plan 1")) for _ in range(3)]
+        finally:
+            fa._search_page, fa.SECURED_SEARCH_AGG_MODE = saved
+            fa._products.invalidate()
+        facet_calls = sum(1 for b in index.requests if b.get("facets"))
+        results.append(_check(f"product facet {label}", all(a["found"] and a["total_revenue"] == 400 for a in answers)
+                              and facet_calls == 1, f"{answers[-1]}, {facet_calls} facet request(s) for 3 lookups"))
+    return results
+
+def check_regions() -> list:
+    """RLS pushdown matches stored spellings the way the client-side guard does."""
+    stored = ["Region-3", "region_3", "Region 3", "East", "region2", "Region3"]
+    docs = [dict(d, Region=stored[i % len(stored)]) for i, d in enumerate(_sales(60))]
+    results = []
+    for facets in (True, False):
+        saved = fa._search_page
+        fa._search_page = FakeIndex(docs, facets=facets)
+        fa._regions.invalidate()
+        try:
+            for scope in ("region3", "east"):
+                expect = sum(1 for d in docs if fa._region_in_scope(d["Region"], scope))
+                flt = asyncio.run(fa._region_filter(scope))
+                pushed = len(fa._search_page.answer({"filter": flt, "top": 1000}).get("value", [])) if flt else None
+                totals = asyncio.run(fa._scan_product_totals(scope, allow_revenue=False))
+                got = round(sum(t["UnitSold"] for t in totals.values()) / 10)
+                label = f"{scope} ({'facet' if facets else 'no facet'})"
+                results.append(_check(f"region {label}", got == expect and pushed in (expect, None),
+                                      f"{got}/{expect} rows, filter {'matches ' + str(pushed) if flt else 'not pushed down'}"))
+            if not facets:
+                fa._search_page.facets = True   # the product facet itself works; only the scope can't be pushed
+                results.append(_check("facet path scans instead", asyncio.run(fa._facet_product_totals("east", False)) is None,
+                                       "no unscoped facet aggregation"))
+        finally:
+            fa._search_page = saved
+            fa._regions.invalidate()
+    return results
+
+async def _ids(scan: dict, **kw) -> list:
+    return [d["IdNum"] async for d in fa._iterate_search_batches(["IdNum"], paging="skip", scan=scan, **kw)]
+
+def _page(index: FakeIndex, **kw) -> tuple[list, dict]:
+    saved = fa._search_page
+    fa._search_page, scan = index, {}
+    try:
+        ids = asyncio.run(_ids(scan, **kw))
+    finally:
+        fa._search_page = saved
+    return ids, scan
+
+def check_pager() -> list:
+    """The concurrent pager reads the count off the first page and fans out only past it."""
+    results = []
+    for docs, kw, pages, truncated in ((3, {"max_docs": 5000}, 1, False), (4, {"max_docs": 5000}, 1, False),
+                                       (10, {"max_docs": 5000}, 3, False), (10, {"max_docs": 6}, 2, True),
+                                       (10, {"max_docs": 4}, 1, True)):
+        index = FakeIndex(_sales(docs))
+        ids, scan = _page(index, batch=4, workers=4, **kw)
+        expect = list(range(1, min(docs, kw["max_docs"]) + 1))
+        skips = [b.get("skip") for b in index.requests]
+        results.append(_check(f"{docs} docs, max {kw['max_docs']}",
+                              ids == expect and len(index.requests) == pages and skips.count(0) == 1
+                              and scan["truncated"] == truncated,
+                              f"{len(ids)} docs in {len(index.requests)} request(s), skips {skips}, "
+                              f"truncated={scan['truncated']}"))
+    return results
+
+def _secured_search(body: dict) -> tuple[int, dict]:
+    req = fa.func.HttpRequest("POST", "/api/secured-search", headers={"x-user-role": "admin", "x-allowed-regions": "*",
+                              "x-allow-revenue": "true"}, body=fa.json.dumps(body).encode())
+    resp = asyncio.run(fa.secured_search(req))
+    return resp.status_code, fa.json.loads(resp.get_body())
+
+def check_query_input() -> list:
+    """query: a bare metric name is one metric; malformed sort / group_by answer 400, not 500."""
+    saved = fa._search_page, fa._agg_cache
+    fa._search_page, fa._agg_cache = FakeIndex(_sales(12)), fa._TTLCache(0, 0)
+    try:
+        results = []
+        status, out = _secured_search({"operation": "query", "metrics": "count"})
+        rows = (out.get("data") or {}).get("rows") or []
+        results.append(_check("metrics \"count\"", status == 200 and sum(r.get("count", 0) for r in rows) == 12,
+                              f"{status}, {len(rows)} groups"))
+        for label, extra in (("sort [\"x\"]", {"sort": ["x"]}), ("sort 5", {"sort": 5}), ("group_by 5", {"group_by": 5})):
+            status, out = _secured_search({"operation": "query", **extra})
+            results.append(_check(f"query {label}", status == 400, f"{status} {out.get('error')}"))
+    finally:
+        fa._search_page, fa._agg_cache = saved
+    return results
+
+def check_streaming() -> list:
+    """Scans fold rows into the aggregates a page at a time, with only a few pages fetched ahead."""
+    index = FakeIndex(_sales(9000))
+    folds = []   # (rows in the call, requests sent by then)
+    saved = fa._search_page, fa.SECURED_SEARCH_MAX_DOCS, fa.sales_agg.group_totals, fa.sales_agg.product_totals
+    group_totals, product_totals = saved[2], saved[3]
+
+    def record(fn):
+        def wrapped(rows, *args, **kw):
+            folds.append((len(rows), len(index.requests)))
+            return fn(rows, *args, **kw)
+        return wrapped
+
+    fa._search_page, fa.SECURED_SEARCH_MAX_DOCS = index, 0
+    fa.sales_agg.group_totals, fa.sales_agg.product_totals = record(group_totals), record(product_totals)
+    results = []
+    try:
+        for label, run, count in (
+                ("query", lambda: fa._run_query(fa._parse_query({"metrics": "count"}), "*"),
+                 lambda out: sum(r["count"] for r in out["rows"])),
+                ("scan totals", lambda: fa._scan_product_totals("*", allow_revenue=False),
+                 lambda out: round(sum(t["UnitSold"] for t in out.values()) / 10))):
+            folds.clear()
+            index.requests.clear()
+            rows = count(asyncio.run(run()))
+            biggest = max(n for n, _ in folds)
+            ahead = max(sent - i for i, (_, sent) in enumerate(folds, 1))   # pages fetched but not folded yet
+            results.append(_check(f"streaming {label}", rows == 9000 and biggest <= 1000
+                                  and ahead <= fa.SECURED_SEARCH_FETCH_WORKERS,
+                                  f"{rows} rows in {len(folds)} folds of <= {biggest}, at most {ahead} page(s) ahead"))
+    finally:
+        fa._search_page, fa.SECURED_SEARCH_MAX_DOCS, fa.sales_agg.group_totals, fa.sales_agg.product_totals = saved
+    return results
+
+def check_batch() -> list:
+    """A batch reads one set of numbers: product spellings are merged for popular_product as for product_revenue."""
+    docs = [dict(d, Product="Data Booster 1GB" if i < 6 else "data booster 1gb" if i < 16 else "Plan X")
+            for i, d in enumerate(_sales(28))]
+    saved = fa._search_page, fa._agg_cache, fa.SECURED_SEARCH_AGG_MODE
+    fa._search_page, fa._agg_cache, fa.SECURED_SEARCH_AGG_MODE = FakeIndex(docs), fa._TTLCache(0, 0), "scan"
+    try:
+        status, out = _secured_search({"operations": [{"id": "top", "operation": "popular_product"},
+                                                      {"operation": "product_revenue", "product_from": "top"}]})
+    finally:
+        fa._search_page, fa._agg_cache, fa.SECURED_SEARCH_AGG_MODE = saved
+    top, revenue = [r.get("data") or {} for r in out.get("results", [{}, {}])]
+    return [_check("batch spellings agree", status == 200 and top.get("UnitSold") == 160
+                   and top.get("TotalRevenue") == revenue.get("total_revenue") == 1600,
+                   f"popular {top.get('Product')!r} {top.get('UnitSold')} units / {top.get('TotalRevenue')}, "
+                   f"product_revenue {revenue.get('total_revenue')}")]
+
+SCENARIOS = {"rollup": check_rollup, "rollup_failure": check_rollup_failure, "facet": check_facet, "facet_transport": check_facet_transport, "facet_sums": check_facet_sums, "products": check_product_index, "regions": check_regions, "pager": check_pager, "query": check_query_input, "batch": check_batch, "streaming": check_streaming}
+
+def main():
+    names = sys.argv[1:] or list(SCENARIOS)
+    results = []
+    for name in names:
+        results += SCENARIOS[name]()
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    main()
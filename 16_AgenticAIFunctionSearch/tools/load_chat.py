@@ -0,0 +1,185 @@
+"""
+Load test for /api/chat: throughput and latency at a given concurrency.
+
+Against a running host (local `func start` or a deployed app):
+
+    python tools/load_chat.py --url http://localhost:7071/api/chat --requests 200 --concurrency 50
+    python tools/load_chat.py --url https://<app>.azurewebsites.net/api/chat --key <function key>
+
+Without a host, --simulate compares the async chat handler with a sync one. The agent service is
+replaced by an in-process stand-in with fixed latencies:
+
+- async: every request on one event loop, as the Python worker runs `async def` functions; the
+  stand-in awaits like the aio SDK does.
+- sync: the same handler on thread pools sized like the worker's PYTHON_THREADPOOL_THREAD_COUNT
+  (its default, and 64), one request per thread at a time; the stand-in blocks the thread for
+  each call, as the sync SDK (and a `def` handler) did.
+
+    python tools/load_chat.py --simulate --requests 200 --concurrency 50 --run-ms 800
+    python tools/load_chat.py --simulate --threads 8 32 64 128
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def _report(name: str, latencies: list, errors: int, wall: float):
+    lat = sorted(latencies)
+    p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1000 if lat else float("nan")  # noqa: E731
+    print(f"{name:<24}{len(lat):>6} ok{errors:>5} err{wall:>9.2f} s{len(lat) / wall:>9.1f} req/s"
+          f"{statistics.fmean(lat) * 1000 if lat else float('nan'):>9.0f} ms avg{p(0.5):>7.0f} p50{p(0.95):>7.0f} p95")
+
+# -------------------- live host --------------------
+
+def run_http(args):
+    import requests
+
+    headers = {"Content-Type": "application/json", "x-user-role": args.role}
+    if args.key:
+        headers["x-functions-key"] = args.key
+    session = requests.Session()
+    latencies, errors, lock = [], [0], threading.Lock()
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        try:
+            r = session.post(args.url, headers=headers, json={"input": f"{args.prompt} #{i}"}, timeout=args.timeout)
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(time.perf_counter() - t0)
+            else:
+                errors[0] += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        list(ex.map(one, range(args.requests)))
+    _report(args.url, latencies, errors[0], time.perf_counter() - t0)
+
+# -------------------- in-process simulation --------------------
+
+class _SimulatedAgents:
+    """
+    Stand-in for client.agents (aio): waits like the service would, answers every run with one
+    message. blocking=True holds the calling thread for each wait instead of yielding to the loop.
+    """
+    def __init__(self, run_secs: float, rtt_secs: float, blocking: bool = False):
+        seq = iter(range(1, 1 << 62))
+        next_id = lambda prefix: f"{prefix}_{next(seq)}"  # noqa: E731
+        answer = types.SimpleNamespace(role="assistant", content=[types.SimpleNamespace(
+            text=types.SimpleNamespace(value="Simulated answer.", annotations=[]))])
+
+        async def wait(secs: float):
+            if blocking:
+                time.sleep(secs)
+            else:
+                await asyncio.sleep(secs)
+
+        async def create_thread(**kw):
+            await wait(rtt_secs)
+            return types.SimpleNamespace(id=next_id("thread"))
+
+        async def create_message(**kw):
+            await wait(rtt_secs)
+
+        async def list_messages():
+            await wait(rtt_secs)
+            yield answer
+
+        async def create_and_process(**kw):
+            await wait(run_secs)
+            return types.SimpleNamespace(id=next_id("run"), status="completed", usage=None)
+
+        self.threads = types.SimpleNamespace(create=create_thread)
+        self.messages = types.SimpleNamespace(create=create_message, list=lambda **kw: list_messages())
+        self.runs = types.SimpleNamespace(create_and_process=create_and_process)
+
+def run_simulated(args):
+    import azure.functions as func
+    import function_app as fa
+
+    os.environ.setdefault("AGENT_ID", "asst_simulated")
+    fa.init_error, fa._init_done = None, True
+
+    def request(i: int):
+        return func.HttpRequest(method="POST", url="/api/chat", headers={"x-user-role": args.role},
+                                body=json.dumps({"input": f"{args.prompt} #{i}"}).encode())
+
+    # async: one event loop; `concurrency` requests in flight, like host invocations
+    async def run_async():
+        fa.client = types.SimpleNamespace(agents=_SimulatedAgents(args.run_ms / 1000, args.rtt_ms / 1000))
+        latencies, errors = [], 0
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def one(i: int):
+            nonlocal errors
+            async with slots:
+                t0 = time.perf_counter()
+                r = await fa.chat(request(i))
+                if r.status_code == 200:
+                    latencies.append(time.perf_counter() - t0)
+                else:
+                    errors += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        _report("async (1 loop)", latencies, errors, time.perf_counter() - t0)
+
+    # sync: the handler holds a worker thread per request; `concurrency` callers queue for them
+    def run_sync(threads: int):
+        fa.client = types.SimpleNamespace(agents=_SimulatedAgents(args.run_ms / 1000, args.rtt_ms / 1000, blocking=True))
+        latencies, errors = [], 0
+        worker = ThreadPoolExecutor(max_workers=threads)
+
+        def one_sync(i: int):
+            t0 = time.perf_counter()
+            r = worker.submit(asyncio.run, fa.chat(request(i))).result()
+            return r.status_code, time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with worker, ThreadPoolExecutor(max_workers=args.concurrency) as callers:
+            for status, secs in callers.map(one_sync, range(args.requests)):
+                if status == 200:
+                    latencies.append(secs)
+                else:
+                    errors += 1
+        _report(f"sync ({threads} threads)", latencies, errors, time.perf_counter() - t0)
+
+    asyncio.run(run_async())
+    for threads in dict.fromkeys(args.threads):
+        run_sync(threads)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="chat endpoint of a running host")
+    ap.add_argument("--key", help="function key (x-functions-key)")
+    ap.add_argument("--simulate", action="store_true", help="in-process run against a simulated agent service")
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--role", default="user")
+    ap.add_argument("--prompt", default="What's new on the sales dashboard?")
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--run-ms", type=float, default=800, help="simulated agent run time")
+    ap.add_argument("--rtt-ms", type=float, default=30, help="simulated latency of the other agent calls")
+    ap.add_argument("--threads", type=int, nargs="*", default=[min(32, (os.cpu_count() or 1) + 4), 64],
+                    help="thread counts for the sync baseline (PYTHON_THREADPOOL_THREAD_COUNT; default the worker's, and 64)")
+    args = ap.parse_args()
+    if args.simulate:
+        run_simulated(args)
+    elif args.url:
+        run_http(args)
+    else:
+        ap.error("pass --url or --simulate")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Local HTTP stand-in for cited news pages, to exercise source enrichment (source_meta.py) offline.
+
+Pages are served from 127.0.0.1; addressing the same server as "localhost" makes a second host for
+the per-host limit. Paths:
+
+    /page/<n>?delay=<ms>       HTML with og:title / og:site_name / article:published_time
+    /bare/<n>                  HTML with only a <title> (publisher falls back to the host)
+    /redirect/<n>              302 to /page/<n>
+    /plain, /missing           text/plain, 404 (cached as failures)
+
+    python tools/source_standin.py --serve --port 8765      # serve until Ctrl+C
+    python tools/source_standin.py                          # run the scenarios below against it
+
+The scenarios check: a cold fetch of pages on two hosts stays within the per-host limit and is
+done in about (pages per host / per_host) x delay; a burst of slow links to one host doesn't keep
+another host's page past the budget; a warm repeat is served from the SQLite cache
+without requests; a slow page is cut off at the budget and still lands in the cache afterwards;
+failures are cached; non-public addresses are refused unless allowed, also when the host passes
+the resolver check and then connects to a private address (DNS rebinding).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import requests  # noqa: E402
+import citations  # noqa: E402
+import source_meta  # noqa: E402
+
+# -------------------- server --------------------
+
+class StandIn:
+    """ThreadingHTTPServer on 127.0.0.1 in a daemon thread, counting hits and peak concurrency per host."""
+
+    def __init__(self, port: int = 0):
+        self.hits = Counter()
+        self.peak = Counter()
+        self._active = Counter()
+        self._lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                host = self.headers.get("Host", "").split(":")[0]
+                with standin._lock:
+                    standin.hits[self.path] += 1
+                    standin._active[host] += 1
+                    standin.peak[host] = max(standin.peak[host], standin._active[host])
+                try:
+                    standin._serve(self)
+                finally:
+                    with standin._lock:
+                        standin._active[host] -= 1
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path: str, host: str = "127.0.0.1") -> str:
+        return f"http://{host}:{self.port}{path}"
+
+    def _serve(self, h: BaseHTTPRequestHandler):
+        parts = urlsplit(h.path)
+        delay = float(parse_qs(parts.query).get("delay", ["0"])[0]) / 1000
+        if delay:
+            time.sleep(delay)
+        kind, _, n = parts.path.strip("/").partition("/")
+        if kind == "page":
+            body = (f'<html><head><title>Page {n} | Stand-in</title>'
+                    f'<meta property="og:title" content="Story {n}: Contoso &amp; partners">'
+                    f'<meta property="og:site_name" content="Stand-in News">'
+                    f'<meta property="article:published_time" content="2026-10-{int(n) % 28 + 1:02d}T08:00:00Z">'
+                    f'</head><body>{"<p>filler</p>" * 2000}</body></html>')
+            self._reply(h, 200, "text/html; charset=utf-8", body)
+        elif kind == "bare":
+            self._reply(h, 200, "text/html", f"<html><head><title>  Bare\n page {n} </title></head><body></body></html>")
+        elif kind == "redirect":
+            h.send_response(302)
+            h.send_header("Location", f"/page/{n}")
+            h.send_header("Content-Length", "0")
+            h.end_headers()
+        elif kind == "plain":
+            self._reply(h, 200, "text/plain", "not html")
+        else:
+            self._reply(h, 404, "text/plain", "missing")
+
+    @staticmethod
+    def _reply(h: BaseHTTPRequestHandler, status: int, ctype: str, body: str):
+        data = body.encode()
+        h.send_response(status)
+        h.send_header("Content-Type", ctype)
+        h.send_header("Content-Length", str(len(data)))
+        h.end_headers()
+        h.wfile.write(data)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# -------------------- scenarios --------------------
+
+def _sources(urls) -> list:
+    return [citations.Source("Source", u) for u in urls]
+
+def _enricher(cache, **kw) -> source_meta.Enricher:
+    session = requests.Session()
+    return source_meta.Enricher(lambda: session, cache, **{"allow_private": True, **kw})
+
+def _check(name: str, ok: bool, detail: str):
+    print(f"{'ok ' if ok else 'FAIL'} {name:<34}{detail}")
+    return ok
+
+def run_scenarios(args) -> bool:
+    srv = StandIn()
+    cache_path = os.path.join(tempfile.mkdtemp(prefix="source-meta-"), "cache.sqlite3")
+    cache = source_meta.MetaCache(cache_path)
+    enricher = _enricher(cache, per_host=args.per_host)
+    results = []
+    delay = args.delay_ms
+
+    # cold: pages on two hosts, all enriched within the budget, per-host limit respected
+    urls = [srv.url(f"/page/{i}?delay={delay}", host) for host in ("127.0.0.1", "localhost") for i in range(args.pages)]
+    sources = _sources(urls)
+    t0 = time.perf_counter()
+    changed = enricher.enrich(sources, budget=args.budget_ms / 1000)
+    cold = time.perf_counter() - t0
+    expect = -(-args.pages // args.per_host) * delay / 1000
+    results.append(_check("cold fetch", changed == len(sources), f"{changed}/{len(sources)} enriched in {cold * 1000:.0f} ms "
+                          f"(~{expect * 1000:.0f} ms expected), e.g. {sources[0].as_dict()}"))
+    results.append(_check("per-host limit", max(srv.peak.values()) <= args.per_host, f"peak concurrency {dict(srv.peak)}"))
+
+    # burst: more slow links to one host than there are workers; another host's page isn't held up
+    burst = _enricher(None, per_host=args.per_host, workers=4)
+    sources = _sources([srv.url(f"/page/{100 + i}?delay={delay * 4:.0f}") for i in range(12)]
+                       + [srv.url(f"/page/200?delay={delay}", "localhost")])
+    t0 = time.perf_counter()
+    burst.enrich(sources, budget=delay * 3 / 1000)
+    spent = time.perf_counter() - t0
+    results.append(_check("burst on one host", sources[-1].title.startswith("Story 200"),
+                          f"other host's page {'enriched' if sources[-1].title != 'Source' else 'missed'} "
+                          f"within {spent * 1000:.0f} ms"))
+
+    # warm: the same URLs come from the cache, no requests
+    before = sum(srv.hits.values())
+    sources = _sources(urls)
+    t0 = time.perf_counter()
+    changed = enricher.enrich(sources, budget=args.budget_ms / 1000)
+    warm = time.perf_counter() - t0
+    results.append(_check("warm (cache)", changed == len(sources) and sum(srv.hits.values()) == before,
+                          f"{changed}/{len(sources)} enriched in {warm * 1000:.1f} ms, {sum(srv.hits.values()) - before} requests"))
+
+    # another worker process opening the same cache file
+    other = _enricher(source_meta.MetaCache(cache_path), per_host=args.per_host)
+    sources = _sources(urls[:1])
+    results.append(_check("cache shared via file", other.enrich(sources, budget=0.5) == 1 and sum(srv.hits.values()) == before,
+                          sources[0].title))
+
+    # budget: a slow page is cut off, finishes in the background and is cached
+    slow = srv.url(f"/page/99?delay={args.budget_ms * 3:.0f}")
+    sources = _sources([slow, srv.url("/bare/1"), srv.url("/redirect/7")])
+    t0 = time.perf_counter()
+    enricher.enrich(sources, budget=args.budget_ms / 1000)
+    spent = time.perf_counter() - t0
+    results.append(_check("budget", spent < args.budget_ms / 1000 + 0.15 and sources[0].title == "Source",
+                          f"returned after {spent * 1000:.0f} ms; fast ones: {sources[1].title!r} / {sources[2].title!r}"))
+    time.sleep(args.budget_ms * 3 / 1000)
+    later = _sources([slow])
+    enricher.enrich(later, budget=0)
+    results.append(_check("late fetch cached", later[0].title.startswith("Story 99"), later[0].title))
+
+    # failures are cached (no refetch) and leave the placeholder
+    bad = [srv.url("/plain"), srv.url("/missing")]
+    enricher.enrich(_sources(bad), budget=1)
+    enricher.enrich(_sources(bad), budget=1)
+    results.append(_check("failures cached", all(srv.hits[urlsplit(u).path] == 1 for u in bad),
+                          f"hits {[srv.hits[urlsplit(u).path] for u in bad]}"))
+
+    # non-public addresses are refused by default
+    strict = source_meta.Enricher(requests.Session, None)
+    sources = _sources([srv.url("/page/42")])
+    strict.enrich(sources, budget=1)
+    results.append(_check("private refused", srv.hits["/page/42"] == 0 and sources[0].title == "Source", str(strict.stats)))
+
+    # rebinding: the resolver check passes, the connection still reaches 127.0.0.1
+    checked = source_meta._public_host
+    source_meta._public_host = lambda host: True
+    try:
+        strict = source_meta.Enricher(requests.Session, None)
+        sources = _sources([srv.url("/page/43"), srv.url("/redirect/44", host="localhost")])
+        strict.enrich(sources, budget=1)
+    finally:
+        source_meta._public_host = checked
+    results.append(_check("rebound host refused", srv.hits["/page/43"] + srv.hits["/redirect/44"] == 0
+                          and all(s.title == "Source" for s in sources), str(strict.stats)))
+
+    print("stats", enricher.stats)
+    srv.close()
+    return all(results)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--serve", action="store_true", help="only serve pages")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--pages", type=int, default=8, help="pages per host in the cold scenario")
+    ap.add_argument("--per-host", type=int, default=2)
+    ap.add_argument("--delay-ms", type=float, default=100)
+    ap.add_argument("--budget-ms", type=float, default=800)
+    args = ap.parse_args()
+    if args.serve:
+        srv = StandIn(args.port)
+        print(f"serving on {srv.url('/page/1')} (and localhost:{srv.port})")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            srv.close()
+        return
+    sys.exit(0 if run_scenarios(args) else 1)
+
+if __name__ == "__main__":
+    main()